@@ -18,12 +18,20 @@ import json
 import stomp
 import orjson
 
+from common.berths import BerthClass, class_expression, classes_expression, classify
 from common.config import Config
+from common.journeys import JourneySegmenter
 from common.mongo import Mongo
+from common.ppm import add_rollups, backfill_rollups
+from common.sketch import QuantileSketch
+from common.usage import add_usage, backfill_usage, count_steps
 
 
 log = logging.getLogger("data_collector")
 
+# Feed time between evictions of idle trains from the journey segmenter
+EVICT_INTERVAL = datetime.timedelta(minutes=1)
+
 
 class Feeds(enum.Enum):
     """Enumeration detailing the feed implementations."""
@@ -92,6 +100,7 @@ class PPMFeed(StompFeed):
 
         if self.mongo is not None:
             self.mongo.add("PPM", doc)
+            add_rollups(self.mongo, doc)
 
 
 class TDFeed(StompFeed):
@@ -105,14 +114,15 @@ class TDFeed(StompFeed):
 
     1) We update the `BERTHS' document for the `from' berth, removing the current train
     description and time as well as adding the `to' berth to it's `CONNECTIONS' array
-    if not already there.
+    if not already there. New berths are given their `CLASS' code, see common.berths.
 
     2) We update the `BERTHS' document for the `to' berth, adding the new train
     description and time, as well as adding the `from' berth to it's `CONNECTIONS'
     array if not already there.
 
     3) We update the mongodb `TRAINS' document for that specific headcode/reporting
-    number train. Appending the `to` berth and step time to their respective arrays.
+    number train. Appending the `to` berth, its class and step time to their
+    respective arrays.
 
     Whenever a `berth interpose' message is received we do the following...
 
@@ -121,6 +131,14 @@ class TDFeed(StompFeed):
 
     3) We update the mongodb `TRAINS' document for that specific headcode/reporting
     number train. Appending the `to` berth and time to their respective arrays.
+
+    Every step into a berth, from either message, also increments the berth's one
+    minute bucket in the `BERTH_USAGE' counters once per message frame, see
+    common.usage.
+
+    When COLLECTOR_EDGES is set the steps through real berths are also segmented
+    into journeys as they arrive, see common.journeys. The traversal times of the
+    finished edges are added to the `EDGES' collection once per message frame.
     ----------------------------------------------------------------
 
     - Need to make sure the first berth in a journey is captured for each train, do we
@@ -143,6 +161,12 @@ class TDFeed(StompFeed):
             mongo (common.mongo.Mongo): database class
         """
         super().__init__(["/topic/TD_LNW_C_SIG_AREA"], ["thetrains-td-lnw-c"], mongo)
+        self.segmenter = None
+        if Config.COLLECTOR_EDGES:
+            self.segmenter = JourneySegmenter(
+                Config.GENERATOR_DELTA_B, Config.GENERATOR_DELTA_T
+            )
+        self.last_evict = None
 
     async def handle_message(self, message):
         """Handle the TD JSON message."""
@@ -152,6 +176,9 @@ class TDFeed(StompFeed):
             log.error("Can't decode STOMP message")
             return
 
+        movements = 0
+        steps = []
+        edges = []
         for parsed_msg in parsed:
             msg_type = list(parsed_msg.keys())[0]
             msg = parsed_msg[msg_type]
@@ -165,17 +192,25 @@ class TDFeed(StompFeed):
                 )
 
                 # Generate update dictionaries
+                class_from = int(classify(berth_from))
+                class_to = int(classify(berth_to))
                 update_from = {
                     "$set": {"LATEST_TRAIN": "0000", "LATEST_TIME": time},
                     "$addToSet": {"CONNECTIONS": berth_to},
-                    "$setOnInsert": {"FIXED": False},
+                    "$setOnInsert": {"FIXED": False, "CLASS": class_from},
                 }
                 update_to = {
                     "$set": {"LATEST_TRAIN": train, "LATEST_TIME": time},
                     "$addToSet": {"CONNECTIONS": berth_from},
-                    "$setOnInsert": {"FIXED": False},
+                    "$setOnInsert": {"FIXED": False, "CLASS": class_to},
                 }
-                update_train = {"$push": {"BERTHS": berth_to, "TIMES": time}}
+                update_train = {
+                    "$push": {"BERTHS": berth_to, "TIMES": time, "CLASSES": class_to}
+                }
+                movements += 1
+                steps.append((berth_to, time))
+                if self.segmenter is not None and class_to == BerthClass.REAL:
+                    edges.extend(self.segmenter.step(train, berth_to, time))
 
                 # Run database updates
                 if self.mongo is not None:
@@ -190,11 +225,18 @@ class TDFeed(StompFeed):
                 log.debug("TD_CC_MSG: {},{},{}\n".format(time, train, berth_to))
 
                 # Generate update dictionaries
+                class_to = int(classify(berth_to))
                 update_to = {
                     "$set": {"LATEST_TRAIN": train, "LATEST_TIME": time},
-                    "$setOnInsert": {"FIXED": False},
+                    "$setOnInsert": {"FIXED": False, "CLASS": class_to},
+                }
+                update_train = {
+                    "$push": {"BERTHS": berth_to, "TIMES": time, "CLASSES": class_to}
                 }
-                update_train = {"$push": {"BERTHS": berth_to, "TIMES": time}}
+                movements += 1
+                steps.append((berth_to, time))
+                if self.segmenter is not None and class_to == BerthClass.REAL:
+                    edges.extend(self.segmenter.step(train, berth_to, time))
 
                 # Run database updates
                 if self.mongo is not None:
@@ -212,6 +254,39 @@ class TDFeed(StompFeed):
             else:  # should not happen
                 log.warning("Received unknown TD message type: {}".format(msg_type))
 
+        # Count the movements once per frame so the generator can schedule runs
+        if self.mongo is not None and movements > 0:
+            update_count = {"$inc": {"COUNT": movements}}
+            self.mongo.update("COUNTERS", {"NAME": "MOVEMENTS"}, update_count)
+            add_usage(self.mongo, count_steps(steps))
+
+        # Finish the journeys of idle trains at most once a minute of feed time
+        if self.segmenter is not None and movements > 0:
+            if self.last_evict is None or time - self.last_evict > EVICT_INTERVAL:
+                edges.extend(self.segmenter.evict(time))
+                self.last_evict = time
+            self.add_edges(edges)
+
+    def add_edges(self, edges):
+        """Add the traversal times of finished edges to the EDGES statistics.
+
+        Args:
+            edges ([(str, str, float, datetime.datetime)]): from berth, to berth,
+                seconds taken and time of each edge
+        """
+        sketches = {}
+        for b_from, b_to, seconds, _ in edges:
+            if (b_from, b_to) not in sketches:
+                sketches[(b_from, b_to)] = QuantileSketch(
+                    max_value=Config.GENERATOR_DELTA_T * 3600.0
+                )
+            sketches[(b_from, b_to)].add(seconds)
+
+        if self.mongo is not None:
+            for (b_from, b_to), sketch in sketches.items():
+                update = {"$inc": sketch.to_inc()}
+                self.mongo.update("EDGES", {"FROM": b_from, "TO": b_to}, update)
+
 
 class TMFeed(StompFeed):
     """Train movement feed handling class.
@@ -417,6 +492,29 @@ class STOMPCollector(object):
         sys.exit(0)
 
 
+def classify_berths(mongo):
+    """Add the berth class codes to any BERTHS and TRAINS stored without them.
+
+    This must run before the feeds are subscribed to, so the CLASSES array of
+    every train stays aligned with its BERTHS array. Trains stepped by an older
+    collector after this has run are classified by the generator itself.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+    """
+    mongo.create_index("BERTHS", [("CLASS", 1)])
+    selection = {"CLASS": {"$exists": False}}
+    update = [{"$set": {"CLASS": class_expression("$NAME")}}]
+    mongo.update("BERTHS", selection, update, many=True, upsert=False)
+
+    # Trains stepped by an older collector also have too few classes
+    size = {"$size": {"$ifNull": ["$CLASSES", []]}}
+    selection = {"$expr": {"$ne": [size, {"$size": "$BERTHS"}]}}
+    update = [{"$set": {"CLASSES": classes_expression("$BERTHS", "$CLASSES")}}]
+    mongo.update("TRAINS", selection, update, many=True, upsert=False)
+    log.info("Classified stored berths and trains")
+
+
 def main():
     """Call when data_collector starts."""
     # Setup the configuration and mongo connection
@@ -429,8 +527,24 @@ def main():
         with open("./berths.json") as berths_file:
             berths_data = json.load(berths_file)
             for key, set_data in berths_data.items():
+                set_data["CLASS"] = int(classify(key))
                 mongo.update("BERTHS", {"NAME": key}, {"$set": set_data})
 
+    # Classify any berths and trains stored before berth classes were added
+    if mongo is not None:
+        classify_berths(mongo)
+
+    # Index the berth and PPM times, and roll up any PPM stored before the rollups
+    if mongo is not None:
+        mongo.create_index("BERTHS", [("LATEST_TIME", 1)])
+        mongo.create_index("PPM", [("date", 1)])
+        for collection in backfill_rollups(mongo):
+            log.info("Backfilled the {} rollups".format(collection))
+
+    # Count the usage of the last hour from the TRAINS if not counted already
+    if mongo is not None and backfill_usage(mongo, datetime.datetime.now()):
+        log.info("Backfilled the berth usage counters")
+
     # Setup the STOMP national rail data feed collector and connect
     feeds = []
     if Config.COLLECTOR_PPM:
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the classification of train describer berth names.
+
+Berth names are the two character TD area followed by the four character
+berth. Besides the real signalling berths the TD feeds also step trains
+through pseudo berths, such as the `STrike IN' and `Clear OUT' berths, the
+date, time and clock berths and the `Last Sent', `Train Reporting' and SMART
+link status berths. The collector classifies each berth name once as it is
+first seen, so the class code can be stored and queried instead of matching
+every berth name again on every generator run.
+
+The same ordered rule table is used to classify names in Python and to build
+the equivalent MongoDB expression for classifying stored names.
+"""
+
+import re
+import enum
+
+
+class BerthClass(enum.IntEnum):
+    """Compact berth class codes stored in the database."""
+
+    REAL = 0
+    MALFORMED = 1
+    LINK_STATUS = 2
+    STRIKE = 3
+    CLOCK = 4
+
+
+# Ordered classification rules, the first matching rule wins
+BERTH_RULES = [
+    (BerthClass.MALFORMED, "^(?!.{6}$)"),
+    (BerthClass.LINK_STATUS, "^..(LS|TR|SMT)|LS$"),
+    (BerthClass.STRIKE, "(STIN|COUT)$"),
+    (BerthClass.CLOCK, "(DATE|TIME|CLCK)$"),
+]
+
+_COMPILED_RULES = [(code, re.compile(regex)) for code, regex in BERTH_RULES]
+
+
+def classify(name):
+    """Classify a berth name.
+
+    Args:
+        name (str): berth name, the TD area followed by the berth
+    Returns:
+        BerthClass: berth class
+    """
+    for code, regex in _COMPILED_RULES:
+        if regex.search(name):
+            return code
+    return BerthClass.REAL
+
+
+def class_expression(name):
+    """Get the MongoDB aggregation expression that classifies a berth name.
+
+    Args:
+        name (str): aggregation expression of the berth name, e.g. "$NAME"
+    Returns:
+        dict: expression evaluating to the integer berth class
+    """
+    return {
+        "$switch": {
+            "branches": [
+                {
+                    "case": {"$regexMatch": {"input": name, "regex": regex}},
+                    "then": int(code),
+                }
+                for code, regex in BERTH_RULES
+            ],
+            "default": int(BerthClass.REAL),
+        }
+    }
+
+
+def classes_expression(berths, classes):
+    """Get the MongoDB expression of the berth classes of a train.
+
+    Trains stored before the classes were, or stepped by an older collector,
+    have no classes or fewer classes than berths. Their classes no longer line
+    up with their berths, so all of their berths are classified again instead.
+
+    Args:
+        berths (str): aggregation expression of the berth names, e.g. "$BERTHS"
+        classes (str): aggregation expression of the stored berth classes
+    Returns:
+        dict: expression evaluating to the berth classes, aligned with the berths
+    """
+    return {
+        "$cond": [
+            {"$eq": [{"$size": {"$ifNull": [classes, []]}}, {"$size": berths}]},
+            classes,
+            {
+                "$map": {
+                    "input": berths,
+                    "as": "berth",
+                    "in": class_expression("$$berth"),
+                }
+            },
+        ]
+    }
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the broadcast of live berth occupancy changes to the dash clients.
+
+Each dash worker process runs one upstream thread that follows the occupancy of
+the selected BERTHS and passes every batch of changes to the queue of each open
+server-sent events stream. The thread follows a change stream on the BERTHS
+where the database supports them, replica sets and sharded clusters, and
+otherwise polls for berths with a recent LATEST_TIME, comparing them against
+the occupancy it last saw.
+
+A client that falls behind by more than a full queue misses changes rather
+than holding up the others, and is brought up to date by the next refresh of
+the graph page's dynamic layer.
+
+Each open stream holds one of the worker's threads, so only a limited number of
+clients are streamed to, leaving the rest of the threads to the dash callbacks.
+Clients turned away keep up with the periodic patches of the dynamic layer.
+The upstream thread stops once the last client leaves. If the change stream or
+a poll fails it is tried again after a back off, so the open streams are not
+left with only keepalives, and polling is only fallen back to when the server
+does not support change streams.
+"""
+
+import json
+import time
+import queue
+import datetime
+import threading
+
+from pymongo.errors import PyMongoError
+
+# Batches of changes queued for a client before further ones are dropped
+QUEUE_SIZE = 100
+
+# Seconds between polls and how far back each poll looks for out of order times
+POLL_INTERVAL = 0.5
+POLL_LAG = datetime.timedelta(minutes=1)
+
+# Seconds between keepalive comments on an idle stream
+KEEPALIVE = 15
+
+# Milliseconds a change stream waits for changes before checking for clients
+STREAM_AWAIT = 1000
+
+# Seconds before a failed change stream is first opened again, and at most
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 60
+
+OCCUPANCY_FIELDS = ["NAME", "LATEST_TRAIN", "LATEST_TIME"]
+
+
+def changed_states(states, docs):
+    """Get the berths whose occupancy changed, updating the last seen states.
+
+    Args:
+        states (dict): last seen train and time keyed by berth, updated in place
+        docs ([dict]): BERTHS documents with the latest train and time
+    Returns:
+        dict: berth names, trains and times of the changed berths
+    """
+    changes = {"NAMES": [], "TRAINS": [], "TIMES": []}
+    for doc in docs:
+        state = (doc.get("LATEST_TRAIN", "0000"), doc.get("LATEST_TIME"))
+        if states.get(doc["NAME"]) == state:
+            continue
+        states[doc["NAME"]] = state
+        changes["NAMES"].append(doc["NAME"])
+        changes["TRAINS"].append(state[0])
+        changes["TIMES"].append(str(state[1]))
+    return changes
+
+
+class BerthBroadcaster(object):
+    """Follows the BERTHS occupancy once and fans the changes out to clients."""
+
+    def __init__(self, log, mongo, max_subscribers=16):
+        """Initialise BerthBroadcaster.
+
+        Args:
+            log (logging.logger): Logger to use
+            mongo (common.mongo.Mongo): Database class
+            max_subscribers (int): Most clients streamed to at once
+        """
+        self.log = log
+        self.mongo = mongo
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self):
+        """Add a client, starting the upstream thread if it is not running.
+
+        Returns:
+            queue.Queue: queue the client receives batches of changes on, None
+                if the most clients are already streamed to
+        """
+        subscriber = queue.Queue(maxsize=QUEUE_SIZE)
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            self.subscribers.add(subscriber)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Remove a client.
+
+        Args:
+            subscriber (queue.Queue): queue returned by subscribe
+        """
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, changes):
+        """Pass a batch of changes to every client.
+
+        Args:
+            changes (dict): berth names, trains and times of the changed berths
+        """
+        if not changes["NAMES"]:
+            return
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(changes)
+            except queue.Full:
+                pass
+
+    def active(self):
+        """Check if any clients are left, marking the thread stopped if not.
+
+        Returns:
+            bool: True if the upstream thread should keep running
+        """
+        with self.lock:
+            if not self.subscribers:
+                self.thread = None
+                return False
+            return True
+
+    def run(self):
+        """Follow the BERTHS occupancy until every client has left."""
+        if self.mongo is None:
+            return
+        pipeline = [
+            {
+                "$match": {
+                    "operationType": {"$in": ["update", "replace", "insert"]},
+                    "fullDocument.SELECTED": True,
+                }
+            },
+            {"$project": {"fullDocument." + f: 1 for f in OCCUPANCY_FIELDS}},
+        ]
+        delay = RETRY_DELAY
+        while self.active():
+            stream = self.mongo.watch(
+                "BERTHS",
+                pipeline,
+                full_document="updateLookup",
+                max_await_time_ms=STREAM_AWAIT,
+            )
+            if stream is None:
+                # Only poll when the server has no change streams, not on errors
+                if self.mongo.supports_change_streams() is False:
+                    self.log.info("Polling the BERTHS for occupancy changes")
+                    self.poll()
+                    return
+                followed = False
+            else:
+                self.log.info("Following the BERTHS change stream")
+                followed = self.follow(stream)
+
+            if followed:
+                delay = RETRY_DELAY
+            else:
+                # Back off before opening the change stream again
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def follow(self, stream):
+        """Publish the changes from a BERTHS change stream until it fails.
+
+        Args:
+            stream (pymongo.change_stream.ChangeStream): BERTHS change stream
+        Returns:
+            bool: True if any changes were followed
+        """
+        states = {}
+        followed = False
+        try:
+            with stream:
+                while self.active():
+                    change = stream.try_next()
+                    if change is None:
+                        continue
+                    followed = True
+                    doc = change.get("fullDocument")
+                    if doc is not None:
+                        self.publish(changed_states(states, [doc]))
+        except PyMongoError as e:
+            self.log.warning("BERTHS change stream error ({})".format(e))
+        return followed
+
+    def poll(self):
+        """Publish the changes found by polling the BERTHS until all clients leave."""
+        states = {}
+        since = None
+        delay = RETRY_DELAY
+        while self.active():
+            selection = {"SELECTED": True}
+            if since is not None:
+                selection["LATEST_TIME"] = {"$gte": since - POLL_LAG}
+            docs = self.mongo.get("BERTHS", selection, OCCUPANCY_FIELDS)
+            try:
+                docs = list(docs) if docs is not None else None
+            except PyMongoError as e:
+                self.log.warning("BERTHS poll error ({})".format(e))
+                docs = None
+            if docs is None:
+                # Back off before polling again
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+
+            delay = RETRY_DELAY
+            changes = changed_states(states, docs)
+            # The first poll only records the current occupancy
+            if since is not None:
+                self.publish(changes)
+            times = [doc["LATEST_TIME"] for doc in docs if doc.get("LATEST_TIME")]
+            if times and (since is None or max(times) > since):
+                since = max(times)
+            time.sleep(POLL_INTERVAL)
+
+
+def event_stream(broadcaster, subscriber):
+    """Stream the occupancy changes to a client as server-sent events.
+
+    Args:
+        broadcaster (BerthBroadcaster): broadcaster the client subscribed to
+        subscriber (queue.Queue): queue returned by subscribe
+    Returns:
+        generator: server-sent events
+    """
+    try:
+        while True:
+            try:
+                changes = subscriber.get(timeout=KEEPALIVE)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield "data: {}\n\n".format(json.dumps(changes, separators=(",", ":")))
+    finally:
+        broadcaster.unsubscribe(subscriber)
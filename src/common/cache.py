@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""Implements a small file cache shared between processes on the same host.
+
+The dash app runs several gunicorn worker processes, each serving callbacks
+for any of the open browser tabs. Expensive values, such as the built graph
+figure, are stored as pickle files in a local directory so every worker can
+serve them. An entry is reused until it is older than the TTL or its version
+no longer matches, for example when the generator publishes a new layout.
+
+Rebuilding an entry takes an exclusive file lock, so when an entry expires only
+one process rebuilds it while the others wait and then read the new entry.
+"""
+
+import os
+import time
+import fcntl
+import pickle
+import tempfile
+
+
+class FileCache(object):
+    """Cache of pickled values in a local directory with a TTL and versions."""
+
+    def __init__(self, directory, ttl):
+        """Initialise FileCache.
+
+        Args:
+            directory (str): Directory to store the cache files in
+            ttl (float): Seconds an entry is reused for, disabled if 0
+        """
+        self.directory = directory
+        self.ttl = ttl
+        if self.enabled():
+            os.makedirs(directory, exist_ok=True)
+
+    def enabled(self):
+        """Check if the cache is enabled.
+
+        Returns:
+            bool: True if entries are cached
+        """
+        return self.ttl > 0 and bool(self.directory)
+
+    def path(self, key):
+        """Get the file path of an entry.
+
+        Args:
+            key (str): entry name
+        Returns:
+            str: pickle file path
+        """
+        return os.path.join(self.directory, "{}.pickle".format(key))
+
+    def get(self, key, version=None):
+        """Get an entry if it is fresh.
+
+        Args:
+            key (str): entry name
+            version (object): version the entry must have been stored with
+        Returns:
+            object: cached value, None if missing, expired or another version
+        """
+        if not self.enabled():
+            return None
+        try:
+            with open(self.path(key), "rb") as entry_file:
+                entry = pickle.load(entry_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if entry["VERSION"] != version or time.time() - entry["TIME"] >= self.ttl:
+            return None
+        return entry["VALUE"]
+
+    def last(self, key):
+        """Get the last stored value of an entry, however old or of any version.
+
+        Args:
+            key (str): entry name
+        Returns:
+            object: last stored value, None if missing
+        """
+        if not self.enabled():
+            return None
+        try:
+            with open(self.path(key), "rb") as entry_file:
+                return pickle.load(entry_file)["VALUE"]
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, value, version=None):
+        """Store an entry, replacing it atomically.
+
+        Args:
+            key (str): entry name
+            value (object): value to store, must be picklable
+            version (object): version to store the entry with
+        """
+        if not self.enabled():
+            return
+        entry = {"TIME": time.time(), "VERSION": version, "VALUE": value}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as entry_file:
+                pickle.dump(entry, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path(key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def invalidate(self, key):
+        """Remove an entry so the next request rebuilds it.
+
+        Args:
+            key (str): entry name
+        """
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def get_or_build(self, key, build, version=None):
+        """Get an entry, building and storing it if it is not fresh.
+
+        Args:
+            key (str): entry name
+            build (callable): builds the value, a None value is not stored
+            version (object): version the entry must have been stored with
+        Returns:
+            object: cached or newly built value
+        """
+        if not self.enabled():
+            return build()
+
+        value = self.get(key, version)
+        if value is not None:
+            return value
+
+        # Only one process rebuilds, the rest wait for it and use its entry
+        lock_path = os.path.join(self.directory, "{}.lock".format(key))
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                value = self.get(key, version)
+                if value is None:
+                    value = build()
+                    if value is not None:
+                        self.set(key, value, version)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return value
@@ -24,18 +24,33 @@ class Config(object):
     COLLECTOR_PPM = config("COLLECTOR_PPM", cast=bool, default=False)
     COLLECTOR_TD = config("COLLECTOR_TD", cast=bool, default=False)
     COLLECTOR_TM = config("COLLECTOR_TM", cast=bool, default=False)
+    COLLECTOR_EDGES = config("COLLECTOR_EDGES", cast=bool, default=False)
 
     # Generator configuration
     GENERATOR_RATE = config("GENERATOR_RATE", cast=int, default=3600)
+    GENERATOR_POLL_RATE = config("GENERATOR_POLL_RATE", cast=int, default=60)
+    GENERATOR_MIN_MOVEMENTS = config("GENERATOR_MIN_MOVEMENTS", cast=int, default=50000)
+    GENERATOR_MIN_EDGES = config("GENERATOR_MIN_EDGES", cast=int, default=25)
     GENERATOR_K = config("GENERATOR_K", cast=float, default=0.000001)
     GENERATOR_ITER = config("GENERATOR_ITER", cast=int, default=5000)
     GENERATOR_CUT_D = config("GENERATOR_CUT_D", cast=float, default=0.25)
     GENERATOR_SCALE = config("GENERATOR_SCALE", cast=int, default=100000)
+    GENERATOR_LAYOUT = config("GENERATOR_LAYOUT", default="spring")
+    GENERATOR_CHUNK_SIZE = config("GENERATOR_CHUNK_SIZE", cast=int, default=20000)
+    GENERATOR_WORKERS = config("GENERATOR_WORKERS", cast=int, default=1)
     GENERATOR_DELTA_B = config("GENERATOR_DELTA_B", cast=int, default=5)
     GENERATOR_DELTA_T = config("GENERATOR_DELTA_T", cast=int, default=1)
+    GENERATOR_CHECKPOINTS = config("GENERATOR_CHECKPOINTS", default="")
+    GENERATOR_RETENTION_HOURS = config("GENERATOR_RETENTION_HOURS", cast=int, default=0)
+    GENERATOR_ROLLUP_DAYS = config("GENERATOR_ROLLUP_DAYS", cast=int, default=90)
+    GENERATOR_TRACE_MEMORY = config("GENERATOR_TRACE_MEMORY", cast=bool, default=False)
+    GENERATOR_PROFILES = config("GENERATOR_PROFILES", default="")
 
     # Dash configuration
     DASH_MAPBOX_TOKEN = config("DASH_MAPBOX_TOKEN", default="token")
+    DASH_CACHE_DIR = config("DASH_CACHE_DIR", default="/tmp/thetrains")
+    DASH_CACHE_TTL = config("DASH_CACHE_TTL", cast=int, default=5)
+    DASH_MAX_STREAMS = config("DASH_MAX_STREAMS", cast=int, default=16)
 
     @staticmethod
     def init_logging(log):
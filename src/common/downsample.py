@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the downsampling of time series for plotting.
+
+Plotting more points than the plot has pixels only costs transfer and render
+time. The Largest-Triangle-Three-Buckets algorithm, from Sveinn Steinarsson's
+thesis "Downsampling Time Series for Visual Representation", keeps the first and
+last points and one point from each of the equal sized buckets in between. The
+point kept is the one forming the largest triangle with the point kept from the
+previous bucket and the average of the next bucket, which preserves the peaks
+and troughs a plot of every point would show.
+"""
+
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """Select the points of a series to keep with Largest-Triangle-Three-Buckets.
+
+    Args:
+        x (np.ndarray): increasing x values, datetimes are used as nanoseconds
+        y (np.ndarray): y values
+        threshold (int): number of points to keep
+    Returns:
+        np.ndarray: sorted indices of the points to keep
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype("datetime64[ns]").astype(np.int64)
+    x = x.astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    # Split all but the first and last points into threshold - 2 buckets
+    bounds = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64)
+    bounds += 1
+    bounds[-1] = n - 1
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = bounds[i], bounds[i + 1]
+        if i + 2 < len(bounds):
+            avg_x = x[hi : bounds[i + 2]].mean()  # noqa: E203
+            avg_y = y[hi : bounds[i + 2]].mean()  # noqa: E203
+        else:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+
+        # Twice the area of the triangle with each point in the bucket
+        area = np.abs(
+            (x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a])
+        )
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the conversion of OSGB grid references to WGS84 coordinates.
+
+TIPLOC locations are given as Ordnance Survey National Grid eastings and
+northings on the OSGB36 datum, while the berths are stored as WGS84 latitudes
+and longitudes. The conversion follows the Ordnance Survey guide to coordinate
+systems in Great Britain: the inverse Transverse Mercator projection onto the
+Airy 1830 ellipsoid, then a seven parameter Helmert transformation to the
+GRS80 ellipsoid of WGS84. The Helmert transformation is accurate to a few
+metres, which is far closer than berths are spaced.
+
+Every function works on whole NumPy arrays, so thousands of TIPLOCs are
+converted at once.
+"""
+
+import numpy as np
+
+# Airy 1830 ellipsoid and the National Grid true origin
+AIRY_A = 6377563.396
+AIRY_B = 6356256.909
+F0 = 0.9996012717
+LAT0 = np.radians(49.0)
+LON0 = np.radians(-2.0)
+E0 = 400000.0
+N0 = -100000.0
+
+# GRS80 ellipsoid used by WGS84
+GRS80_A = 6378137.0
+GRS80_B = 6356752.3141
+
+# OSGB36 to WGS84 Helmert translation (m), scale (ppm) and rotation (arcsec)
+HELMERT_T = np.array([446.448, -125.157, 542.060])
+HELMERT_S = -20.4894
+HELMERT_R = np.array([0.1502, 0.2470, 0.8421])
+
+
+def osgb_to_wgs84(easting, northing):
+    """Convert National Grid eastings and northings to WGS84 coordinates.
+
+    Args:
+        easting (np.ndarray): OSGB36 eastings in metres
+        northing (np.ndarray): OSGB36 northings in metres
+    Returns:
+        np.ndarray: WGS84 latitudes in degrees
+        np.ndarray: WGS84 longitudes in degrees
+    """
+    lat, lon = grid_to_latlon(
+        np.asarray(easting, dtype=np.float64), np.asarray(northing, dtype=np.float64)
+    )
+    x, y, z = latlon_to_cartesian(lat, lon, AIRY_A, AIRY_B)
+    x, y, z = helmert(x, y, z)
+    lat, lon = cartesian_to_latlon(x, y, z, GRS80_A, GRS80_B)
+    return np.degrees(lat), np.degrees(lon)
+
+
+def grid_to_latlon(easting, northing):
+    """Invert the National Grid Transverse Mercator projection.
+
+    Args:
+        easting (np.ndarray): eastings in metres
+        northing (np.ndarray): northings in metres
+    Returns:
+        np.ndarray: OSGB36 latitudes in radians
+        np.ndarray: OSGB36 longitudes in radians
+    """
+    a, b = AIRY_A, AIRY_B
+    e2 = 1 - (b * b) / (a * a)
+    n = (a - b) / (a + b)
+    n2, n3 = n * n, n * n * n
+
+    def meridional_arc(lat):
+        d, s = lat - LAT0, lat + LAT0
+        return (
+            b
+            * F0
+            * (
+                (1 + n + 5 / 4 * n2 + 5 / 4 * n3) * d
+                - (3 * n + 3 * n2 + 21 / 8 * n3) * np.sin(d) * np.cos(s)
+                + (15 / 8 * n2 + 15 / 8 * n3) * np.sin(2 * d) * np.cos(2 * s)
+                - 35 / 24 * n3 * np.sin(3 * d) * np.cos(3 * s)
+            )
+        )
+
+    # Iterate the latitude until the meridional arc matches the northing
+    lat = (northing - N0) / (a * F0) + LAT0
+    for _ in range(20):
+        residual = northing - N0 - meridional_arc(lat)
+        if np.all(np.abs(residual) < 1e-5):
+            break
+        lat = lat + residual / (a * F0)
+
+    sin, cos, tan = np.sin(lat), np.cos(lat), np.tan(lat)
+    nu = a * F0 / np.sqrt(1 - e2 * np.square(sin))
+    rho = a * F0 * (1 - e2) / np.power(1 - e2 * np.square(sin), 1.5)
+    eta2 = nu / rho - 1
+    sec = 1 / cos
+    tan2 = np.square(tan)
+
+    vii = tan / (2 * rho * nu)
+    viii = tan / (24 * rho * np.power(nu, 3)) * (5 + 3 * tan2 + eta2 - 9 * tan2 * eta2)
+    ix = tan / (720 * rho * np.power(nu, 5)) * (61 + 90 * tan2 + 45 * np.square(tan2))
+    x = sec / nu
+    xi = sec / (6 * np.power(nu, 3)) * (nu / rho + 2 * tan2)
+    xii = sec / (120 * np.power(nu, 5)) * (5 + 28 * tan2 + 24 * np.square(tan2))
+    xiia = (
+        sec
+        / (5040 * np.power(nu, 7))
+        * (61 + 662 * tan2 + 1320 * np.power(tan2, 2) + 720 * np.power(tan2, 3))
+    )
+
+    de = easting - E0
+    lat = lat - vii * np.power(de, 2) + viii * np.power(de, 4) - ix * np.power(de, 6)
+    lon = (
+        LON0
+        + x * de
+        - xi * np.power(de, 3)
+        + xii * np.power(de, 5)
+        - xiia * np.power(de, 7)
+    )
+    return lat, lon
+
+
+def latlon_to_cartesian(lat, lon, a, b):
+    """Convert ellipsoidal coordinates at zero height to cartesian coordinates.
+
+    Args:
+        lat (np.ndarray): latitudes in radians
+        lon (np.ndarray): longitudes in radians
+        a (float): ellipsoid semi-major axis
+        b (float): ellipsoid semi-minor axis
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): x, y and z in metres
+    """
+    e2 = 1 - (b * b) / (a * a)
+    nu = a / np.sqrt(1 - e2 * np.square(np.sin(lat)))
+    x = nu * np.cos(lat) * np.cos(lon)
+    y = nu * np.cos(lat) * np.sin(lon)
+    z = (1 - e2) * nu * np.sin(lat)
+    return x, y, z
+
+
+def helmert(x, y, z):
+    """Apply the OSGB36 to WGS84 Helmert transformation.
+
+    Args:
+        x (np.ndarray): OSGB36 cartesian x in metres
+        y (np.ndarray): OSGB36 cartesian y in metres
+        z (np.ndarray): OSGB36 cartesian z in metres
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): WGS84 x, y and z in metres
+    """
+    s = 1 + HELMERT_S * 1e-6
+    rx, ry, rz = np.radians(HELMERT_R / 3600)
+    tx, ty, tz = HELMERT_T
+    return (
+        tx + s * x - rz * y + ry * z,
+        ty + rz * x + s * y - rx * z,
+        tz - ry * x + rx * y + s * z,
+    )
+
+
+def cartesian_to_latlon(x, y, z, a, b):
+    """Convert cartesian coordinates to ellipsoidal coordinates.
+
+    Args:
+        x (np.ndarray): x in metres
+        y (np.ndarray): y in metres
+        z (np.ndarray): z in metres
+        a (float): ellipsoid semi-major axis
+        b (float): ellipsoid semi-minor axis
+    Returns:
+        np.ndarray: latitudes in radians
+        np.ndarray: longitudes in radians
+    """
+    e2 = 1 - (b * b) / (a * a)
+    p = np.hypot(x, y)
+    lat = np.arctan2(z, p * (1 - e2))
+    for _ in range(10):
+        nu = a / np.sqrt(1 - e2 * np.square(np.sin(lat)))
+        lat = np.arctan2(z + e2 * nu * np.sin(lat), p)
+    return lat, np.arctan2(y, x)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the online segmentation of train journeys into berth edges.
+
+The collector feeds every step of a train through a real berth into the
+JourneySegmenter as it arrives. The segmenter applies the same rules the graph
+generator applies to the full TRAINS history, using only a few values of state
+per train:
+
+1) The delta of a step is the time since the previous step of the train, the
+very first step seen for a train only starts the timing.
+
+2) Steps within delta_b seconds of the previous step are duplicate, fringe or
+waiting berths and are dropped.
+
+3) Of repeated steps through the same berth only the last is kept.
+
+4) A step more than delta_t hours after the previous one starts a new journey,
+no edge links it to the previous step.
+
+The edge between two kept steps is only final once the next different berth
+is seen, so edges are emitted one step late, or when an idle train is evicted.
+
+The ChunkSegmenter applies the same rules with NumPy to a stream of steps read
+in fixed size chunks, where the steps of each train arrive together and in
+order. Only the train still streaming at the end of a chunk can continue into
+the next one, so it is the only state carried across chunks and memory stays
+bounded by the chunk size however long the history is.
+
+The generator runs on the full history again and again, so segment_trains only
+counts the traversal time of an edge once it is confirmed by the train entering
+the next berth, after the time the train was last counted up to.
+"""
+
+import datetime
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from common.sketch import QuantileSketch
+
+
+class JourneySegmenter(object):
+    """Per train state machine that turns berth steps into edge observations."""
+
+    def __init__(self, delta_b, delta_t):
+        """Initialise JourneySegmenter.
+
+        Args:
+            delta_b (int): Berths within delta seconds will be classed as the same
+            delta_t (int): Split train data when there is a gap of delta hours
+        """
+        self.delta_b = datetime.timedelta(seconds=delta_b)
+        self.delta_t = datetime.timedelta(hours=delta_t)
+        self.trains = {}
+
+    def step(self, train, berth, time):
+        """Add a step of a train through a real berth.
+
+        Args:
+            train (str): train description
+            berth (str): berth name
+            time (datetime.datetime): step time
+        Returns:
+            [(str, str, float, datetime.datetime)]: from berth, to berth, seconds
+                taken and time of the edges that are now final
+        """
+        state = self.trains.get(train)
+        if state is None:
+            # Only start the timing, there is no context for the first step
+            self.trains[train] = {"LAST": time, "PREV": None, "PENDING": None}
+            return []
+
+        delta = time - state["LAST"] if state["LAST"] is not None else self.delta_t
+        state["LAST"] = time
+        if delta < self.delta_b:
+            return []
+
+        edges = []
+        pending = state["PENDING"]
+        if pending is not None and pending[0] != berth:
+            edges = self.finalise(state)
+        state["PENDING"] = (berth, time, delta)
+        return edges
+
+    def finalise(self, state):
+        """Emit the edge into the pending step and make it the previous step.
+
+        Args:
+            state (dict): train state
+        Returns:
+            [(str, str, float, datetime.datetime)]: the edge, if there is one
+        """
+        edges = []
+        berth, time, delta = state["PENDING"]
+        if state["PREV"] is not None and delta < self.delta_t:
+            edges.append((state["PREV"], berth, delta.total_seconds(), time))
+        state["PREV"] = berth
+        state["PENDING"] = None
+        return edges
+
+    def evict(self, now):
+        """Finish the journeys of trains that have been idle for delta_t hours.
+
+        Evicted trains only keep an empty state, so their next step starts a
+        new journey rather than being dropped as a first step.
+
+        Args:
+            now (datetime.datetime): current feed time
+        Returns:
+            [(str, str, float, datetime.datetime)]: edges that are now final
+        """
+        edges = []
+        for train in list(self.trains):
+            state = self.trains[train]
+            if state["LAST"] is None or now - state["LAST"] < self.delta_t:
+                continue
+            if state["PENDING"] is not None:
+                edges.extend(self.finalise(state))
+            self.trains[train] = {"LAST": None, "PREV": None, "PENDING": None}
+        return edges
+
+
+class ChunkSegmenter(object):
+    """Vectorised segmentation of a chunked stream of train steps into edges."""
+
+    def __init__(self, delta_b, delta_t):
+        """Initialise ChunkSegmenter.
+
+        Args:
+            delta_b (int): Berths within delta seconds will be classed as the same
+            delta_t (int): Split train data when there is a gap of delta hours
+        """
+        self.delta_b = np.timedelta64(delta_b, "s")
+        self.delta_t = np.timedelta64(delta_t, "h")
+        self.carry = None
+
+    def chunk(self, trains, berths, times):
+        """Segment the next chunk of steps.
+
+        Args:
+            trains (np.ndarray): train of each step, steps of a train together
+            berths (np.ndarray): berth name of each step
+            times (np.ndarray): time of each step
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray): from
+                berths, to berths, seconds taken, trains and confirmation times
+                of the edges that are now final, see reduce
+        """
+        trains = np.asarray(trains, dtype=object)
+        berths = np.asarray(berths, dtype=object)
+        times = np.asarray(times, dtype="datetime64[ms]")
+        if len(times) == 0:
+            empty = np.empty(0, dtype=object)
+            return (
+                empty,
+                empty,
+                np.empty(0),
+                empty,
+                np.empty(0, dtype="datetime64[ms]"),
+            )
+
+        # The delta of a step is the time since the previous step of the train,
+        # which for the first step of the chunk may be in the previous chunk
+        deltas = np.full(len(times), np.timedelta64("NaT"), dtype="timedelta64[ms]")
+        same = trains[1:] == trains[:-1]
+        deltas[1:][same] = (times[1:] - times[:-1])[same]
+        if self.carry is not None and trains[0] == self.carry["TRAIN"]:
+            deltas[0] = times[0] - self.carry["LAST"]
+
+        # Drop the first step of each train and the steps within delta_b
+        keep = ~np.isnat(deltas)
+        keep[keep] = deltas[keep] >= self.delta_b
+
+        # Steps still pending from the previous chunk go before the new steps
+        c_trains, c_berths, c_times, c_entered, c_deltas, c_emitted = self.carried()
+        last = times[-1]
+        edges = self.reduce(
+            np.concatenate([c_trains, trains[keep]]),
+            np.concatenate([c_berths, berths[keep]]),
+            np.concatenate([c_times, times[keep]]),
+            np.concatenate([c_entered, times[keep]]),
+            np.concatenate([c_deltas, deltas[keep]]),
+            np.concatenate([c_emitted, np.zeros(int(keep.sum()), dtype=bool)]),
+            open_train=trains[-1],
+        )
+        self.carry["LAST"] = last
+        return edges
+
+    def finish(self):
+        """Emit the pending edge of the last train once the stream has ended.
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray): from
+                berths, to berths, seconds taken, trains and confirmation times
+                of the remaining edges, see reduce
+        """
+        edges = self.reduce(*self.carried(), open_train=None)
+        self.carry = None
+        return edges
+
+    def carried(self):
+        """Get the kept steps carried over from the previous chunk.
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray,
+                np.ndarray): trains, berths, times, times the berths were
+                entered, deltas and if the edge into them was handled
+        """
+        if self.carry is None:
+            return (
+                np.empty(0, dtype=object),
+                np.empty(0, dtype=object),
+                np.empty(0, dtype="datetime64[ms]"),
+                np.empty(0, dtype="datetime64[ms]"),
+                np.empty(0, dtype="timedelta64[ms]"),
+                np.empty(0, dtype=bool),
+            )
+        rows = self.carry["ROWS"]
+        return (np.full(len(rows[0]), self.carry["TRAIN"], dtype=object),) + rows
+
+    def reduce(self, trains, berths, times, entered, deltas, emitted, open_train):
+        """Turn the kept steps into edges and carry the open train's steps.
+
+        An edge is confirmed once the train is seen entering a different berth
+        after it, at the first step of that berth. Edges into the last berth of
+        a train are not confirmed yet, as the train may still report the berth
+        again, so only confirmed edges have a settled traversal time.
+
+        Args:
+            trains (np.ndarray): train of each kept step
+            berths (np.ndarray): berth of each kept step
+            times (np.ndarray): time of each kept step
+            entered (np.ndarray): time of the first step of each kept step's
+                repeats of the berth, the step's own time if it is the first
+            deltas (np.ndarray): delta of each kept step
+            emitted (np.ndarray): True if the edge into the step was handled
+            open_train (object): train that may continue in the next chunk
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray): from
+                berths, to berths, seconds taken, trains and confirmation times
+                of the edges that are now final, NaT if not confirmed
+        """
+        # Of repeated steps through the same berth only the last is kept, it
+        # takes the time the first of them entered the berth
+        first = np.ones(len(trains), dtype=bool)
+        first[1:] = (trains[1:] != trains[:-1]) | (berths[1:] != berths[:-1])
+        starts = np.maximum.accumulate(np.where(first, np.arange(len(trains)), 0))
+        entered = entered[starts]
+        last = np.ones(len(trains), dtype=bool)
+        last[:-1] = first[1:]
+        trains, berths, times = trains[last], berths[last], times[last]
+        entered, deltas, emitted = entered[last], deltas[last], emitted[last]
+
+        # Consecutive steps of a train less than delta_t hours apart are linked
+        link = np.zeros(len(trains), dtype=bool)
+        link[1:] = (trains[1:] == trains[:-1]) & (deltas[1:] < self.delta_t)
+        link &= ~emitted
+
+        # A step is confirmed when the train enters the next berth
+        confirmed = np.full(len(trains), np.datetime64("NaT"), dtype="datetime64[ms]")
+        same = trains[1:] == trains[:-1]
+        confirmed[:-1][same] = entered[1:][same]
+
+        # The open train's last step can still be replaced by a repeat of it
+        self.carry = None
+        if open_train is not None:
+            tail = np.flatnonzero(trains == open_train)[-2:]
+            link[tail[-1:]] = False
+            pending = np.zeros(len(tail), dtype=bool)
+            pending[-1:] = True
+            self.carry = {
+                "TRAIN": open_train,
+                "LAST": None,
+                "ROWS": (
+                    berths[tail],
+                    times[tail],
+                    entered[tail],
+                    deltas[tail],
+                    ~pending,
+                ),
+            }
+
+        to = np.flatnonzero(link)
+        seconds = deltas[to] / np.timedelta64(1, "s")
+        return berths[to - 1], berths[to], seconds, trains[to], confirmed[to]
+
+
+def segment_trains(steps, delta_b, delta_t, chunk_size, watermark):
+    """Segment a stream of train steps into edges, one chunk at a time.
+
+    Only the unique edges, the sketches of the new traversal times and the
+    state of one train are held across chunks. A traversal time is new once
+    its edge is confirmed after the time the train's edges were last counted
+    up to, so an edge into the last berth of a train is only counted once the
+    train moves on, and a repeat of the berth in a later run is not counted
+    again.
+
+    Args:
+        steps (iterable): TRAIN_PIPELINE documents, the steps of a train together
+        delta_b (int): Berths within delta seconds will be classed as the same
+        delta_t (int): Split train data when there is a gap of delta hours
+        chunk_size (int): Train steps read and segmented at a time
+        watermark (datetime.datetime): counted up to time of the trains without
+            one of their own, all of their edges are new if None
+    Returns:
+        np.ndarray: berth names
+        np.ndarray: (m, 2) unique edges as indices into the berth names
+        dict: (from, to) berth keys to sketches of the new traversal times
+        dict: trains with new traversal times to the time they are now
+            counted up to
+    """
+    sketches = {}
+    progress = {}
+
+    # Give each berth an integer id as it is first seen
+    index = {}
+    pairs = np.empty(0, dtype=np.int64)
+    counted = {}
+    segmenter = ChunkSegmenter(delta_b, delta_t)
+    while segmenter is not None:
+        chunk = list(itertools.islice(steps, chunk_size))
+        if chunk:
+            for step in chunk:
+                counted[step["TRAIN"]] = step.get("COUNTED", watermark)
+            b_from, b_to, seconds, trains, confirmed = segmenter.chunk(
+                [step["TRAIN"] for step in chunk],
+                [step["BERTH"] for step in chunk],
+                pd.DatetimeIndex([step["TIME"] for step in chunk]),
+            )
+        else:
+            b_from, b_to, seconds, trains, confirmed = segmenter.finish()
+            segmenter = None
+
+        # Keep each edge linking the berths once
+        names, inverse = np.unique(np.concatenate([b_from, b_to]), return_inverse=True)
+        ids = np.array(
+            [index.setdefault(name, len(index)) for name in names.tolist()],
+            dtype=np.int64,
+        )[inverse]
+        src, dst = np.split(ids, 2)
+        pairs = np.union1d(pairs, (src << 32) | dst)
+
+        # Record the confirmed traversal times we have not counted before
+        marks = np.array(
+            [counted[train] or "NaT" for train in trains.tolist()],
+            dtype="datetime64[ms]",
+        )
+        new = ~np.isnat(confirmed)
+        new[new] = np.isnat(marks[new]) | (confirmed[new] > marks[new])
+        for i in np.flatnonzero(new):
+            if (b_from[i], b_to[i]) not in sketches:
+                sketches[(b_from[i], b_to[i])] = QuantileSketch(
+                    max_value=delta_t * 3600.0
+                )
+            sketches[(b_from[i], b_to[i])].add(float(seconds[i]))
+            time = pd.Timestamp(confirmed[i]).to_pydatetime()
+            progress[trains[i]] = max(progress.get(trains[i], time), time)
+
+        # Only the last train can still have edges in the next chunk
+        if chunk:
+            counted = {chunk[-1]["TRAIN"]: counted[chunk[-1]["TRAIN"]]}
+
+    names = np.array(list(index), dtype=object)
+    edges = np.column_stack([pairs >> 32, pairs & 0xFFFFFFFF])
+    return names, edges, sketches, progress
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the static and dynamic layers of the graph page map.
+
+The positions, edges and descriptions of the berths only change when the graph
+generator publishes a new layout, so they are built once per generator run into
+a static layer. The layer is stored gzipped in the GRAPH_LAYERS collection with
+an ETag, and the dash app cuts the views of the map from it, see common.views.
+
+The occupancy of the berths changes every few seconds. The dynamic layer holds
+only the name, train, time and usage of each berth, and is small enough to send
+on every refresh. Most refreshes only need a patch of the berths whose state
+changed since the last revision of the dynamic layer, so their size scales
+with the trains that moved.
+"""
+
+import gzip
+import json
+import hashlib
+
+from bson.binary import Binary
+
+# Decimal places kept of the berth coordinates, about 10cm
+COORDINATE_PLACES = 6
+
+
+def static_text(berth):
+    """Get the part of the hover text of a berth that only changes with the layout.
+
+    Args:
+        berth (dict): BERTHS document
+    Returns:
+        str: hover text
+    """
+    name = str(berth["NAME"])
+    text = "TD area: " + name[:2] + "<br />"
+    text = text + "Berth: " + name[2:] + "<br />"
+    if berth.get("DESCRIPTION") is not None:
+        text = text + "Description: " + str(berth["DESCRIPTION"]) + "<br />"
+    text = text + "Fixed: " + str(bool(berth.get("FIXED"))) + "<br />"
+    return text
+
+
+def build_static_layer(berths):
+    """Build the static layer from the selected berths.
+
+    Args:
+        berths ([dict]): selected BERTHS documents
+    Returns:
+        dict: berth names, coordinates and hover texts, and the edges as pairs of
+            indices into the berths
+    """
+    selected = {berth["NAME"]: berth for berth in berths}
+    index = {name: i for i, name in enumerate(selected)}
+
+    def coordinate(berth, key):
+        return round(float(berth[key]), COORDINATE_PLACES)
+
+    # Each edge is kept once, whichever berth lists it
+    edges = set()
+    for berth in selected.values():
+        for edge in berth.get("EDGES", [[]])[0]:
+            if edge in selected and edge != berth["NAME"]:
+                pair = (index[berth["NAME"]], index[edge])
+                edges.add((min(pair), max(pair)))
+
+    return {
+        "NAMES": list(selected),
+        "LATITUDE": [coordinate(b, "LATITUDE") for b in selected.values()],
+        "LONGITUDE": [coordinate(b, "LONGITUDE") for b in selected.values()],
+        "TEXT": [static_text(b) for b in selected.values()],
+        "EDGES": [list(edge) for edge in sorted(edges)],
+    }
+
+
+def encode_layer(layer):
+    """Encode a layer as gzipped JSON with an ETag of its content.
+
+    Args:
+        layer (dict): layer to encode
+    Returns:
+        bytes: gzipped JSON
+        str: ETag
+    """
+    data = json.dumps(layer, separators=(",", ":")).encode("utf-8")
+    etag = hashlib.sha1(data).hexdigest()
+    return gzip.compress(data, mtime=0), etag
+
+
+def decode_layer(data):
+    """Decode a gzipped JSON layer.
+
+    Args:
+        data (bytes): gzipped JSON
+    Returns:
+        dict: layer
+    """
+    return json.loads(gzip.decompress(data))
+
+
+def publish_static_layer(mongo):
+    """Build the static layer from the selected BERTHS and store it.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+    Returns:
+        str: ETag of the layer, None if it could not be published
+    """
+    projection = ["NAME", "LATITUDE", "LONGITUDE", "DESCRIPTION", "FIXED", "EDGES"]
+    berths = mongo.get("BERTHS", {"SELECTED": True}, projection)
+    if berths is None:
+        return None
+
+    data, etag = encode_layer(build_static_layer(berths))
+    update = {"$set": {"ETAG": etag, "DATA": Binary(data)}}
+    if mongo.update("GRAPH_LAYERS", {"NAME": "STATIC"}, update) is None:
+        return None
+    return etag
+
+
+def get_static_etag(mongo):
+    """Get the ETag of the published static layer.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+    Returns:
+        str: ETag, None if no layer has been published
+    """
+    docs = mongo.get("GRAPH_LAYERS", {"NAME": "STATIC"}, ["ETAG"])
+    for doc in docs if docs is not None else []:
+        return doc["ETAG"]
+    return None
+
+
+def get_static_layer(mongo):
+    """Get the published static layer.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+    Returns:
+        bytes: gzipped JSON, None if no layer has been published
+        str: ETag
+    """
+    docs = mongo.get("GRAPH_LAYERS", {"NAME": "STATIC"})
+    for doc in docs if docs is not None else []:
+        return bytes(doc["DATA"]), doc["ETAG"]
+    return None, None
+
+
+def build_dynamic_layer(berths, usage, etag):
+    """Build the dynamic layer of the selected berths.
+
+    Args:
+        berths ([dict]): selected BERTHS documents with the latest train and time
+        usage (dict): step counts over the last hour keyed by berth
+        etag (str): ETag of the static layer
+    Returns:
+        dict: berth names with their train, time and usage arrays
+    """
+    names = [berth["NAME"] for berth in berths]
+    return {
+        "ETAG": etag,
+        "NAMES": names,
+        "TRAINS": [berth.get("LATEST_TRAIN", "0000") for berth in berths],
+        "TIMES": [str(berth.get("LATEST_TIME")) for berth in berths],
+        "USAGE": [usage.get(name, 0) for name in names],
+    }
+
+
+# Dynamic layer arrays holding the state of each berth
+DYNAMIC_FIELDS = ["NAMES", "TRAINS", "TIMES", "USAGE"]
+
+
+def diff_dynamic_layers(old, new):
+    """Get the patch from one dynamic layer to the next.
+
+    Args:
+        old (dict): previous dynamic layer
+        new (dict): next dynamic layer
+    Returns:
+        dict: names of the berths whose state changed and their new states
+    """
+    old_states = set(zip(*[old[field] for field in DYNAMIC_FIELDS]))
+    changed = [
+        i
+        for i, state in enumerate(zip(*[new[field] for field in DYNAMIC_FIELDS]))
+        if state not in old_states
+    ]
+    return {field: [new[field][i] for i in changed] for field in DYNAMIC_FIELDS}
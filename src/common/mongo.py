@@ -8,24 +8,26 @@ from pymongo import MongoClient
 class Mongo(object):
     """Class to handle MongoDB data flow."""
 
-    def __init__(self, log, client):
+    def __init__(self, log, client, uri=None):
         """Initialise Mongo.
 
         Args:
             log (logging.logger): logger to use
             client (pymongo.MongoClient): pymongo client
+            uri (str): connection URI, so other processes can connect themselves
         """
         self.log = log  # We take the logger from the application
         self.client = client  # Mongo database
+        self.uri = uri
 
     @classmethod
-    def connect(cls, log, uri):
+    def connect(cls, log, uri, database="thetrains"):
         """Connect to database, return None if not possible."""
         try:
             client = MongoClient(uri)
-            client = client.thetrains  # Using thetrains database
+            client = client[database]  # Using thetrains database by default
             log.info("Connected to mongo at {}".format(uri))
-            return cls(log, client)
+            return cls(log, client, uri)
         except Exception:
             log.warning("Mongo connection error: {}".format(uri))
             return None
@@ -50,6 +52,19 @@ class Mongo(object):
         except Exception as e:
             self.log.warning("Mongo drop error ({})".format(e))
 
+    def create_index(self, collection, keys, **kwargs):
+        """Create an index on a collection if it does not already exist.
+
+        Args:
+            collection (str): collection name
+            keys ([(str, int)]): index keys and directions
+            **kwargs: index options passed to pymongo
+        """
+        try:
+            self.client[collection].create_index(keys, **kwargs)
+        except Exception as e:
+            self.log.warning("Mongo index error ({})".format(e))
+
     def add(self, collection, doc):
         """Add a document to a collection.
 
@@ -62,30 +77,121 @@ class Mongo(object):
         except Exception as e:
             self.log.warning("Mongo add error ({})".format(e))
 
-    def update(self, collection, selection, update, many=False):
+    def add_many(self, collection, docs):
+        """Add many documents to a collection.
+
+        Args:
+            collection (str): collection name
+            docs ([dict]): documents in dict format
+        """
+        try:
+            self.client[collection].insert_many(docs)
+        except Exception as e:
+            self.log.warning("Mongo add error ({})".format(e))
+
+    def update(self, collection, selection, update, many=False, upsert=True):
         """Update document in collection by selection.
 
         Args:
             collection (str): collection name
             selection (dict): document selection
             update (dict): document update
+            many (bool): update all matching documents
+            upsert (bool): insert a document if none match
+        Returns:
+            pymongo.results.UpdateResult: update result, None on error
         """
         try:
             if many:
-                self.client[collection].update_many(selection, update, upsert=True)
+                return self.client[collection].update_many(
+                    selection, update, upsert=upsert
+                )
             else:
-                self.client[collection].update_one(selection, update, upsert=True)
+                return self.client[collection].update_one(
+                    selection, update, upsert=upsert
+                )
         except Exception as e:
             self.log.warning("Mongo update error ({})".format(e))
+            return None
 
-    def get(self, collection):
-        """Get all documents from a collection.
+    def delete(self, collection, selection, many=False):
+        """Delete documents from a collection by selection.
 
         Args:
             collection (str): collection name
+            selection (dict): document selection
+            many (bool): delete all matching documents
+        Returns:
+            pymongo.results.DeleteResult: delete result, None on error
         """
         try:
-            return self.client[collection].find()
+            if many:
+                return self.client[collection].delete_many(selection)
+            else:
+                return self.client[collection].delete_one(selection)
+        except Exception as e:
+            self.log.warning("Mongo delete error ({})".format(e))
+            return None
+
+    def get(self, collection, selection=None, projection=None, sort=None):
+        """Get documents from a collection.
+
+        Args:
+            collection (str): collection name
+            selection (dict): document selection, all documents if None
+            projection (dict): fields to return, all fields if None
+            sort ([(str, int)]): sort keys and directions, natural order if None
+        """
+        try:
+            return self.client[collection].find(selection, projection, sort=sort)
         except Exception as e:
             self.log.warning("Mongo get error ({})".format(e))
             return None
+
+    def aggregate(self, collection, pipeline, batch_size=None):
+        """Run an aggregation pipeline on a collection.
+
+        Args:
+            collection (str): collection name
+            pipeline ([dict]): aggregation pipeline stages
+            batch_size (int): documents fetched per round trip, server default if None
+        """
+        kwargs = {"batchSize": batch_size} if batch_size else {}
+        try:
+            return self.client[collection].aggregate(
+                pipeline, allowDiskUse=True, **kwargs
+            )
+        except Exception as e:
+            self.log.warning("Mongo aggregate error ({})".format(e))
+            return None
+
+    def watch(self, collection, pipeline=None, **kwargs):
+        """Open a change stream on a collection.
+
+        Change streams are only available on replica sets and sharded clusters.
+
+        Args:
+            collection (str): collection name
+            pipeline ([dict]): aggregation pipeline stages filtering the changes
+            **kwargs: change stream options passed to pymongo
+        """
+        try:
+            return self.client[collection].watch(pipeline, **kwargs)
+        except Exception as e:
+            self.log.warning("Mongo watch error ({})".format(e))
+            return None
+
+    def supports_change_streams(self):
+        """Check if the server supports change streams.
+
+        Change streams are only available on replica sets and sharded clusters.
+
+        Returns:
+            bool: True if change streams are supported, None on error
+        """
+        try:
+            hello = self.client.command("isMaster")
+        except Exception as e:
+            self.log.warning("Mongo server status error ({})".format(e))
+            return None
+        return "setName" in hello or hello.get("msg") == "isdbgrid"
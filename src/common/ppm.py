@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the rollups of the public performance measure (PPM) messages.
+
+The collector stores one raw PPM document per RTPPM message. Charts over long
+ranges read rollups instead, one document per minute, hour or day in the
+PPM_MINUTE, PPM_HOUR and PPM_DAY collections. Each rollup holds the number of
+messages in its bucket and the sum, minimum and maximum of every PPM field, so
+it is updated incrementally with a single upsert as each message is stored,
+and the mean of a field is its sum over the count.
+
+A rollup collection that does not exist yet is backfilled from the raw PPM.
+
+Charts read the finest rollup with at most READ_FACTOR buckets for each point
+they plot, and downsample it to the points, so the peaks within the buckets of
+a coarser rollup are not averaged away.
+"""
+
+import datetime
+
+# Numeric fields of the PPM documents that are rolled up
+PPM_FIELDS = ["total", "on_time", "late", "ppm", "rolling_ppm"]
+
+# Rollup resolutions, their collections and bucket lengths
+RESOLUTIONS = [
+    ("minute", "PPM_MINUTE", datetime.timedelta(minutes=1)),
+    ("hour", "PPM_HOUR", datetime.timedelta(hours=1)),
+    ("day", "PPM_DAY", datetime.timedelta(days=1)),
+]
+
+# Rollup buckets read for each point plotted
+READ_FACTOR = 10
+
+
+def bucket(date, unit):
+    """Get the start of the bucket a PPM message falls in.
+
+    Args:
+        date (datetime.datetime): message time
+        unit (str): bucket unit, minute, hour or day
+    Returns:
+        datetime.datetime: start of the bucket
+    """
+    date = date.replace(second=0, microsecond=0)
+    if unit in ["hour", "day"]:
+        date = date.replace(minute=0)
+    if unit == "day":
+        date = date.replace(hour=0)
+    return date
+
+
+def rollup_update(doc):
+    """Get the update adding a PPM message to its rollups.
+
+    Args:
+        doc (dict): PPM document
+    Returns:
+        dict: rollup update
+    """
+    inc = {f + "_sum": doc[f] for f in PPM_FIELDS}
+    inc["count"] = 1
+    return {
+        "$inc": inc,
+        "$min": {f + "_min": doc[f] for f in PPM_FIELDS},
+        "$max": {f + "_max": doc[f] for f in PPM_FIELDS},
+    }
+
+
+def add_rollups(mongo, doc):
+    """Add a PPM message to the rollup of each resolution.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+        doc (dict): PPM document
+    """
+    update = rollup_update(doc)
+    for unit, collection, _ in RESOLUTIONS:
+        mongo.update(collection, {"date": bucket(doc["date"], unit)}, update)
+
+
+def backfill_pipeline(unit, collection):
+    """Get the pipeline rolling up the raw PPM at a resolution.
+
+    Args:
+        unit (str): bucket unit, minute, hour or day
+        collection (str): rollup collection
+    Returns:
+        [dict]: aggregation pipeline stages
+    """
+    group = {
+        "_id": {"$dateTrunc": {"date": "$date", "unit": unit}},
+        "count": {"$sum": 1},
+    }
+    for field in PPM_FIELDS:
+        group[field + "_sum"] = {"$sum": "$" + field}
+        group[field + "_min"] = {"$min": "$" + field}
+        group[field + "_max"] = {"$max": "$" + field}
+    return [
+        {"$group": group},
+        {"$set": {"date": "$_id"}},
+        {"$unset": "_id"},
+        {
+            "$merge": {
+                "into": collection,
+                "on": "date",
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
+
+def backfill_rollups(mongo):
+    """Create any missing rollup collections from the raw PPM.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+    Returns:
+        [str]: rollup collections backfilled
+    """
+    collections = mongo.collections()
+    if collections is None:
+        return []
+
+    backfilled = []
+    for unit, collection, _ in RESOLUTIONS:
+        if collection in collections:
+            continue
+        mongo.create_index(collection, [("date", 1)], unique=True)
+        if mongo.aggregate("PPM", backfill_pipeline(unit, collection)) is not None:
+            backfilled.append(collection)
+    return backfilled
+
+
+def choose_resolution(start, end, max_rows):
+    """Choose the finest rollup with at most a number of buckets in a range.
+
+    Args:
+        start (datetime.datetime): start of the range
+        end (datetime.datetime): end of the range
+        max_rows (int): most buckets to read
+    Returns:
+        str: bucket unit
+        str: rollup collection, the daily rollup if none are fine enough
+    """
+    for unit, collection, length in RESOLUTIONS:
+        if (end - start) / length <= max_rows:
+            return unit, collection
+    return RESOLUTIONS[-1][:2]
+
+
+def rollup_means(docs):
+    """Get the mean of each PPM field from rollup documents.
+
+    Args:
+        docs ([dict]): rollup documents
+    Returns:
+        [dict]: PPM documents of the bucket dates and field means
+    """
+    means = []
+    for doc in docs:
+        mean = {"date": doc["date"]}
+        for field in PPM_FIELDS:
+            mean[field] = doc[field + "_sum"] / doc["count"]
+        means.append(mean)
+    return means
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the occupancy frames of the replay page.
+
+Replaying a past day of movements on the map needs the occupancy of every
+berth at any minute, which would take a scan of the TRAINS for each frame. The
+generator instead replays the berth steps once into the REPLAY_FRAMES
+collection, one document per minute holding the occupancy changes within it,
+and every quarter of an hour a keyframe of the full occupancy at the start of
+the minute. The occupancy at any time is then the last keyframe before it with
+the changes since, so a window of the replay is a single range read.
+
+Steps are replayed as the live BERTHS are updated. A train leaves its berth
+when it steps into the next one or when another train enters the berth, and
+is cleared once it has not moved for the time after which the generator
+cleans stale berths. Only the changes of real berths are stored, but the steps
+through pseudo berths still move the trains out of the real ones.
+
+Frames are built up to the last whole minute, starting from the minute after
+the frames built by the previous run, and expire after a week. The first run
+starts at a keyframe, so every window of frames built has one to start from. A
+window whose keyframe is missing starts from the next keyframe instead.
+"""
+
+import heapq
+import datetime
+
+from common.berths import BerthClass, classify
+
+FRAME_LENGTH = datetime.timedelta(minutes=1)
+KEYFRAME_MINUTES = 15
+
+# Time a train is kept in a berth without moving, see GraphGenerator.clean_berths
+OCCUPANCY_HOLD = datetime.timedelta(hours=2)
+
+# Frames built on the first run, and how long they are kept
+REPLAY_BACKFILL = datetime.timedelta(days=1)
+REPLAY_TTL = datetime.timedelta(days=7)
+
+# Longest window of frames read at once
+MAX_WINDOW = datetime.timedelta(hours=3)
+
+
+def frame_start(time):
+    """Get the start of the frame a time falls in.
+
+    Args:
+        time (datetime.datetime): time
+    Returns:
+        datetime.datetime: start of the minute
+    """
+    return time.replace(second=0, microsecond=0)
+
+
+def keyframe_start(time):
+    """Get the start of the last keyframe at or before a time.
+
+    Args:
+        time (datetime.datetime): time
+    Returns:
+        datetime.datetime: start of the keyframe minute
+    """
+    time = frame_start(time)
+    return time.replace(minute=time.minute - time.minute % KEYFRAME_MINUTES)
+
+
+def create_indexes(mongo):
+    """Create the unique minute index of the frames, which also expires them.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+    """
+    ttl = int(REPLAY_TTL.total_seconds())
+    mongo.create_index(
+        "REPLAY_FRAMES", [("MINUTE", 1)], unique=True, expireAfterSeconds=ttl
+    )
+
+
+def steps_pipeline(since, end):
+    """Get the pipeline streaming the stored TRAINS steps within a time range.
+
+    Args:
+        since (datetime.datetime): time of the oldest step
+        end (datetime.datetime): time after the newest step
+    Returns:
+        [dict]: aggregation pipeline stages
+    """
+    within = {"$gte": since, "$lt": end}
+    return [
+        {"$match": {"TIMES": {"$elemMatch": within}}},
+        {
+            "$project": {
+                "_id": 0,
+                "TRAIN": "$NAME",
+                "STEPS": {"$zip": {"inputs": ["$BERTHS", "$TIMES"]}},
+            }
+        },
+        {"$unwind": "$STEPS"},
+        {
+            "$project": {
+                "TRAIN": 1,
+                "BERTH": {"$arrayElemAt": ["$STEPS", 0]},
+                "TIME": {"$arrayElemAt": ["$STEPS", 1]},
+            }
+        },
+        {"$match": {"TIME": within}},
+    ]
+
+
+def occupancy_changes(steps):
+    """Replay berth steps into the changes of the berth occupancy.
+
+    Args:
+        steps ([(datetime.datetime, str, str)]): time, train and berth of each
+            step, in time order
+    Returns:
+        [(datetime.datetime, str, str)]: time, berth and train of each change,
+            in time order, the train is "0000" when the berth is cleared
+    """
+    occupancy = {}
+    positions = {}
+    holds = []
+    changes = []
+
+    def clear(time, berth, train):
+        if occupancy.get(berth) is not None and occupancy[berth][0] == train:
+            del occupancy[berth]
+            changes.append((time, berth, "0000"))
+
+    for time, train, berth in steps:
+        # Clear the trains that have not moved for the hold time
+        while holds and holds[0][0] <= time:
+            expiry, entered, hold_berth, hold_train = heapq.heappop(holds)
+            if occupancy.get(hold_berth) == (hold_train, entered):
+                clear(expiry, hold_berth, hold_train)
+
+        # The train leaves its last berth and replaces any train in the next
+        last = positions.get(train)
+        if last is not None and last != berth:
+            clear(time, last, train)
+        positions[train] = berth
+        if occupancy.get(berth, (None,))[0] != train:
+            changes.append((time, berth, train))
+        occupancy[berth] = (train, time)
+        heapq.heappush(holds, (time + OCCUPANCY_HOLD, time, berth, train))
+
+    # Clear the trains whose hold ends after the last step
+    while holds:
+        expiry, entered, hold_berth, hold_train = heapq.heappop(holds)
+        if occupancy.get(hold_berth) == (hold_train, entered):
+            clear(expiry, hold_berth, hold_train)
+    return changes
+
+
+def build_frames(steps, start, end):
+    """Build the frames of a range of minutes from the berth steps.
+
+    Args:
+        steps ([(datetime.datetime, str, str)]): time, train and berth of each
+            step from at least the hold time before the start, in time order
+        start (datetime.datetime): start of the first frame
+        end (datetime.datetime): end of the last frame
+    Returns:
+        [dict]: REPLAY_FRAMES documents of the minutes with changes or keyframes
+    """
+    real = {}
+
+    def is_real(berth):
+        if berth not in real:
+            real[berth] = classify(berth) == BerthClass.REAL
+        return real[berth]
+
+    changes = [c for c in occupancy_changes(steps) if c[0] < end and is_real(c[1])]
+
+    # Apply the changes before the start to get the occupancy at the start
+    occupancy = {}
+    i = 0
+    while i < len(changes) and changes[i][0] < start:
+        _, berth, train = changes[i]
+        occupancy[berth] = train
+        i += 1
+
+    frames = []
+    minute = start
+    while minute < end:
+        frame = {"MINUTE": minute, "OFFSETS": [], "NAMES": [], "TRAINS": []}
+        if minute == keyframe_start(minute):
+            occupied = sorted(b for b, t in occupancy.items() if t != "0000")
+            frame["KEYFRAME"] = {
+                "NAMES": occupied,
+                "TRAINS": [occupancy[berth] for berth in occupied],
+            }
+        while i < len(changes) and changes[i][0] < minute + FRAME_LENGTH:
+            time, berth, train = changes[i]
+            occupancy[berth] = train
+            offset = (time - minute) // datetime.timedelta(milliseconds=1)
+            frame["OFFSETS"].append(offset)
+            frame["NAMES"].append(berth)
+            frame["TRAINS"].append(train)
+            i += 1
+        if frame["NAMES"] or "KEYFRAME" in frame:
+            frames.append(frame)
+        minute += FRAME_LENGTH
+    return frames
+
+
+def update_frames(mongo, since, now):
+    """Build and store the frames from a minute up to the last whole minute.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+        since (datetime.datetime): start of the first frame to build, the
+            backfill window before now if None
+        now (datetime.datetime): current time
+    Returns:
+        datetime.datetime: end of the last frame built, None on failure
+    """
+    end = frame_start(now)
+    if since is None:
+        start = keyframe_start(end - REPLAY_BACKFILL)
+    elif since < end - REPLAY_TTL:
+        start = keyframe_start(end - REPLAY_TTL)
+    else:
+        start = since
+    if start >= end:
+        return end
+
+    # Replay from the hold time before the start to get the occupancy there
+    docs = mongo.aggregate("TRAINS", steps_pipeline(start - OCCUPANCY_HOLD, end))
+    if docs is None:
+        return None
+    steps = sorted(
+        ((doc["TIME"], doc["TRAIN"], doc["BERTH"]) for doc in docs),
+        key=lambda step: step[0],
+    )
+
+    for frame in build_frames(steps, start, end):
+        selection = {"MINUTE": frame["MINUTE"]}
+        if mongo.update("REPLAY_FRAMES", selection, {"$set": frame}) is None:
+            return None
+    return end
+
+
+def get_window(mongo, start, end):
+    """Get the keyframe and changes needed to replay a window.
+
+    The window starts from the next keyframe within it if the keyframe before
+    the start is missing, such as before the first frames built.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+        start (datetime.datetime): start of the window
+        end (datetime.datetime): end of the window
+    Returns:
+        dict: occupancy at the keyframe, and the offset in milliseconds from
+            the keyframe, berth and train of each change until the end, None
+            if not available or no keyframe is within the window
+    """
+    selection = {"MINUTE": {"$gte": keyframe_start(start), "$lt": end}}
+    docs = mongo.get("REPLAY_FRAMES", selection, sort=[("MINUTE", 1)])
+    if docs is None:
+        return None
+
+    keyframe = None
+    window = {"START": str(start), "END": str(end)}
+    for doc in docs:
+        if keyframe is None:
+            # Skip the changes before the first keyframe
+            if "KEYFRAME" not in doc:
+                continue
+            keyframe = doc["MINUTE"]
+            window.update(
+                {
+                    "KEYFRAME": str(keyframe),
+                    "OCCUPANCY": doc["KEYFRAME"],
+                    "OFFSETS": [],
+                    "NAMES": [],
+                    "TRAINS": [],
+                }
+            )
+        base = (doc["MINUTE"] - keyframe) // datetime.timedelta(milliseconds=1)
+        window["OFFSETS"].extend(base + offset for offset in doc["OFFSETS"])
+        window["NAMES"].extend(doc["NAMES"])
+        window["TRAINS"].extend(doc["TRAINS"])
+    return window if keyframe is not None else None
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+"""Module providing a mergeable quantile sketch for streaming statistics.
+
+Values are counted into logarithmically sized bins, so any quantile can be
+estimated to within a fixed relative accuracy. Values are clamped to a fixed
+range which bounds the number of bins, and therefore the memory, per sketch.
+Sketches merge by adding their bin counts, which means they can also be merged
+inside the database with a single $inc update.
+"""
+
+import math
+
+
+class QuantileSketch(object):
+    """Log binned quantile sketch with a fixed relative accuracy."""
+
+    def __init__(self, accuracy=0.02, min_value=1.0, max_value=86400.0):
+        """Initialise QuantileSketch.
+
+        Args:
+            accuracy (float): relative accuracy of the quantile estimates
+            min_value (float): values below this are counted as this value
+            max_value (float): values above this are counted as this value
+        """
+        self.accuracy = accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.count = 0
+        self.total = 0.0
+
+    @classmethod
+    def from_doc(cls, doc, **kwargs):
+        """Create a sketch from a stored document.
+
+        Args:
+            doc (dict): document with "COUNT", "SUM" and "BINS" fields
+        Returns:
+            QuantileSketch: sketch holding the document counts
+        """
+        sketch = cls(**kwargs)
+        sketch.count = doc.get("COUNT", 0)
+        sketch.total = doc.get("SUM", 0.0)
+        sketch.bins = {int(i): n for i, n in doc.get("BINS", {}).items()}
+        return sketch
+
+    def to_doc(self):
+        """Get the sketch as a document to store.
+
+        Returns:
+            dict: document with "COUNT", "SUM" and "BINS" fields
+        """
+        bins = {str(i): n for i, n in self.bins.items()}
+        return {"COUNT": self.count, "SUM": self.total, "BINS": bins}
+
+    def to_inc(self):
+        """Get the $inc update to merge this sketch into a stored document.
+
+        Returns:
+            dict: $inc update fields
+        """
+        inc = {"COUNT": self.count, "SUM": self.total}
+        for i, n in self.bins.items():
+            inc["BINS.{}".format(i)] = n
+        return inc
+
+    def index(self, value):
+        """Get the bin index for a value.
+
+        Args:
+            value (float): value to bin
+        Returns:
+            int: bin index
+        """
+        value = min(max(value, self.min_value), self.max_value)
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def add(self, value, count=1):
+        """Add a value to the sketch.
+
+        Args:
+            value (float): value to add
+            count (int): number of times to add the value
+        """
+        i = self.index(value)
+        self.bins[i] = self.bins.get(i, 0) + count
+        self.count += count
+        self.total += value * count
+
+    def merge(self, other):
+        """Merge another sketch into this one.
+
+        Args:
+            other (QuantileSketch): sketch with the same accuracy to merge
+        """
+        if other.accuracy != self.accuracy:
+            raise ValueError("Can't merge sketches with different accuracy")
+        for i, n in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self):
+        """Get the exact mean of the added values.
+
+        Returns:
+            float: mean value, None if the sketch is empty
+        """
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def quantile(self, q):
+        """Estimate a quantile of the added values.
+
+        Args:
+            q (float): quantile between 0 and 1
+        Returns:
+            float: quantile estimate, None if the sketch is empty
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if seen > rank:
+                break
+        return 2 * math.pow(self.gamma, i) / (self.gamma + 1)
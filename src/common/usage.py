@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the rolling per-berth usage counters shown on the graph page.
+
+Rather than scanning the full TRAINS history on every refresh, the collector
+counts the steps into each berth in one minute buckets in the BERTH_USAGE
+collection, incrementing the bucket of every step once per message frame. The
+usage of a berth over the last hour is then the sum of its last sixty buckets,
+so reading it costs the same however long the history is. Old buckets are
+removed by a TTL index.
+
+When the collection is first created it is backfilled from the steps of the
+last hour already stored in the TRAINS.
+"""
+
+import datetime
+
+# Window the usage is counted over and the TTL of the buckets
+USAGE_WINDOW = datetime.timedelta(hours=1)
+USAGE_TTL = 2 * USAGE_WINDOW
+
+
+def bucket(time):
+    """Get the one minute bucket a step time falls in.
+
+    Args:
+        time (datetime.datetime): step time
+    Returns:
+        datetime.datetime: start of the minute
+    """
+    return time.replace(second=0, microsecond=0)
+
+
+def count_steps(steps):
+    """Count the steps into each berth in each minute bucket.
+
+    Args:
+        steps ([(str, datetime.datetime)]): berth and time of each step
+    Returns:
+        dict: step counts keyed by berth and minute
+    """
+    counts = {}
+    for berth, time in steps:
+        key = (berth, bucket(time))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def create_indexes(mongo):
+    """Create the unique bucket and TTL indexes of the usage counters.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+    """
+    ttl = int(USAGE_TTL.total_seconds())
+    mongo.create_index("BERTH_USAGE", [("NAME", 1), ("MINUTE", 1)], unique=True)
+    mongo.create_index("BERTH_USAGE", [("MINUTE", 1)], expireAfterSeconds=ttl)
+
+
+def add_usage(mongo, counts):
+    """Increment the usage counters.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+        counts (dict): step counts keyed by berth and minute, see count_steps
+    """
+    for (berth, minute), count in counts.items():
+        update = {"$inc": {"COUNT": count}}
+        mongo.update("BERTH_USAGE", {"NAME": berth, "MINUTE": minute}, update)
+
+
+def backfill_pipeline(since):
+    """Get the pipeline counting the stored TRAINS steps into usage buckets.
+
+    Args:
+        since (datetime.datetime): time of the oldest step to count
+    Returns:
+        [dict]: aggregation pipeline stages
+    """
+    return [
+        {"$match": {"TIMES": {"$elemMatch": {"$gte": since}}}},
+        {"$project": {"_id": 0, "STEPS": {"$zip": {"inputs": ["$BERTHS", "$TIMES"]}}}},
+        {"$unwind": "$STEPS"},
+        {
+            "$project": {
+                "BERTH": {"$arrayElemAt": ["$STEPS", 0]},
+                "TIME": {"$arrayElemAt": ["$STEPS", 1]},
+            }
+        },
+        {"$match": {"TIME": {"$gte": since}}},
+        {
+            "$group": {
+                "_id": {
+                    "NAME": "$BERTH",
+                    "MINUTE": {"$dateTrunc": {"date": "$TIME", "unit": "minute"}},
+                },
+                "COUNT": {"$sum": 1},
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "NAME": "$_id.NAME",
+                "MINUTE": "$_id.MINUTE",
+                "COUNT": 1,
+            }
+        },
+        {
+            "$merge": {
+                "into": "BERTH_USAGE",
+                "on": ["NAME", "MINUTE"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+
+
+def backfill_usage(mongo, now):
+    """Create the usage counters from the TRAINS if they do not exist yet.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+        now (datetime.datetime): current time
+    Returns:
+        bool: True if the counters were backfilled
+    """
+    collections = mongo.collections()
+    if collections is None or "BERTH_USAGE" in collections:
+        return False
+    create_indexes(mongo)
+    pipeline = backfill_pipeline(bucket(now - USAGE_WINDOW))
+    return mongo.aggregate("TRAINS", pipeline) is not None
+
+
+def usage_pipeline(since):
+    """Get the pipeline summing the usage buckets of each berth.
+
+    Args:
+        since (datetime.datetime): start of the oldest bucket to sum
+    Returns:
+        [dict]: aggregation pipeline stages
+    """
+    return [
+        {"$match": {"MINUTE": {"$gte": since}}},
+        {"$group": {"_id": "$NAME", "COUNT": {"$sum": "$COUNT"}}},
+    ]
+
+
+def get_usage(mongo, now):
+    """Get the number of steps into each berth over the last hour.
+
+    The window is rounded to whole minutes, so it is up to a minute longer.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+        now (datetime.datetime): current time
+    Returns:
+        dict: step counts keyed by berth, None if not available
+    """
+    docs = mongo.aggregate("BERTH_USAGE", usage_pipeline(bucket(now - USAGE_WINDOW)))
+    if docs is None:
+        return None
+    return {doc["_id"]: doc["COUNT"] for doc in docs}
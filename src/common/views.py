@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the zoom dependent views of the graph page map.
+
+Rather than every berth and edge, the browser is sent a view of the static
+layer for the map bounds and zoom it shows. Zoomed in, the view holds the
+berths within the bounds together with their neighbours, so edges leaving the
+bounds are still drawn. Zoomed out, the berths are clustered on a grid of
+square cells a fixed number of pixels across on the Web Mercator map, each
+cluster drawn at the mean position of its berths, so the number of markers
+stays bounded however many TD areas are collected.
+
+Each static layer is indexed once by a LayerIndex, which sorts the berths by a
+coarse grid so the berths within the bounds are found without a scan, keeps
+the edges of each berth, and builds the clustering of each zoom the first time
+it is asked for. A view then only costs as much as the berths or clusters in
+it.
+
+A view lists the berth names behind each of its markers, so the browser can
+colour and size a marker from the occupancy and usage of all its berths.
+"""
+
+import math
+
+import numpy as np
+
+# Zoom from which single berths are drawn rather than clusters
+DETAIL_ZOOM = 11
+
+# Width of the cluster cells in pixels, of the 256 pixel map tiles
+CLUSTER_PIXELS = 24
+TILE_PIXELS = 256
+
+# Size of the grid cells the berths are indexed by, and the cells in a row
+GRID_DEGREES = 0.25
+GRID_COLUMNS = int(360 / GRID_DEGREES) + 1
+
+# Typical map size in pixels, used to fit the initial view
+MAP_WIDTH = 1500
+MAP_HEIGHT = 1000
+
+
+def mercator_y(lat):
+    """Get the Web Mercator y coordinate of latitudes, in degrees of longitude.
+
+    Args:
+        lat (np.ndarray): latitudes in degrees
+    Returns:
+        np.ndarray: y coordinates
+    """
+    return np.degrees(np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)))
+
+
+def cell_size(zoom):
+    """Get the width of the cluster cells at a zoom.
+
+    Args:
+        zoom (int): map zoom
+    Returns:
+        float: cell width in degrees of longitude
+    """
+    return 360.0 / (2**zoom) * CLUSTER_PIXELS / TILE_PIXELS
+
+
+def in_bounds(lat, lon, bounds):
+    """Check which points are within map bounds.
+
+    Args:
+        lat (np.ndarray): latitudes in degrees
+        lon (np.ndarray): longitudes in degrees
+        bounds ((float, float, float, float)): west, south, east and north
+    Returns:
+        np.ndarray: True for the points within the bounds
+    """
+    west, south, east, north = bounds
+    return (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+
+
+def clip_bounds(bounds):
+    """Clip map bounds to the globe.
+
+    Args:
+        bounds ((float, float, float, float)): west, south, east and north
+    Returns:
+        (float, float, float, float): bounds within the longitudes and
+            latitudes of the globe, None if any bound is not finite
+    """
+    if not all(math.isfinite(v) for v in bounds):
+        return None
+    west, south, east, north = bounds
+    return (
+        min(max(west, -180.0), 180.0),
+        min(max(south, -90.0), 90.0),
+        min(max(east, -180.0), 180.0),
+        min(max(north, -90.0), 90.0),
+    )
+
+
+def build_view(layer, groups, lat, lon, text, edges):
+    """Build a view from its markers and the edges between them.
+
+    Args:
+        layer (dict): static layer
+        groups ([[int]]): indices of the static layer berths behind each marker
+        lat (np.ndarray): marker latitudes
+        lon (np.ndarray): marker longitudes
+        text ([str]): marker hover texts
+        edges (np.ndarray): (m, 2) edges as indices into the markers
+    Returns:
+        dict: marker berth names, coordinates and hover texts, and the edges
+    """
+    names = layer["NAMES"]
+    return {
+        "GROUPS": [[names[i] for i in group] for group in groups],
+        "LATITUDE": np.round(lat, 6).tolist(),
+        "LONGITUDE": np.round(lon, 6).tolist(),
+        "TEXT": text,
+        "EDGES": edges.tolist(),
+    }
+
+
+class LayerIndex(object):
+    """Spatial index and per zoom clusterings of one static layer."""
+
+    def __init__(self, layer):
+        """Initialise LayerIndex.
+
+        Args:
+            layer (dict): static layer
+        """
+        self.layer = layer
+        self.lat = np.asarray(layer["LATITUDE"], dtype=np.float64)
+        self.lon = np.asarray(layer["LONGITUDE"], dtype=np.float64)
+        self.edges = np.array(layer["EDGES"], dtype=np.int64).reshape(-1, 2)
+        self.clusterings = {}
+
+        # Sort the berths by their grid cell, row by row
+        rows = np.floor((self.lat + 90.0) / GRID_DEGREES).astype(np.int64)
+        cols = np.floor((self.lon + 180.0) / GRID_DEGREES).astype(np.int64)
+        keys = rows * GRID_COLUMNS + cols
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+        # The edges of each berth, as CSR pointers into the edge ids
+        ends = self.edges.ravel()
+        self.edge_order = np.argsort(ends, kind="stable") // 2
+        self.edge_ptr = np.zeros(len(self.lat) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(ends, minlength=len(self.lat)), out=self.edge_ptr[1:])
+
+    def within(self, bounds):
+        """Get the berths within map bounds from the grid cells they cover.
+
+        Args:
+            bounds ((float, float, float, float)): west, south, east and north
+        Returns:
+            np.ndarray: sorted indices of the berths within the bounds
+        """
+        bounds = clip_bounds(bounds)
+        if bounds is None:
+            return np.empty(0, dtype=np.int64)
+        west, south, east, north = bounds
+        row_0, row_1 = (int((v + 90.0) // GRID_DEGREES) for v in (south, north))
+        col_0, col_1 = (int((v + 180.0) // GRID_DEGREES) for v in (west, east))
+        starts = np.arange(row_0, row_1 + 1, dtype=np.int64) * GRID_COLUMNS
+        lo = np.searchsorted(self.keys, starts + col_0, side="left")
+        hi = np.searchsorted(self.keys, starts + col_1, side="right")
+        found = [self.order[a:b] for a, b in zip(lo.tolist(), hi.tolist()) if b > a]
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        found = np.sort(np.concatenate(found))
+        return found[in_bounds(self.lat[found], self.lon[found], bounds)]
+
+    def incident(self, nodes):
+        """Get the edges of a set of berths.
+
+        Args:
+            nodes (np.ndarray): berth indices
+        Returns:
+            np.ndarray: unique edge ids
+        """
+        starts = self.edge_ptr[nodes]
+        counts = self.edge_ptr[nodes + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return np.unique(self.edge_order[offsets + np.arange(int(counts.sum()))])
+
+    def detail_view(self, bounds):
+        """Get the view of single berths within the map bounds.
+
+        Args:
+            bounds ((float, float, float, float)): west, south, east and north
+        Returns:
+            dict: view of the berths and their neighbours
+        """
+        # Keep the edges touching the bounds and both of their berths
+        inside = self.within(bounds)
+        edges = self.edges[self.incident(inside)]
+        nodes = np.union1d(inside, edges.ravel())
+        text = [self.layer["TEXT"][i] for i in nodes.tolist()]
+        groups = [[i] for i in nodes.tolist()]
+        return build_view(
+            self.layer,
+            groups,
+            self.lat[nodes],
+            self.lon[nodes],
+            text,
+            np.searchsorted(nodes, edges),
+        )
+
+    def clustering(self, zoom):
+        """Get the clusters of the berths on the grid of a zoom, built once.
+
+        Args:
+            zoom (int): map zoom
+        Returns:
+            dict: cluster coordinates, berths, hover texts and joined pairs
+        """
+        if zoom in self.clusterings:
+            return self.clusterings[zoom]
+
+        # Give every berth the cluster of its grid cell
+        size = cell_size(zoom)
+        cells = np.stack(
+            [np.floor(self.lon / size), np.floor(mercator_y(self.lat) / size)], axis=1
+        ).astype(np.int64)
+        _, cluster = np.unique(cells, axis=0, return_inverse=True)
+        cluster = cluster.ravel()
+        count = np.bincount(cluster)
+
+        # Join the clusters whose berths are joined, keeping each pair once
+        pairs = np.sort(cluster[self.edges], axis=1)
+        pairs = np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0).reshape(-1, 2)
+
+        order = np.argsort(cluster, kind="stable")
+        groups = [m.tolist() for m in np.split(order, np.cumsum(count)[:-1])]
+        clusters = {
+            "LATITUDE": np.bincount(cluster, weights=self.lat) / count,
+            "LONGITUDE": np.bincount(cluster, weights=self.lon) / count,
+            "GROUPS": groups,
+            "TEXT": [
+                (
+                    self.layer["TEXT"][group[0]]
+                    if len(group) == 1
+                    else "Berths: {}<br />".format(len(group))
+                )
+                for group in groups
+            ],
+            "PAIRS": pairs,
+        }
+        self.clusterings[zoom] = clusters
+        return clusters
+
+    def cluster_view(self, zoom, bounds):
+        """Get the view of the berths clustered on a grid within the map bounds.
+
+        Args:
+            zoom (int): map zoom
+            bounds ((float, float, float, float)): west, south, east and north
+        Returns:
+            dict: view of the clusters
+        """
+        if len(self.lat) == 0:
+            return build_view(self.layer, [], self.lat, self.lon, [], self.edges)
+        clusters = self.clustering(zoom)
+        clat, clon = clusters["LATITUDE"], clusters["LONGITUDE"]
+
+        # Keep the clusters within the bounds and those they are joined to
+        inside = in_bounds(clat, clon, bounds)
+        pairs = clusters["PAIRS"]
+        pairs = pairs[inside[pairs[:, 0]] | inside[pairs[:, 1]]]
+        nodes = np.union1d(np.flatnonzero(inside), pairs.ravel())
+        return build_view(
+            self.layer,
+            [clusters["GROUPS"][c] for c in nodes.tolist()],
+            clat[nodes],
+            clon[nodes],
+            [clusters["TEXT"][c] for c in nodes.tolist()],
+            np.searchsorted(nodes, pairs),
+        )
+
+    def view(self, zoom, bounds):
+        """Get the view of the static layer for map bounds and zoom.
+
+        Args:
+            zoom (int): map zoom
+            bounds ((float, float, float, float)): west, south, east and north
+        Returns:
+            dict: single berths zoomed in, otherwise clusters
+        """
+        if zoom < DETAIL_ZOOM:
+            return self.cluster_view(zoom, bounds)
+        return self.detail_view(bounds)
+
+
+def fit_view(layer):
+    """Get the map center and zoom showing all the berths of a static layer.
+
+    Args:
+        layer (dict): static layer
+    Returns:
+        (float, float): center latitude and longitude
+        int: zoom
+    """
+    if not layer["NAMES"]:
+        return (53.3, -2.5), 9
+    lat = np.asarray(layer["LATITUDE"], dtype=np.float64)
+    lon = np.asarray(layer["LONGITUDE"], dtype=np.float64)
+    y = mercator_y(lat)
+    lon_span = max(float(lon.max() - lon.min()), 1e-3)
+    y_span = max(float(y.max() - y.min()), 1e-3)
+
+    # Degrees of longitude across one pixel at zoom 0 is 360 / 256
+    scale = min(MAP_WIDTH / lon_span, MAP_HEIGHT / y_span) * 360.0 / TILE_PIXELS
+    zoom = int(min(max(math.floor(math.log2(scale)), 1), 15))
+    center_y = np.radians((y.max() + y.min()) / 2)
+    center_lat = float(np.degrees(2 * np.arctan(np.exp(center_y)) - np.pi / 2))
+    return (center_lat, float((lon.max() + lon.min()) / 2)), zoom
@@ -6,6 +6,8 @@ from flask import Flask
 from dash import Dash
 import dash_bootstrap_components as dbc
 
+from common.broadcast import BerthBroadcaster
+from common.cache import FileCache
 from common.config import Config
 from common.mongo import Mongo
 
@@ -46,6 +48,16 @@ def create_dash(server):
     # Initialise the mongo database
     app.mongo = Mongo.connect(app.logger, app.server.config["MONGO_URI"])
 
+    # Initialise the figure cache shared by the gunicorn workers
+    app.cache = FileCache(
+        app.server.config["DASH_CACHE_DIR"], app.server.config["DASH_CACHE_TTL"]
+    )
+
+    # Initialise the live berth occupancy broadcast of this worker
+    app.broadcaster = BerthBroadcaster(
+        app.logger, app.mongo, app.server.config["DASH_MAX_STREAMS"]
+    )
+
     # Update the Flask config a default "TITLE" and then with any new Dash
     # configuration parameters that might have been updated so that we can
     # access Dash config easily from anywhere in the project with Flask's
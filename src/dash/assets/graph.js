@@ -0,0 +1,364 @@
+/*
+ * Draws the graph page map from views of its static layer and the dynamic layer.
+ *
+ * The berths are not all sent to the browser. For the bounds and zoom the map
+ * shows, the server sends a view holding the berths within the bounds or,
+ * zoomed out, clusters of berths. Views are requested for bounds snapped to
+ * the map tiles, so panning within a tile does not fetch a new view and the
+ * browser cache answers a view seen before unless the generator has published
+ * a new layout. Each marker of a view lists the berths behind it. Views are
+ * fetched in the background and drawn with Plotly.react when they arrive, so the
+ * page never waits on them, and a view superseded by a later move is dropped.
+ *
+ * The state of every berth is kept by name. A full dynamic layer of trains,
+ * times and usage replaces it, a patch of only the berths that changed since
+ * the drawn revision updates it, and the markers are restyled in place with
+ * Plotly.restyle, leaving the edges untouched.
+ *
+ * Trains are moved as they step between berths by the server-sent events of
+ * the occupancy stream. A berth's train is only replaced by a later one, so a
+ * patch built before a streamed change never undoes it. Each server only
+ * streams to so many pages, the others only follow the patches.
+ *
+ * The view and marker functions take the map, view and state they draw, so the
+ * replay page draws its map with them too, see replay.js.
+ */
+
+var graphView = {key: null, etag: null, view: null, index: {}};
+var graphLoading = null;
+var graphState = {revision: null, etag: null, trains: {}, times: {}, usage: {}};
+var graphStream = null;
+
+// Most zoomed in map level, see pages/graph.py
+var MAX_ZOOM = 22;
+
+// Milliseconds before a stream turned away by the server is tried again
+var STREAM_RETRY = 5 * 60 * 1000;
+
+function mercatorY(lat) {
+    var rad = lat * Math.PI / 180;
+    return Math.log(Math.tan(Math.PI / 4 + rad / 2)) * 180 / Math.PI;
+}
+
+function mercatorLat(y) {
+    return Math.atan(Math.sinh(y * Math.PI / 180)) * 180 / Math.PI;
+}
+
+function mapBounds(plotId, relayout, figure) {
+    // The corners of the map are only reported once it has been moved
+    var derived = relayout && relayout["mapbox._derived"];
+    var mapbox = figure.layout.mapbox;
+    var zoom = relayout && relayout["mapbox.zoom"] !== undefined
+        ? relayout["mapbox.zoom"] : mapbox.zoom;
+    var lons = [];
+    var lats = [];
+    if (derived && derived.coordinates) {
+        for (var i = 0; i < derived.coordinates.length; i++) {
+            lons.push(derived.coordinates[i][0]);
+            lats.push(derived.coordinates[i][1]);
+        }
+    } else {
+        var center = relayout && relayout["mapbox.center"]
+            ? relayout["mapbox.center"] : mapbox.center;
+        var plot = document.querySelector("#" + plotId + " .js-plotly-plot");
+        var width = plot && plot.clientWidth ? plot.clientWidth : 1500;
+        var height = figure.layout.height || 1000;
+        var degrees = 360 / (256 * Math.pow(2, zoom));
+        var y = mercatorY(center.lat);
+        lons = [center.lon - width / 2 * degrees, center.lon + width / 2 * degrees];
+        lats = [
+            mercatorLat(y - height / 2 * degrees),
+            mercatorLat(y + height / 2 * degrees)
+        ];
+    }
+    return {
+        zoom: Math.min(Math.max(Math.floor(zoom), 0), MAX_ZOOM),
+        west: Math.min.apply(null, lons),
+        south: Math.min.apply(null, lats),
+        east: Math.max.apply(null, lons),
+        north: Math.max.apply(null, lats)
+    };
+}
+
+function viewKey(bounds) {
+    // Snap the bounds outwards to the map tiles, padded by one tile
+    var tile = 360 / Math.pow(2, bounds.zoom);
+    var west = Math.max((Math.floor(bounds.west / tile) - 1) * tile, -180);
+    var east = Math.min((Math.ceil(bounds.east / tile) + 1) * tile, 180);
+    var south = Math.max(
+        (Math.floor(mercatorY(Math.max(bounds.south, -85)) / tile) - 1) * tile, -180
+    );
+    var north = Math.min(
+        (Math.ceil(mercatorY(Math.min(bounds.north, 85)) / tile) + 1) * tile, 180
+    );
+    return "zoom=" + bounds.zoom
+        + "&west=" + west.toFixed(6)
+        + "&south=" + mercatorLat(south).toFixed(6)
+        + "&east=" + east.toFixed(6)
+        + "&north=" + mercatorLat(north).toFixed(6);
+}
+
+function loadView(key, callback) {
+    // The browser cache answers this request unless the layout has changed
+    var xhr = new XMLHttpRequest();
+    xhr.open("GET", "/layers/view.json?" + key, true);
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            callback(null);
+            return;
+        }
+        var view = JSON.parse(xhr.responseText);
+        var index = {};
+        for (var i = 0; i < view.GROUPS.length; i++) {
+            for (var j = 0; j < view.GROUPS[i].length; j++) {
+                index[view.GROUPS[i][j]] = i;
+            }
+        }
+        callback({key: key, etag: view.ETAG, view: view, index: index});
+    };
+    xhr.onerror = function () {
+        callback(null);
+    };
+    xhr.send(null);
+}
+
+function markerStyle(view, state, i) {
+    // States without usage, such as replays, only colour the markers
+    var group = view.GROUPS[i];
+    var usage = 0;
+    var trains = [];
+    var updated = "None";
+    for (var j = 0; j < group.length; j++) {
+        var name = group[j];
+        var train = state.trains[name];
+        usage += state.usage !== null ? state.usage[name] || 0 : 0;
+        if (train !== undefined && train !== "0000") {
+            trains.push(train);
+        }
+        var time = state.times[name];
+        if (time !== undefined && (updated === "None" || time > updated)) {
+            updated = time;
+        }
+    }
+
+    var text = view.TEXT[i];
+    if (state.usage === null) {
+        usage = 0;
+    } else if (group.length === 1) {
+        text += "Usage: " + usage + " trains/hr<br />";
+    } else {
+        text += "Mean usage: " + (usage / group.length).toFixed(1) + " trains/hr<br />";
+    }
+    text += "Updated: " + updated + "<br />";
+    if (trains.length > 0) {
+        text += (trains.length === 1 ? "Train: " : "Trains: ") + trains.join(", ");
+    }
+    return {
+        colour: trains.length > 0 ? "#E7717D" : "#263025",
+        size: 5 + usage / group.length,
+        text: text
+    };
+}
+
+function markerStyles(view, state) {
+    var styles = {colours: [], sizes: [], texts: []};
+    for (var i = 0; i < view.GROUPS.length; i++) {
+        var style = markerStyle(view, state, i);
+        styles.colours.push(style.colour);
+        styles.sizes.push(style.size);
+        styles.texts.push(style.text);
+    }
+    return styles;
+}
+
+function restyleMarkers(plotId, view, state) {
+    var plot = document.querySelector("#" + plotId + " .js-plotly-plot");
+    if (plot === null || !window.Plotly || view === null) {
+        return false;
+    }
+    var styles = markerStyles(view, state);
+    var update = {
+        "marker.color": [styles.colours],
+        "marker.size": [styles.sizes],
+        hovertext: [styles.texts]
+    };
+    window.Plotly.restyle(plot, update, [1]);
+    return true;
+}
+
+function setTrain(name, train, time) {
+    // Times are compared as "YYYY-MM-DD HH:MM:SS[.ffffff]" strings
+    var last = graphState.times[name];
+    if (last === undefined || last === "None" || time >= last) {
+        graphState.trains[name] = train;
+        graphState.times[name] = time;
+    }
+}
+
+function applyChanges(changes) {
+    if (graphState.revision === null || graphView.view === null) {
+        return;
+    }
+    var shown = false;
+    for (var j = 0; j < changes.NAMES.length; j++) {
+        var name = changes.NAMES[j];
+        if (graphState.times[name] !== undefined) {
+            setTrain(name, changes.TRAINS[j], changes.TIMES[j]);
+            shown = shown || graphView.index[name] !== undefined;
+        }
+    }
+    if (shown) {
+        restyleMarkers("graph-map", graphView.view, graphState);
+    }
+}
+
+function startStream() {
+    if (graphStream !== null || !window.EventSource) {
+        return;
+    }
+    graphStream = new window.EventSource("/stream/berths");
+    graphStream.onmessage = function (event) {
+        applyChanges(JSON.parse(event.data));
+    };
+    graphStream.onerror = function () {
+        // A busy server turns the stream away, the patches keep the map up to
+        // date until it is tried again
+        if (graphStream.readyState === window.EventSource.CLOSED) {
+            graphStream = null;
+            setTimeout(startStream, STREAM_RETRY);
+        }
+    };
+}
+
+function setLayer(dynamic) {
+    graphState = {
+        revision: dynamic.REVISION,
+        etag: dynamic.ETAG,
+        trains: {},
+        times: {},
+        usage: {}
+    };
+    for (var i = 0; i < dynamic.NAMES.length; i++) {
+        var name = dynamic.NAMES[i];
+        graphState.trains[name] = dynamic.TRAINS[i];
+        graphState.times[name] = dynamic.TIMES[i];
+        graphState.usage[name] = dynamic.USAGE[i];
+    }
+    startStream();
+}
+
+function applyPatch(patch) {
+    if (patch.BASE !== graphState.revision) {
+        return false;
+    }
+    for (var j = 0; j < patch.NAMES.length; j++) {
+        var name = patch.NAMES[j];
+        graphState.usage[name] = patch.USAGE[j];
+        setTrain(name, patch.TRAINS[j], patch.TIMES[j]);
+    }
+    graphState.revision = patch.REVISION;
+    return true;
+}
+
+function drawView(view, state, figure) {
+    // Plot the edges as lines between the markers, then the markers
+    var lat = [];
+    var lon = [];
+    for (var k = 0; k < view.EDGES.length; k++) {
+        var a = view.EDGES[k][0];
+        var b = view.EDGES[k][1];
+        lat.push(view.LATITUDE[a], view.LATITUDE[b], null);
+        lon.push(view.LONGITUDE[a], view.LONGITUDE[b], null);
+    }
+    var edges = {
+        type: "scattermapbox",
+        mode: "lines",
+        lat: lat,
+        lon: lon,
+        line: {width: 1.0, color: "#888"},
+        hoverinfo: "none"
+    };
+    var styles = markerStyles(view, state);
+    var nodes = {
+        type: "scattermapbox",
+        mode: "markers",
+        lat: view.LATITUDE,
+        lon: view.LONGITUDE,
+        marker: {size: styles.sizes, color: styles.colours, opacity: 0.7},
+        hovertext: styles.texts,
+        hoverinfo: "text"
+    };
+    return {data: [edges, nodes], layout: figure.layout};
+}
+
+function reactView(plotId, view, state) {
+    // Draw a view that arrived after its callback returned over the map as it
+    // is now, Plotly.react only redraws the traces
+    var plot = document.querySelector("#" + plotId + " .js-plotly-plot");
+    if (plot === null || !window.Plotly) {
+        return false;
+    }
+    var figure = drawView(view, state, {layout: plot.layout});
+    window.Plotly.react(plot, figure.data, figure.layout);
+    return true;
+}
+
+function triggeredBy(prop) {
+    var context = window.dash_clientside.callback_context;
+    if (!context || !context.triggered) {
+        return false;
+    }
+    for (var i = 0; i < context.triggered.length; i++) {
+        if (context.triggered[i].prop_id === prop) {
+            return true;
+        }
+    }
+    return false;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    graph: {
+        update_figure: function (dynamic, relayout, figure) {
+            var no_update = window.dash_clientside.no_update;
+            var revision = no_update;
+
+            if (dynamic && triggeredBy("graph-dynamic.data")) {
+                // A patch that can't be applied asks for the full layer next time
+                if ("BASE" in dynamic) {
+                    if (!applyPatch(dynamic)) {
+                        return [no_update, null];
+                    }
+                } else {
+                    setLayer(dynamic);
+                }
+                revision = graphState.revision;
+            }
+            if (graphState.revision === null) {
+                return [no_update, revision];
+            }
+
+            // Fetch a new view if the map moved to other tiles or the layout changed
+            var key = viewKey(mapBounds("graph-map", relayout, figure));
+            if (key !== graphView.key || graphView.etag !== graphState.etag) {
+                if (graphLoading !== key) {
+                    graphLoading = key;
+                    loadView(key, function (loaded) {
+                        if (graphLoading !== key) {
+                            return;
+                        }
+                        graphLoading = null;
+                        if (loaded !== null) {
+                            graphView = loaded;
+                            reactView("graph-map", graphView.view, graphState);
+                        }
+                    });
+                }
+                return [no_update, revision];
+            }
+            if (!restyleMarkers("graph-map", graphView.view, graphState)) {
+                return [drawView(graphView.view, graphState, figure), revision];
+            }
+            return [no_update, revision];
+        }
+    }
+});
@@ -0,0 +1,212 @@
+/*
+ * Plays back the occupancy frames of a past day on the replay page map.
+ *
+ * The map is drawn from the same views as the graph page, see graph.js. The
+ * occupancy is fetched in windows of an hour in one request each, holding the
+ * occupancy at the keyframe before the window and every change since. Seeking
+ * starts from the keyframe and applies the changes up to the time sought, and
+ * playback applies the changes as the clock passes them, fetching the next
+ * window in the background before the current one runs out. Windows and views
+ * are fetched in the background like the graph page's views, and drawn when
+ * they arrive.
+ *
+ * Frame times are the collector's local times and are handled as UTC here, so
+ * they are never shifted by the browser's time zone.
+ */
+
+var replayView = {key: null, etag: null, view: null, index: {}};
+var replayState = {trains: {}, times: {}, usage: null};
+var replayLoading = null;
+var replayPlayer = {
+    position: null,
+    speed: 60,
+    playing: false,
+    timer: null,
+    last: null,
+    window: null,
+    applied: 0,
+    next: null,
+    loading: false,
+    seeking: null
+};
+
+// Minutes of frames fetched at once, and the milliseconds between clock ticks
+var REPLAY_WINDOW = 60;
+var REPLAY_TICK = 200;
+
+function replayParse(time) {
+    // "YYYY-MM-DD HH:MM:SS" or "YYYY-MM-DD" to milliseconds
+    var parts = time.split(/[^0-9]/).map(Number);
+    return Date.UTC(
+        parts[0], parts[1] - 1, parts[2], parts[3] || 0, parts[4] || 0, parts[5] || 0
+    );
+}
+
+function replayFormat(ms) {
+    return new Date(ms).toISOString().slice(0, 19).replace("T", " ");
+}
+
+function replayWindow(start, callback) {
+    var xhr = new XMLHttpRequest();
+    var url = "/replay/frames.json?start=" + replayFormat(start).replace(" ", "T")
+        + "&minutes=" + REPLAY_WINDOW;
+    xhr.open("GET", url, true);
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            callback(null);
+            return;
+        }
+        var frames = JSON.parse(xhr.responseText);
+        frames.keyframe = replayParse(frames.KEYFRAME);
+        frames.end = replayParse(frames.END);
+        callback(frames);
+    };
+    xhr.onerror = function () {
+        callback(null);
+    };
+    xhr.send(null);
+}
+
+function replayApply(until) {
+    // Apply the changes of the window up to a time, returns if any were shown
+    var frames = replayPlayer.window;
+    var shown = false;
+    while (replayPlayer.applied < frames.OFFSETS.length) {
+        var j = replayPlayer.applied;
+        var time = frames.keyframe + frames.OFFSETS[j];
+        if (time > until) {
+            break;
+        }
+        var name = frames.NAMES[j];
+        replayState.trains[name] = frames.TRAINS[j];
+        replayState.times[name] = replayFormat(time);
+        shown = shown || replayView.index[name] !== undefined;
+        replayPlayer.applied++;
+    }
+    return shown;
+}
+
+function replaySeek(frames, position) {
+    // Start from the keyframe occupancy, then apply the changes since, a window
+    // whose keyframe was missing starts from the next one
+    position = Math.max(position, frames.keyframe);
+    replayPlayer.window = frames;
+    replayPlayer.applied = 0;
+    replayPlayer.next = null;
+    replayPlayer.position = position;
+    replayState = {trains: {}, times: {}, usage: null};
+    var occupancy = frames.OCCUPANCY;
+    for (var i = 0; i < occupancy.NAMES.length; i++) {
+        replayState.trains[occupancy.NAMES[i]] = occupancy.TRAINS[i];
+        replayState.times[occupancy.NAMES[i]] = frames.KEYFRAME;
+    }
+    replayApply(position);
+}
+
+function replayClock() {
+    var clock = document.getElementById("replay-clock");
+    if (clock !== null && replayPlayer.position !== null) {
+        clock.textContent = replayFormat(replayPlayer.position).slice(11);
+    }
+}
+
+function replayTick() {
+    var now = Date.now();
+    var player = replayPlayer;
+    if (!player.playing || player.window === null) {
+        player.last = now;
+        return;
+    }
+    var position = player.position + (now - player.last) * player.speed;
+    player.last = now;
+
+    // Fetch the next window before this one runs out, and wait for it if late
+    var remaining = player.window.end - position;
+    if (remaining < REPLAY_WINDOW * 60000 / 4 && player.next === null && !player.loading) {
+        var current = player.window;
+        player.loading = true;
+        replayWindow(player.window.end, function (frames) {
+            player.loading = false;
+            if (player.window !== current) {
+                return;
+            }
+            player.next = frames;
+            if (frames === null) {
+                player.playing = false;
+            }
+        });
+    }
+    if (position >= player.window.end) {
+        if (player.next === null) {
+            position = player.window.end;
+        } else {
+            replaySeek(player.next, position);
+            position = player.position;
+            restyleMarkers("replay-map", replayView.view, replayState);
+        }
+    }
+
+    player.position = position;
+    if (replayApply(position)) {
+        restyleMarkers("replay-map", replayView.view, replayState);
+    }
+    replayClock();
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    replay: {
+        update_figure: function (date, minute, clicks, speed, relayout, figure) {
+            var no_update = window.dash_clientside.no_update;
+            if (!date) {
+                return no_update;
+            }
+            replayPlayer.speed = speed || 1;
+            replayPlayer.playing = (clicks || 0) % 2 === 1;
+            if (replayPlayer.timer === null) {
+                replayPlayer.last = Date.now();
+                replayPlayer.timer = setInterval(replayTick, REPLAY_TICK);
+            }
+
+            // Seek when the day or time is picked, or on the first draw
+            var seek = triggeredBy("replay-date.date")
+                || triggeredBy("replay-time.value")
+                || replayPlayer.window === null;
+            if (seek) {
+                var position = replayParse(date) + (minute || 0) * 60000;
+                replayPlayer.seeking = position;
+                replayWindow(position, function (frames) {
+                    if (replayPlayer.seeking !== position) {
+                        return;
+                    }
+                    replayPlayer.seeking = null;
+                    if (frames === null) {
+                        return;
+                    }
+                    replaySeek(frames, position);
+                    replayClock();
+                    if (replayView.view !== null
+                            && !restyleMarkers("replay-map", replayView.view, replayState)) {
+                        reactView("replay-map", replayView.view, replayState);
+                    }
+                });
+            }
+
+            // Fetch a new view if the map moved to other tiles
+            var key = viewKey(mapBounds("replay-map", relayout, figure));
+            if (key !== replayView.key && replayLoading !== key) {
+                replayLoading = key;
+                loadView(key, function (loaded) {
+                    if (replayLoading !== key) {
+                        return;
+                    }
+                    replayLoading = null;
+                    if (loaded !== null) {
+                        replayView = loaded;
+                        reactView("replay-map", replayView.view, replayState);
+                    }
+                });
+            }
+            return no_update;
+        }
+    }
+});
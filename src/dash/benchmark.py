@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+
+"""Latency benchmark of the dash page functions, callbacks and routes.
+
+A scratch database is populated with a synthetic rail network of a chosen
+number of berths, the movements of a number of trains through it over the last
+day and a history of PPM messages. The usage counters, PPM rollups, replay
+frames and static map layer are then derived from them by the same functions
+the collector and generator use. Each benchmark case calls a page function,
+callback or route of the dash app directly against the scratch database and
+reports the p50, p95 and p99 latency, the bytes it would send to the browser
+and the peak memory allocated by a single call.
+
+The figure cache is disabled unless asked for, so every call does the full
+work of a cache miss. Results can be saved and later runs compared against
+them, failing if any case got slower or bigger by more than a tolerance.
+
+Usage:
+    python benchmark.py populate --berths 3000 --trains 2000 --movements 200000
+    python benchmark.py run --repeats 50 --output baseline.json
+    python benchmark.py run --repeats 50 --baseline baseline.json --tolerance 0.2
+"""
+
+import sys
+import json
+import time
+import random
+import string
+import logging
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+
+import numpy as np
+import plotly
+from dash.exceptions import PreventUpdate
+from flask import Response
+
+from app import app
+from common import layers, replay
+from common.cache import FileCache
+from common.config import Config
+from common.mongo import Mongo
+from common.ppm import backfill_rollups
+from common.usage import backfill_usage
+import pages.graph as graph_page
+import pages.ppm as ppm_page
+import pages.replay as replay_page
+
+
+log = logging.getLogger("dash_benchmark")
+
+# Synthetic berths per TD area and per line, and the spacing along a line
+AREA_BERTHS = 500
+LINE_BERTHS = 50
+BERTH_SPACING = 0.01
+
+# Area the synthetic lines start in, as (south, west, north, east)
+NETWORK_BOUNDS = (50.5, -5.0, 57.5, 1.5)
+
+# Seconds between the steps of a synthetic train
+STEP_SECONDS = (30, 120)
+
+
+def synthetic_berths(count, rng):
+    """Build a connected network of berths laid out along random lines.
+
+    Args:
+        count (int): number of berths
+        rng (random.Random): random generator
+    Returns:
+        [dict]: BERTHS documents, selected and placed
+    """
+    south, west, north, east = NETWORK_BOUNDS
+    berths = []
+    for i in range(count):
+        area = string.ascii_uppercase[i // AREA_BERTHS // 26 % 26]
+        area += string.ascii_uppercase[i // AREA_BERTHS % 26]
+        if i % LINE_BERTHS == 0:
+            # Start each line from a berth of an earlier one, the first anywhere
+            heading = rng.uniform(0, 2 * np.pi)
+            if berths:
+                branch = rng.choice(berths)
+                lat, lon = branch["LATITUDE"], branch["LONGITUDE"]
+            else:
+                lat, lon = rng.uniform(south, north), rng.uniform(west, east)
+                branch = None
+        else:
+            branch = berths[-1]
+        heading += rng.gauss(0, 0.1)
+        lat = min(max(lat + BERTH_SPACING * np.sin(heading), south), north)
+        lon = min(max(lon + BERTH_SPACING * np.cos(heading), west), east)
+        berth = {
+            "NAME": "{}{:04d}".format(area, i % AREA_BERTHS),
+            "LATITUDE": lat,
+            "LONGITUDE": lon,
+            "DESCRIPTION": "Signal" if rng.random() < 0.1 else None,
+            "FIXED": rng.random() < 0.05,
+            "CLASS": 0,
+            "SELECTED": True,
+            "EDGES": [[]],
+            "LATEST_TRAIN": "0000",
+        }
+        if branch is not None:
+            berth["EDGES"][0].append(branch["NAME"])
+            branch["EDGES"][0].append(berth["NAME"])
+        berths.append(berth)
+    return berths
+
+
+def synthetic_trains(berths, count, movements, now, rng):
+    """Walk trains through the berths over the last day.
+
+    The last berth of each train is left occupied by it.
+
+    Args:
+        berths ([dict]): BERTHS documents, updated in place
+        count (int): number of trains
+        movements (int): total number of steps of all the trains
+        now (datetime.datetime): time of the latest steps
+        rng (random.Random): random generator
+    Returns:
+        [dict]: TRAINS documents
+    """
+    index = {berth["NAME"]: berth for berth in berths}
+    headcodes = set()
+    while len(headcodes) < count:
+        headcodes.add(
+            "{}{}{:02d}".format(
+                rng.randint(0, 9),
+                rng.choice(string.ascii_uppercase),
+                rng.randint(0, 99),
+            )
+        )
+
+    trains = []
+    for i, headcode in enumerate(sorted(headcodes)):
+        steps = movements // count + (1 if i < movements % count else 0)
+        if steps == 0:
+            continue
+        gaps = [rng.randint(*STEP_SECONDS) for _ in range(steps)]
+        latest = max(datetime.timedelta(days=1).total_seconds() - sum(gaps), 0)
+        step_time = now - datetime.timedelta(seconds=sum(gaps) + rng.uniform(0, latest))
+
+        berth, last = rng.choice(berths), None
+        train = {"NAME": headcode, "BERTHS": [], "TIMES": [], "CLASSES": []}
+        for gap in gaps:
+            step_time += datetime.timedelta(seconds=gap)
+            train["BERTHS"].append(berth["NAME"])
+            train["TIMES"].append(step_time)
+            train["CLASSES"].append(0)
+            ahead = [name for name in berth["EDGES"][0] if name != last]
+            last = berth["NAME"]
+            berth = index[rng.choice(ahead or berth["EDGES"][0] or [last])]
+        index[last]["LATEST_TRAIN"] = headcode
+        index[last]["LATEST_TIME"] = step_time
+        trains.append(train)
+    return trains
+
+
+def synthetic_ppm(count, now, rng):
+    """Build a history of PPM messages, one a minute up to now.
+
+    Args:
+        count (int): number of messages
+        now (datetime.datetime): time of the latest message
+        rng (random.Random): random generator
+    Returns:
+        [dict]: PPM documents
+    """
+    docs = []
+    for i in range(count):
+        total = rng.randint(500, 20000)
+        late = rng.randint(0, total // 5)
+        ppm = 100.0 * (total - late) / total
+        docs.append(
+            {
+                "date": now - datetime.timedelta(minutes=count - i),
+                "total": total,
+                "on_time": total - late,
+                "late": late,
+                "ppm": ppm,
+                "rolling_ppm": min(ppm + rng.uniform(-2, 2), 100.0),
+            }
+        )
+    return docs
+
+
+def populate(args):
+    """Fill the scratch database with synthetic data and its derived collections.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+    """
+    mongo = Mongo.connect(log, args.uri, args.database)
+    if mongo is None:
+        raise ConnectionError
+    for collection in mongo.collections() or []:
+        mongo.drop(collection)
+
+    rng = random.Random(args.seed)
+    now = datetime.datetime.now()
+    berths = synthetic_berths(args.berths, rng)
+    trains = synthetic_trains(berths, args.trains, args.movements, now, rng)
+    for berth in berths:
+        berth.setdefault("LATEST_TIME", now - datetime.timedelta(hours=1))
+    for collection, docs in [
+        ("BERTHS", berths),
+        ("TRAINS", trains),
+        ("PPM", synthetic_ppm(args.ppm, now, rng)),
+    ]:
+        for i in range(0, len(docs), args.batch):
+            mongo.add_many(collection, docs[i : i + args.batch])  # noqa: E203
+
+    # Derive the collections and indexes the collector and generator maintain
+    mongo.create_index("BERTHS", [("NAME", 1)], unique=True)
+    mongo.create_index("BERTHS", [("LATEST_TIME", 1)])
+    mongo.create_index("PPM", [("date", 1)])
+    backfill_usage(mongo, now)
+    backfill_rollups(mongo)
+    replay.create_indexes(mongo)
+    replay.update_frames(mongo, None, now)
+    if layers.publish_static_layer(mongo) is None:
+        raise Exception("Could not publish the static layer!")
+
+
+def payload_bytes(result):
+    """Get the number of bytes a result sends to the browser.
+
+    Args:
+        result (object): callback return value or route response
+    Returns:
+        int: response body bytes, or JSON bytes of a callback value
+    """
+    if isinstance(result, Response):
+        return len(result.get_data())
+    return len(json.dumps(result, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def measure(call, repeats):
+    """Time repeated calls of a benchmark case and the memory of one call.
+
+    Args:
+        call (callable): benchmark case
+        repeats (int): number of timed calls
+    Returns:
+        dict: latency percentiles in ms, payload bytes and peak memory in MB
+    """
+    call()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = call()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    # Trace the memory of a separate call, tracing slows the calls down
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "bytes": payload_bytes(result),
+        "peak_mb": peak / 2**20,
+    }
+
+
+def callback(function, *args):
+    """Get a benchmark case calling a dash callback within a request context.
+
+    Args:
+        function (callable): callback function
+        *args: callback arguments
+    Returns:
+        callable: benchmark case, returns None if the update is prevented
+    """
+
+    def call():
+        with app.server.test_request_context():
+            try:
+                return function(*args)
+            except PreventUpdate:
+                return None
+
+    return call
+
+
+def route(url):
+    """Get a benchmark case requesting a route of the dash server.
+
+    Args:
+        url (str): route URL with its query
+    Returns:
+        callable: benchmark case returning the response
+    """
+    client = app.server.test_client()
+    return lambda: client.get(url)
+
+
+def cases(mongo, now):
+    """Get the benchmark cases of every page.
+
+    Args:
+        mongo (common.mongo.Mongo): database class for the scratch database
+        now (datetime.datetime): time the windows of data end at
+    Returns:
+        [(str, callable)]: case names and calls
+    """
+    # Map views of the whole network zoomed out and a corner of it zoomed in
+    data, _ = layers.get_static_layer(mongo)
+    layer = layers.decode_layer(data)
+    west, east = min(layer["LONGITUDE"]), max(layer["LONGITUDE"])
+    south, north = min(layer["LATITUDE"]), max(layer["LATITUDE"])
+    lat, lon = layer["LATITUDE"][0], layer["LONGITUDE"][0]
+
+    def view(zoom, bounds):
+        query = "zoom={}&west={}&south={}&east={}&north={}".format(zoom, *bounds)
+        return route("{}?{}".format(graph_page.VIEW_URL, query))
+
+    def dates(days):
+        return str((now - datetime.timedelta(days=days)).date()), str(now.date())
+
+    start = replay.frame_start(now - datetime.timedelta(hours=2))
+    frames = "{}?start={}&minutes=60".format(replay_page.FRAMES_URL, start.isoformat())
+    return [
+        ("graph.body", graph_page.body),
+        ("graph.build_dynamic_layer", graph_page.build_dynamic_layer),
+        (
+            "graph.update_graph_dynamic",
+            callback(graph_page.update_graph_dynamic, 0, None),
+        ),
+        ("graph.view z6", view(6, (west, south, east, north))),
+        ("graph.view z9", view(9, (west, south, east, north))),
+        ("graph.view z12", view(12, (lon - 0.1, lat - 0.05, lon + 0.1, lat + 0.05))),
+        (
+            "ppm.get_ppm_df 1d",
+            lambda: ppm_page.get_ppm_df(now - datetime.timedelta(days=1), now),
+        ),
+        (
+            "ppm.get_ppm_df 90d",
+            lambda: ppm_page.get_ppm_df(now - datetime.timedelta(days=90), now),
+        ),
+        (
+            "ppm.update_ppm_graph 7d",
+            callback(ppm_page.update_ppm_graph, *dates(7), None),
+        ),
+        (
+            "ppm.update_ppm_graph 90d",
+            callback(ppm_page.update_ppm_graph, *dates(90), None),
+        ),
+        ("replay.frames 60m", route(frames)),
+    ]
+
+
+def run(args):
+    """Run every benchmark case against the scratch database.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+    Returns:
+        [dict]: case names and their measurements
+    """
+    mongo = Mongo.connect(log, args.uri, args.database)
+    if mongo is None:
+        raise ConnectionError
+    app.mongo = mongo
+    app.cache = FileCache(tempfile.mkdtemp() if args.cache else "", args.cache)
+
+    results = []
+    for name, call in cases(mongo, datetime.datetime.now()):
+        if args.case and not any(case in name for case in args.case):
+            continue
+        result = measure(call, args.repeats)
+        result["case"] = name
+        results.append(result)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Find the cases slower or bigger than a baseline by more than a tolerance.
+
+    Args:
+        results ([dict]): measurements of this run
+        baseline ([dict]): measurements of the baseline run
+        tolerance (float): allowed relative increase
+    Returns:
+        [str]: description of each regression
+    """
+    previous = {result["case"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        if result["case"] not in previous:
+            continue
+        for key in ["p95_ms", "bytes"]:
+            before, after = previous[result["case"]][key], result[key]
+            if after > before * (1 + tolerance):
+                regressions.append(
+                    "{} {} {:.1f} -> {:.1f}".format(result["case"], key, before, after)
+                )
+    return regressions
+
+
+def print_results(results):
+    """Print a table of the measurements of each case.
+
+    Args:
+        results ([dict]): case names and their measurements
+    """
+    row = "{:<28} {:>9} {:>9} {:>9} {:>10} {:>8}"
+    print(row.format("case", "p50_ms", "p95_ms", "p99_ms", "bytes", "peak_mb"))
+    for result in results:
+        print(
+            row.format(
+                result["case"],
+                "{:.1f}".format(result["p50_ms"]),
+                "{:.1f}".format(result["p95_ms"]),
+                "{:.1f}".format(result["p99_ms"]),
+                result["bytes"],
+                "{:.1f}".format(result["peak_mb"]),
+            )
+        )
+
+
+def main():
+    """Call when the benchmark is run from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--uri", default=Config.MONGO_URI, help="MongoDB URI")
+    parser.add_argument("--database", default="thetrains_dash_benchmark")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log progress")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fill = commands.add_parser("populate", help="fill the database with synthetic data")
+    fill.add_argument("--berths", type=int, default=3000, help="selected berths")
+    fill.add_argument("--trains", type=int, default=2000, help="trains")
+    fill.add_argument("--movements", type=int, default=200000, help="train steps")
+    fill.add_argument("--ppm", type=int, default=100000, help="PPM messages")
+    fill.add_argument("--seed", type=int, default=0, help="random seed")
+    fill.add_argument("--batch", type=int, default=1000, help="documents per insert")
+
+    timing = commands.add_parser("run", help="time the page functions and routes")
+    timing.add_argument("--repeats", type=int, default=20, help="timed calls per case")
+    timing.add_argument("--case", nargs="+", help="only run cases matching these")
+    timing.add_argument(
+        "--cache", type=int, default=0, help="figure cache TTL, disabled if 0"
+    )
+    timing.add_argument("--output", help="write the results as JSON")
+    timing.add_argument("--baseline", help="results JSON to compare against")
+    timing.add_argument("--tolerance", type=float, default=0.2, help="allowed increase")
+
+    args = parser.parse_args()
+    Config.init_logging(log)
+    log.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    # Populating wipes the database so never let it be the live one
+    if args.database == "thetrains":
+        parser.error("the benchmark database can't be the live thetrains database")
+
+    if args.command == "populate":
+        populate(args)
+        return
+
+    results = run(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("Regression: {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ import dash_bootstrap_components as dbc
 from app import app
 import pages.graph as graph_page
 import pages.ppm as ppm_page
+import pages.replay as replay_page
 
 
 server = app.server
@@ -30,6 +31,7 @@ def add_navbar(body):
         children=[
             dbc.NavItem(dbc.NavLink("Graph", href="/")),
             dbc.NavItem(dbc.NavLink("PPM", href="/ppm")),
+            dbc.NavItem(dbc.NavLink("Replay", href="/replay")),
         ],
         brand="thetrains",
         brand_href="/",
@@ -52,6 +54,8 @@ def display_page(pathname):
         return add_navbar(graph_page.body())
     elif pathname == "/ppm":
         return add_navbar(ppm_page.body())
+    elif pathname == "/replay":
+        return add_navbar(replay_page.body())
     else:
         return "404"
 
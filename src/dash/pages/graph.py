@@ -2,187 +2,250 @@
 
 """Graph page layout module."""
 
+import uuid
+import hashlib
 import datetime
+import threading
 
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
+from flask import Response, request
 import plotly.graph_objects as go
-import pandas as pd
 
 from app import app
+from common import layers, views
+from common.broadcast import event_stream
+from common.usage import get_usage
 
+# URLs the map views and live occupancy are served from, see assets/graph.js
+VIEW_URL = "/layers/view.json"
+STREAM_URL = "/stream/berths"
 
-def get_sizes():
-    """Get the sizes of the nodes given frequency of use.
+# Most zoomed in map level
+MAX_ZOOM = 22
+
+# Index of the static layer the views are built from, kept until a new layout
+LAYER_INDEX = {"ETAG": None, "INDEX": None}
+LAYER_INDEX_LOCK = threading.Lock()
+
+
+def get_static_layer():
+    """Get the published static layer, publishing it if there is none yet.
 
     Returns:
-        dict: dict of node sizes
+        bytes: gzipped JSON, None if not available
+        str: ETag
     """
-    trains = app.mongo.get("TRAINS")
-    if trains is None:
-        return None
+    if app.mongo is None:
+        return None, None
+    data, etag = layers.get_static_layer(app.mongo)
+    if data is None and layers.publish_static_layer(app.mongo) is not None:
+        data, etag = layers.get_static_layer(app.mongo)
+    return data, etag
 
-    # Get the current time and delta
-    time_now = datetime.datetime.now()
-    time_delta = datetime.timedelta(hours=1)
 
-    # Get counts of trains passing through berths in the past hour
-    usage = {}
-    for train in trains:
-        for time, berth in zip(train["TIMES"], train["BERTHS"]):
-            if berth not in usage:
-                usage[berth] = 0
-            if (time_now - time) < time_delta:
-                usage[berth] += 1
+def get_decoded_static_layer():
+    """Get the published static layer decoded, shared by the workers.
 
-    # Get the sizes by scaling and applying a minimum
-    scale = 1
-    min_size = 5
-    sizes = {}
-    for key, value in usage.items():
-        sizes[key] = (value * scale) + min_size
+    Returns:
+        dict: static layer, None if not available
+        str: ETag
+    """
+    if app.mongo is None:
+        return None, None
+    etag = layers.get_static_etag(app.mongo)
+
+    def build():
+        data, _ = get_static_layer()
+        return layers.decode_layer(data) if data is not None else None
 
-    return usage, sizes
+    return app.cache.get_or_build("graph_static", build, etag), etag
 
 
-def get_berths():
-    """Get the nodes and edges of the graph as dataframes.
+def get_layer_index():
+    """Get the index of the published static layer, built once by each worker.
 
     Returns:
-        pd.DataFrame: nodes dataframe
-        pd.DataFrame: edges dataframe
+        common.views.LayerIndex: static layer index, None if not available
+        str: ETag
     """
-    usage, sizes = get_sizes()
-    if sizes is None:
+    etag = layers.get_static_etag(app.mongo) if app.mongo is not None else None
+    with LAYER_INDEX_LOCK:
+        if etag is not None and LAYER_INDEX["ETAG"] == etag:
+            return LAYER_INDEX["INDEX"], etag
+
+    layer, etag = get_decoded_static_layer()
+    if layer is None:
         return None, None
+    index = views.LayerIndex(layer)
+    with LAYER_INDEX_LOCK:
+        LAYER_INDEX.update(ETAG=etag, INDEX=index)
+    return index, etag
 
-    def apply_usage(node):
-        """Get the count of how many trains have used berth in last hour.
-
-        Returns:
-            float: usage of the node
-        """
-        return usage[node["NAME"]]
-
-    def apply_size(node):
-        """Generate the size of the node from how frequently train use it.
-
-        Returns:
-            float: size for the node
-        """
-        return sizes[node["NAME"]]
-
-    def apply_text(node):
-        """Generate the hover text to display for each node.
-
-        Returns:
-            str: hover text for node
-        """
-        text = "TD area: " + str(node["NAME"])[:2] + "<br />"
-        text = text + "Berth: " + str(node["NAME"])[2:] + "<br />"
-        if str(node["DESCRIPTION"]) != "nan":
-            text = text + "Description: " + str(node["DESCRIPTION"]) + "<br />"
-        if node["FIXED"]:
-            text = text + "Fixed: True" + "<br />"
-        else:
-            text = text + "Fixed: False" + "<br />"
-        text = text + "Usage: " + str(node["USAGE"]) + " trains/hr<br />"
-        text = text + "Updated: " + str(node["LATEST_TIME"]) + "<br />"
-
-        if node["LATEST_TRAIN"] != "0000":
-            text = text + "Train: " + str(node["LATEST_TRAIN"])
-        return text
-
-    def apply_colour(node):
-        """Generate colour of each node.
-
-        Returns:
-            str: color for node
-        """
-        if node["LATEST_TRAIN"] == "0000":
-            return "#263025"
-        else:
-            return "#E7717D"
 
-    if app.mongo is None:
+def view_params(args):
+    """Parse the zoom and bounds of a map view request.
+
+    Args:
+        args (werkzeug.datastructures.MultiDict): request arguments
+    Returns:
+        int: map zoom, None if the arguments are not valid
+        (float, float, float, float): west, south, east and north bounds, within
+            the globe
+    """
+    try:
+        zoom = int(args["zoom"])
+        bounds = tuple(float(args[k]) for k in ["west", "south", "east", "north"])
+    except (KeyError, ValueError):
         return None, None
 
-    berths = app.mongo.get("BERTHS")
-    if berths is None:
+    # Reject bounds that are not finite and clip the others to the globe
+    bounds = views.clip_bounds(bounds)
+    if bounds is None:
+        return None, None
+    west, south, east, north = bounds
+    if not 0 <= zoom <= MAX_ZOOM or west >= east or south >= north:
         return None, None
+    return zoom, bounds
 
-    selected = {}
-    for b in berths:
-        if "SELECTED" in list(b.keys()):
-            if b["SELECTED"]:
-                selected[b["NAME"]] = b
 
-    try:
-        # Generate nodes dataframe
-        nodes = pd.DataFrame.from_dict(selected, orient="index")
-        nodes["FIXED"].fillna(False, inplace=True)
-        nodes["COLOUR"] = nodes.apply(apply_colour, axis=1)
-        nodes["SIZE"] = nodes.apply(apply_size, axis=1)
-        nodes["USAGE"] = nodes.apply(apply_usage, axis=1)
-        nodes["TEXT"] = nodes.apply(apply_text, axis=1)
-
-        # Generate edges dataframe
-        lat, lon = [], []
-        for name, data in selected.items():
-            if "EDGES" in list(data.keys()):
-                for edge in data["EDGES"][0]:
-                    if edge in selected:
-                        lat.append(data["LATITUDE"])
-                        lat.append(selected[edge]["LATITUDE"])
-                        lat.append(None)
-                        lon.append(data["LONGITUDE"])
-                        lon.append(selected[edge]["LONGITUDE"])
-                        lon.append(None)
-        edges = pd.DataFrame({"LATITUDE": lat, "LONGITUDE": lon})
-    except Exception as e:
-        app.logger.warning("Could not generate berths from database data: {}".format(e))
+@app.server.route(VIEW_URL)
+def serve_view():
+    """Serve the map view for the bounds and zoom, or Not Modified if cached.
+
+    A view only changes with the static layer, so its ETag is that of the
+    static layer and the request, and the browser cache answers repeat visits.
+
+    Returns:
+        flask.Response: gzipped JSON map view
+    """
+    zoom, bounds = view_params(request.args)
+    if zoom is None:
+        return Response(status=400)
+    if app.mongo is None:
+        return Response(status=503)
+    static_etag = layers.get_static_etag(app.mongo)
+    if static_etag is None:
+        static_etag = get_static_layer()[1]
+        if static_etag is None:
+            return Response(status=503)
+    etag = hashlib.sha1(
+        "{}?{}".format(static_etag, request.query_string.decode()).encode("utf-8")
+    ).hexdigest()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        index, static_etag = get_layer_index()
+        if index is None:
+            return Response(status=503)
+        view = index.view(zoom, bounds)
+        view["ETAG"] = static_etag
+        data, _ = layers.encode_layer(view)
+        response = Response(data, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+
+    # Browsers keep the views but check the ETag on every request
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@app.server.route(STREAM_URL)
+def stream_berths():
+    """Stream the berth occupancy changes as server-sent events.
+
+    Returns:
+        flask.Response: event stream, Service Unavailable if the worker already
+            streams to as many clients as it can
+    """
+    subscriber = app.broadcaster.subscribe()
+    if subscriber is None:
+        return Response(status=503)
+    stream = event_stream(app.broadcaster, subscriber)
+    response = Response(stream, mimetype="text/event-stream")
+    # The stream may be closed before it starts, so never reaches its cleanup
+    response.call_on_close(lambda: app.broadcaster.unsubscribe(subscriber))
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def get_dynamic_layer():
+    """Get the latest revision of the dynamic layer, shared by every open page.
+
+    The layer is rebuilt at most once per cache TTL across all the workers,
+    or straight away when the generator publishes a new static layer.
+
+    Returns:
+        dict: name, train, time and usage arrays of the selected berths
+        dict: patch to the layer from its previous revision, None if unknown
+    """
+    if app.mongo is None:
+        return None, None
+    etag = layers.get_static_etag(app.mongo)
+    revision = app.cache.get_or_build("graph_dynamic", build_dynamic_revision, etag)
+    if revision is None:
         return None, None
+    return revision["LAYER"], revision["PATCH"]
 
-    return nodes, edges
 
+def build_dynamic_revision():
+    """Build a new revision of the dynamic layer and its patch from the last one.
 
-def get_graph_map():
-    """Get the graph rail network mapbox map.
+    Returns:
+        dict: the dynamic layer and its patch from the previous revision
+    """
+    layer = build_dynamic_layer()
+    if layer is None:
+        return None
+    layer["REVISION"] = uuid.uuid4().hex
+
+    # A patch can only be applied to the same static layer
+    patch = None
+    last = app.cache.last("graph_dynamic")
+    if last is not None and last["LAYER"]["ETAG"] == layer["ETAG"]:
+        patch = layers.diff_dynamic_layers(last["LAYER"], layer)
+        patch["BASE"] = last["LAYER"]["REVISION"]
+        patch["REVISION"] = layer["REVISION"]
+    return {"LAYER": layer, "PATCH": patch}
+
+
+def build_dynamic_layer():
+    """Build the dynamic layer from the latest BERTHS occupancy and usage.
 
     Returns:
-        go.Figure: Scattermapbox of rail network graph
+        dict: name, train, time and usage arrays of the selected berths
     """
-    # Get the nodes and edges and pandas dataframes from the database
-    nodes, edges = get_berths()
-    if nodes is None or edges is None:
+    _, etag = get_static_layer()
+    if etag is None:
         return None
 
-    # Plot the edges as lines between the nodes
-    graph_map = go.Figure(
-        go.Scattermapbox(
-            mode="lines",
-            lat=edges["LATITUDE"].tolist(),
-            lon=edges["LONGITUDE"].tolist(),
-            line=dict(width=1.0, color="#888"),
-            hoverinfo="none",
-        )
-    )
+    # Get counts of trains passing through berths in the past hour
+    usage = get_usage(app.mongo, datetime.datetime.now())
+    projection = ["NAME", "LATEST_TRAIN", "LATEST_TIME"]
+    berths = app.mongo.get("BERTHS", {"SELECTED": True}, projection)
+    if usage is None or berths is None:
+        return None
+    return layers.build_dynamic_layer(berths, usage, etag)
 
-    # Plot the nodes with markers depending on if a train is present
-    graph_map.add_trace(
-        go.Scattermapbox(
-            mode="markers",
-            lat=nodes["LATITUDE"].tolist(),
-            lon=nodes["LONGITUDE"].tolist(),
-            marker=go.scattermapbox.Marker(
-                size=nodes["SIZE"].tolist(), color=nodes["COLOUR"].tolist(), opacity=0.7
-            ),
-            hovertext=nodes["TEXT"].tolist(),
-            hoverinfo="text",
-        )
+
+def get_graph_map():
+    """Get the graph rail network mapbox map without any data.
+
+    The map is centred on the selected berths, and the views of it and the
+    dynamic layer are drawn onto it in the browser.
+
+    Returns:
+        dict: empty mapbox figure
+    """
+    index, _ = get_layer_index()
+    (lat, lon), zoom = views.fit_view(
+        index.layer if index is not None else {"NAMES": []}
     )
+    graph_map = go.Figure()
 
     # Update the mapbox layout
     graph_map.update_layout(
@@ -194,13 +257,13 @@ def get_graph_map():
             accesstoken=app.server.config["DASH_MAPBOX_TOKEN"],
             style="light",
             pitch=0,
-            zoom=9,
-            center=go.layout.mapbox.Center(lat=53.3, lon=-2.5),  # 53.4771, -2.2297
+            zoom=zoom,
+            center=go.layout.mapbox.Center(lat=lat, lon=lon),
         ),
     )
 
     graph_map["layout"]["uirevision"] = "constant"
-    return graph_map
+    return graph_map.to_dict()
 
 
 def body():
@@ -209,8 +272,7 @@ def body():
     Returns:
         html.Div: dash layout
     """
-    graph_map = get_graph_map()
-    if graph_map is None:
+    if get_dynamic_layer()[0] is None:
         return html.Div(
             dbc.Alert("Cannot retrieve data! Try again later!", color="danger")
         )
@@ -228,9 +290,13 @@ def body():
                                 individual train movements captured from the Network Rail feeds and a subset of known fixed locations. \
                                 Each node represents a train describer 'berth' which usually, but not always, represents a signal.\
                                 Red nodes indicate the live locations of trains on the network, \
-                                whilst the node size indicates the frequency of usage. Hovering over each node provides additional information.\
-                                The graph is updated every 5 seconds. \
-                                Only the west coast mainline central signal area (around Manchester) is considered for now."
+                                whilst the node size indicates the frequency of usage. Hovering over each node provides additional information. "
+                                    "When zoomed out, nearby berths are grouped into a "
+                                    "single node. "
+                                    "Trains are shown live and the usage is updated "
+                                    "every minute. "
+                                    "Only the west coast mainline central signal area "
+                                    "(around Manchester) is considered for now."
                                 ),
                             ]
                         ),
@@ -239,10 +305,12 @@ def body():
                     width={"size": 10, "offset": 1},
                 )
             ),
-            dbc.Row(dbc.Col(dcc.Graph(id="graph-map", figure=graph_map))),
+            dbc.Row(dbc.Col(dcc.Graph(id="graph-map", figure=get_graph_map()))),
+            dcc.Store(id="graph-dynamic"),
+            dcc.Store(id="graph-revision"),
             dcc.Interval(
                 id="graph-page-interval",
-                interval=1 * 5000,
+                interval=60 * 1000,
                 n_intervals=0,  # in milliseconds
             ),
         ],
@@ -252,12 +320,33 @@ def body():
 
 
 @app.callback(
-    Output("graph-map", "figure"), [Input("graph-page-interval", "n_intervals")]
+    Output("graph-dynamic", "data"),
+    [Input("graph-page-interval", "n_intervals")],
+    [State("graph-revision", "data")],
 )
-def update_graph_map(n):
-    """Update the graph rail network mapbox map.
+def update_graph_dynamic(n, revision):
+    """Update the dynamic layer of the graph rail network map.
+
+    Only the berths that changed are sent if the browser has the previous
+    revision of the layer.
 
+    Args:
+        revision (str): revision of the dynamic layer drawn in the browser
     Returns:
-        go.Figure: Scattermapbox of rail network graph
+        dict: dynamic layer, or the patch to it from the drawn revision
     """
-    return get_graph_map()
+    layer, patch = get_dynamic_layer()
+    if layer is None or layer["REVISION"] == revision:
+        raise PreventUpdate
+    if patch is not None and patch["BASE"] == revision:
+        return patch
+    return layer
+
+
+# Draw the view of the map bounds and the latest dynamic layer in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace="graph", function_name="update_figure"),
+    [Output("graph-map", "figure"), Output("graph-revision", "data")],
+    [Input("graph-dynamic", "data"), Input("graph-map", "relayoutData")],
+    [State("graph-map", "figure")],
+)
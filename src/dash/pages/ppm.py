@@ -2,47 +2,149 @@
 
 """PPM page layout module."""
 
+import datetime
+
+import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
+from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
 import pandas as pd
 
 from app import app
+from common.downsample import lttb
+from common.ppm import (
+    PPM_FIELDS,
+    READ_FACTOR,
+    bucket,
+    choose_resolution,
+    rollup_means,
+)
+
+# Most points plotted per series, about one per pixel of a full width graph
+MAX_POINTS = 1000
+
+# Days shown when the page is opened
+DEFAULT_DAYS = 7
 
+# Field, name and colour of the traces of each graph
+NUMBER_TRACES = [
+    ("total", "Total", "#263025"),
+    ("on_time", "On Time", "#a3eba0"),
+    ("late", "Late", "#E7717D"),
+]
+PPM_TRACES = [
+    ("ppm", "PPM", "#263025"),
+    ("rolling_ppm", "Rolling PPM", "#E7717D"),
+]
 
-def get_ppm_df():
-    """Get a pandas dataframe containing all PPM data.
 
+def get_ppm_df(start, end):
+    """Get a pandas dataframe containing the PPM data in a time range.
+
+    The data is read from the finest PPM rollup with at most READ_FACTOR times
+    MAX_POINTS buckets in the range, with the mean of each field in each bucket,
+    and is downsampled to MAX_POINTS by get_figure.
+
+    Args:
+        start (datetime.datetime): start of the range
+        end (datetime.datetime): end of the range, exclusive
     Returns:
         pd.DataFrame: PPM Pandas dataframe
     """
     if app.mongo is None:
         return None
 
-    docs = app.mongo.get("PPM")
+    unit, collection = choose_resolution(start, end, READ_FACTOR * MAX_POINTS)
+    selection = {"date": {"$gte": bucket(start, unit), "$lt": end}}
+    docs = app.mongo.get(collection, selection, sort=[("date", 1)])
     if docs is None:
         return None
+    return pd.DataFrame(rollup_means(docs), columns=["date"] + PPM_FIELDS)
+
+
+def get_date_range(start_date, end_date):
+    """Get the time range covered by the selected dates.
+
+    Args:
+        start_date (str): first date
+        end_date (str): last date, inclusive
+    Returns:
+        datetime.datetime: start of the range
+        datetime.datetime: end of the range, exclusive
+    """
+    start = pd.Timestamp(start_date).to_pydatetime()
+    end = pd.Timestamp(end_date).to_pydatetime() + datetime.timedelta(days=1)
+    return start, end
+
+
+def get_zoom_range(relayout):
+    """Get the x axis range a graph was zoomed or panned to.
+
+    Args:
+        relayout (dict): graph relayoutData
+    Returns:
+        (datetime.datetime, datetime.datetime): x axis range, None if not zoomed
+    """
+    if "xaxis.range[0]" in relayout and "xaxis.range[1]" in relayout:
+        bounds = [relayout["xaxis.range[0]"], relayout["xaxis.range[1]"]]
+    elif "xaxis.range" in relayout:
+        bounds = relayout["xaxis.range"]
+    else:
+        return None
+    return tuple(pd.Timestamp(bound).to_pydatetime() for bound in bounds)
 
-    ppm_dict = {
-        "date": [],
-        "total": [],
-        "on_time": [],
-        "late": [],
-        "ppm": [],
-        "rolling_ppm": [],
-    }
 
-    for doc in docs:
-        ppm_dict["date"].append(doc["date"])
-        ppm_dict["total"].append(doc["total"])
-        ppm_dict["on_time"].append(doc["on_time"])
-        ppm_dict["late"].append(doc["late"])
-        ppm_dict["ppm"].append(doc["ppm"])
-        ppm_dict["rolling_ppm"].append(doc["rolling_ppm"])
+def get_figure(graph, traces, title, start_date, end_date, relayout):
+    """Get a PPM graph figure of the selected dates or the zoomed range.
 
-    df = pd.DataFrame.from_dict(ppm_dict)
-    app.logger.warning(len(df))
-    return df
+    Each trace is downsampled with Largest-Triangle-Three-Buckets to at most
+    MAX_POINTS points, so zooming in re-queries the range at a higher resolution.
+
+    Args:
+        graph (str): graph id
+        traces ([(str, str, str)]): field, name and colour of each trace
+        title (str): graph title
+        start_date (str): first selected date
+        end_date (str): last selected date, inclusive
+        relayout (dict): graph relayoutData
+    Returns:
+        dict: graph figure
+    """
+    if start_date is None or end_date is None:
+        raise PreventUpdate
+    start, end = get_date_range(start_date, end_date)
+    layout = {"title": title, "uirevision": "{}{}".format(start_date, end_date)}
+
+    # Zooming re-queries the zoomed range, resetting the axes the selected dates
+    triggered = [t["prop_id"] for t in dash.callback_context.triggered]
+    if "{}.relayoutData".format(graph) in triggered and relayout:
+        zoom = get_zoom_range(relayout)
+        if zoom is not None:
+            start, end = zoom
+            layout["xaxis"] = {"range": [start, end]}
+        elif not relayout.get("xaxis.autorange"):
+            raise PreventUpdate
+
+    df = get_ppm_df(start, end)
+    if df is None:
+        raise PreventUpdate
+
+    data = []
+    dates = df["date"].to_numpy()
+    for field, name, colour in traces:
+        keep = lttb(dates, df[field].to_numpy(), MAX_POINTS)
+        data.append(
+            {
+                "x": df["date"].iloc[keep],
+                "y": df[field].iloc[keep],
+                "type": "scatter",
+                "name": name,
+                "marker": {"color": colour},
+            }
+        )
+    return {"data": data, "layout": layout}
 
 
 def body():
@@ -52,76 +154,71 @@ def body():
     Returns:
         html.Div: Dash layout
     """
-    df = get_ppm_df()
-    if df is None:
+    if app.mongo is None:
         return html.Div(
             dbc.Alert("Cannot retrieve data! Try again later!", color="danger")
         )
 
+    today = datetime.date.today()
     body = dbc.Container(
         [
             dbc.Row(
                 dbc.Col(
-                    dcc.Graph(
-                        id="number-graph",
-                        figure={
-                            "data": [
-                                {
-                                    "x": df["date"],
-                                    "y": df["total"],
-                                    "type": "scatter",
-                                    "name": "Total",
-                                    "marker": {"color": "#263025"},
-                                },
-                                {
-                                    "x": df["date"],
-                                    "y": df["on_time"],
-                                    "type": "scatter",
-                                    "name": "On Time",
-                                    "marker": {"color": "#a3eba0"},
-                                },
-                                {
-                                    "x": df["date"],
-                                    "y": df["late"],
-                                    "type": "scatter",
-                                    "name": "Late",
-                                    "marker": {"color": "#E7717D"},
-                                },
-                            ],
-                            "layout": {"title": "Number of Trains"},
-                        },
-                    ),
-                    width=12,
-                )
-            ),
-            dbc.Row(
-                dbc.Col(
-                    dcc.Graph(
-                        id="ppm-graph",
-                        figure={
-                            "data": [
-                                {
-                                    "x": df["date"],
-                                    "y": df["ppm"],
-                                    "type": "scatter",
-                                    "name": "PPM",
-                                    "marker": {"color": "#263025"},
-                                },
-                                {
-                                    "x": df["date"],
-                                    "y": df["rolling_ppm"],
-                                    "type": "scatter",
-                                    "name": "Rolling PPM",
-                                    "marker": {"color": "#E7717D"},
-                                },
-                            ],
-                            "layout": {"title": "Public Performance Measure (PPM)"},
-                        },
+                    dcc.DatePickerRange(
+                        id="ppm-dates",
+                        start_date=today - datetime.timedelta(days=DEFAULT_DAYS),
+                        end_date=today,
+                        max_date_allowed=today,
+                        display_format="YYYY-MM-DD",
                     ),
                     width=12,
                 )
             ),
+            dbc.Row(dbc.Col(dcc.Graph(id="number-graph"), width=12)),
+            dbc.Row(dbc.Col(dcc.Graph(id="ppm-graph"), width=12)),
         ],
         fluid=True,
     )
     return body
+
+
+@app.callback(
+    Output("number-graph", "figure"),
+    [
+        Input("ppm-dates", "start_date"),
+        Input("ppm-dates", "end_date"),
+        Input("number-graph", "relayoutData"),
+    ],
+)
+def update_number_graph(start_date, end_date, relayout):
+    """Update the number of trains graph.
+
+    Returns:
+        dict: graph figure
+    """
+    return get_figure(
+        "number-graph",
+        NUMBER_TRACES,
+        "Number of Trains",
+        start_date,
+        end_date,
+        relayout,
+    )
+
+
+@app.callback(
+    Output("ppm-graph", "figure"),
+    [
+        Input("ppm-dates", "start_date"),
+        Input("ppm-dates", "end_date"),
+        Input("ppm-graph", "relayoutData"),
+    ],
+)
+def update_ppm_graph(start_date, end_date, relayout):
+    """Update the public performance measure graph.
+
+    Returns:
+        dict: graph figure
+    """
+    title = "Public Performance Measure (PPM)"
+    return get_figure("ppm-graph", PPM_TRACES, title, start_date, end_date, relayout)
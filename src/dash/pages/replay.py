@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+"""Replay page layout module."""
+
+import datetime
+
+import dash_core_components as dcc
+import dash_bootstrap_components as dbc
+import dash_html_components as html
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from flask import Response, request
+
+from app import app
+from common import layers, replay
+from pages.graph import get_graph_map
+
+# URL the windows of frames are served from, see assets/replay.js
+FRAMES_URL = "/replay/frames.json"
+
+# Playback speeds offered, in replayed seconds per second
+SPEEDS = [1, 10, 60, 300]
+
+
+def window_params(args):
+    """Parse the start and length of a window of frames request.
+
+    Args:
+        args (werkzeug.datastructures.MultiDict): request arguments
+    Returns:
+        datetime.datetime: start of the window, None if the arguments are not valid
+        datetime.datetime: end of the window
+    """
+    try:
+        start = datetime.datetime.fromisoformat(args["start"])
+        length = datetime.timedelta(minutes=int(args["minutes"]))
+    except (KeyError, ValueError):
+        return None, None
+    if not datetime.timedelta(0) < length <= replay.MAX_WINDOW:
+        return None, None
+    return start, start + length
+
+
+@app.server.route(FRAMES_URL)
+def serve_frames():
+    """Serve a window of frames, or Not Modified if the browser has it cached.
+
+    Returns:
+        flask.Response: gzipped JSON window of frames
+    """
+    start, end = window_params(request.args)
+    if start is None:
+        return Response(status=400)
+    if app.mongo is None:
+        return Response(status=503)
+    window = replay.get_window(app.mongo, start, end)
+    if window is None:
+        return Response(status=503)
+
+    data, etag = layers.encode_layer(window)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(data, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+
+    # Windows only change while their frames are still being built
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def body():
+    """Get replay page body.
+
+    Returns:
+        html.Div: dash layout
+    """
+    if app.mongo is None:
+        return html.Div(
+            dbc.Alert("Cannot retrieve data! Try again later!", color="danger")
+        )
+
+    today = datetime.date.today()
+    marks = {minute: "{:02d}:00".format(minute // 60) for minute in range(0, 1440, 180)}
+    speeds = [{"label": "{}x".format(s), "value": s} for s in SPEEDS]
+    body = dbc.Container(
+        [
+            dbc.Row(
+                dbc.Col(
+                    dbc.Card(
+                        dbc.CardBody(
+                            html.P(
+                                "A replay of the train movements of a past day on "
+                                "the graph of the UK rail network. Pick a day and "
+                                "drag the slider to a time of day, then play the "
+                                "movements back at the chosen speed. Red nodes "
+                                "hold trains at the time shown."
+                            )
+                        ),
+                        color="secondary",
+                    ),
+                    width={"size": 10, "offset": 1},
+                )
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dcc.DatePickerSingle(
+                            id="replay-date",
+                            date=today - datetime.timedelta(days=1),
+                            min_date_allowed=today - replay.REPLAY_TTL,
+                            max_date_allowed=today,
+                            display_format="YYYY-MM-DD",
+                        ),
+                        width=2,
+                    ),
+                    dbc.Col(
+                        dcc.Slider(
+                            id="replay-time", min=0, max=1439, value=0, marks=marks
+                        ),
+                        width=6,
+                    ),
+                    dbc.Col(dbc.Button("Play / Pause", id="replay-play"), width=1),
+                    dbc.Col(
+                        dcc.RadioItems(
+                            id="replay-speed",
+                            options=speeds,
+                            value=60,
+                            labelStyle={"display": "inline-block"},
+                        ),
+                        width=2,
+                    ),
+                    dbc.Col(html.Span(id="replay-clock"), width=1),
+                ]
+            ),
+            dbc.Row(dbc.Col(dcc.Graph(id="replay-map", figure=get_graph_map()))),
+        ],
+        fluid=True,
+    )
+    return body
+
+
+# Seek, play and draw the replay in the browser
+app.clientside_callback(
+    ClientsideFunction(namespace="replay", function_name="update_figure"),
+    Output("replay-map", "figure"),
+    [
+        Input("replay-date", "date"),
+        Input("replay-time", "value"),
+        Input("replay-play", "n_clicks"),
+        Input("replay-speed", "value"),
+        Input("replay-map", "relayoutData"),
+    ],
+    [State("replay-map", "figure")],
+)
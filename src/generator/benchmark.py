@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark and parameter sweep harness for the graph generator.
+
+A frozen snapshot of the BERTHS and TRAINS collections is taken once and every
+benchmark run restores it into its own scratch database, so runs are repeatable
+and can happen in parallel. The wall time and peak allocated memory of every
+generator stage are taken from the run profile the generator records. A random
+sample of the fixed berths is held out as unfixed, and the layout is scored by
+how far from their known location those berths end up.
+
+The extraction of the edges from the TRAINS can also be timed on its own for
+different numbers of worker processes, to find the speedup on a given pod.
+
+Usage:
+    python benchmark.py snapshot snapshot.jsonl.gz
+    python benchmark.py sweep snapshot.jsonl.gz --k 1e-6 2e-6 --iter 1000 5000
+    python benchmark.py extract snapshot.jsonl.gz --workers 1 2 4 8
+"""
+
+import gzip
+import json
+import time
+import random
+import logging
+import argparse
+import itertools
+import concurrent.futures
+
+import numpy as np
+from bson import json_util
+
+from common.config import Config
+from common.mongo import Mongo
+from generator import TIPLOC_FILE, GraphGenerator, load_tiplocs
+
+
+log = logging.getLogger("generator_benchmark")
+
+# The collections making up a frozen snapshot
+SNAPSHOT_COLLECTIONS = ["BERTHS", "TRAINS"]
+
+
+def take_snapshot(mongo, path):
+    """Write the snapshot collections to a gzipped JSON lines file.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+        path (str): snapshot file path
+    """
+    with gzip.open(path, "wt") as snapshot_file:
+        for collection in SNAPSHOT_COLLECTIONS:
+            docs = mongo.get(collection, projection={"_id": 0})
+            if docs is None:
+                raise Exception("Could not read {}".format(collection))
+            for doc in docs:
+                line = {"collection": collection, "doc": doc}
+                snapshot_file.write(json_util.dumps(line) + "\n")
+
+
+def restore_snapshot(mongo, path, batch=1000):
+    """Restore a snapshot file into an empty database.
+
+    Args:
+        mongo (common.mongo.Mongo): database class for the scratch database
+        path (str): snapshot file path
+        batch (int): number of documents to insert at once
+    """
+    for collection in mongo.collections() or []:
+        mongo.drop(collection)
+
+    docs = {collection: [] for collection in SNAPSHOT_COLLECTIONS}
+    with gzip.open(path, "rt") as snapshot_file:
+        for line in snapshot_file:
+            line = json_util.loads(line)
+            docs[line["collection"]].append(line["doc"])
+            if len(docs[line["collection"]]) >= batch:
+                mongo.add_many(line["collection"], docs[line["collection"]])
+                docs[line["collection"]] = []
+    for collection, remaining in docs.items():
+        if remaining:
+            mongo.add_many(collection, remaining)
+
+
+def choose_holdout(path, fraction, seed):
+    """Choose a random sample of the fixed berths in a snapshot to hold out.
+
+    Args:
+        path (str): snapshot file path
+        fraction (float): fraction of the fixed berths to hold out
+        seed (int): random seed
+    Returns:
+        dict: held out berth names mapped to their known (lat, lon)
+    """
+    fixed = {}
+    with gzip.open(path, "rt") as snapshot_file:
+        for line in snapshot_file:
+            line = json_util.loads(line)
+            doc = line["doc"]
+            if line["collection"] == "BERTHS" and doc.get("FIXED"):
+                fixed[doc["NAME"]] = (doc["LATITUDE"], doc["LONGITUDE"])
+
+    names = sorted(fixed)
+    sample = random.Random(seed).sample(names, int(len(names) * fraction))
+    return {name: fixed[name] for name in sample}
+
+
+def position_error(graph, holdout):
+    """Score the layout by the position error of the held out berths.
+
+    Args:
+        graph (graph.CSRGraph): generated graph
+        holdout (dict): held out berth names mapped to their known (lat, lon)
+    Returns:
+        dict: number placed and the median, mean and p90 error in km
+    """
+    placed = [i for i, name in enumerate(graph.names.tolist()) if name in holdout]
+    score = {"holdout": len(holdout), "placed": len(placed)}
+    if len(placed) == 0:
+        return score
+
+    # Great circle distance between the generated and known locations
+    known = np.radians([holdout[name] for name in graph.names[placed].tolist()])
+    lat = np.radians(graph.lat[placed])
+    lon = np.radians(graph.lon[placed])
+    a = (
+        np.sin((lat - known[:, 0]) / 2) ** 2
+        + np.cos(lat) * np.cos(known[:, 0]) * np.sin((lon - known[:, 1]) / 2) ** 2
+    )
+    error = 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+    score["median_km"] = float(np.median(error))
+    score["mean_km"] = float(np.mean(error))
+    score["p90_km"] = float(np.percentile(error, 90))
+    return score
+
+
+def run_benchmark(task):
+    """Run the generator once against a restored snapshot.
+
+    Args:
+        task (dict): snapshot path, database, parameters and holdout
+    Returns:
+        dict: parameters, per stage results and layout score
+    """
+    mongo = Mongo.connect(log, task["uri"], task["database"])
+    if mongo is None:
+        raise ConnectionError
+
+    # Restore the frozen data and unfix the held out berths, also hiding their
+    # TIPLOC so the initial placement can't seed them at their true location
+    restore_snapshot(mongo, task["snapshot"])
+    selection = {"NAME": {"$in": list(task["holdout"])}}
+    update = {"$set": {"FIXED": False}, "$unset": {"TIPLOC": ""}}
+    mongo.update("BERTHS", selection, update, many=True)
+
+    params = task["params"]
+    gen = GraphGenerator(
+        log,
+        mongo,
+        params["k"],
+        params["iter"],
+        params["cut_d"],
+        params["scale"],
+        Config.GENERATOR_DELTA_B,
+        Config.GENERATOR_DELTA_T,
+        task["checkpoints"],
+        trace_memory=True,
+        layout=params["layout"],
+        tiplocs=load_tiplocs(task["tiplocs"]),
+    )
+    gen.create_indexes()
+    completed = gen.run()
+
+    result = {
+        "params": params,
+        "completed": completed,
+        "wall": gen.profile["WALL"],
+        "peak_mb": gen.profile["PEAK_MB"] or 0.0,
+        "stages": [
+            {"stage": s["NAME"], "wall": s["WALL"], "peak_mb": s["PEAK_MB"]}
+            for s in gen.profile["STAGES"]
+        ],
+    }
+    if completed:
+        result["score"] = position_error(gen.graph, task["holdout"])
+
+    for collection in mongo.collections() or []:
+        mongo.drop(collection)
+    return result
+
+
+def sweep(args):
+    """Run the generator over a grid of parameters in parallel.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+    Returns:
+        [dict]: results of each run
+    """
+    holdout = choose_holdout(args.snapshot, args.holdout, args.seed)
+    grid = itertools.product(args.k, args.iter, args.cut_d, args.scale, args.layout)
+    tasks = []
+    for i, (k, iterations, cut_d, scale, layout) in enumerate(grid):
+        for repeat in range(args.repeats):
+            tasks.append(
+                {
+                    "uri": args.uri,
+                    "database": "{}_{}_{}".format(args.database, i, repeat),
+                    "snapshot": args.snapshot,
+                    "checkpoints": args.checkpoints,
+                    "tiplocs": args.tiplocs,
+                    "holdout": holdout,
+                    "params": {
+                        "k": k,
+                        "iter": iterations,
+                        "cut_d": cut_d,
+                        "scale": scale,
+                        "layout": layout,
+                    },
+                }
+            )
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        return list(pool.map(run_benchmark, tasks))
+
+
+def extract(args):
+    """Time the edge extraction from the TRAINS with different worker counts.
+
+    Args:
+        args (argparse.Namespace): command line arguments
+    Returns:
+        [dict]: worker count, wall time and number of edges of each run
+    """
+    mongo = Mongo.connect(log, args.uri, args.database)
+    if mongo is None:
+        raise ConnectionError
+    restore_snapshot(mongo, args.snapshot)
+
+    results = []
+    for workers in args.workers:
+        for repeat in range(args.repeats):
+            # Start from empty edge statistics so every run does the same work
+            mongo.drop("EDGES")
+            mongo.drop("GENERATOR_STATE")
+            gen = GraphGenerator(
+                log,
+                mongo,
+                Config.GENERATOR_K,
+                Config.GENERATOR_ITER,
+                Config.GENERATOR_CUT_D,
+                Config.GENERATOR_SCALE,
+                Config.GENERATOR_DELTA_B,
+                Config.GENERATOR_DELTA_T,
+                trace_memory=False,
+                chunk_size=args.chunk_size,
+                workers=workers,
+            )
+            start = time.perf_counter()
+            _, src, dst = gen.get_train_edges()
+            wall = time.perf_counter() - start
+            edges = len(set(zip(src, dst)))
+            results.append({"workers": workers, "wall": wall, "edges": edges})
+
+    for collection in mongo.collections() or []:
+        mongo.drop(collection)
+    return results
+
+
+def print_extract(results):
+    """Print a table of the median extraction time for each worker count.
+
+    Args:
+        results ([dict]): results of each run
+    """
+    walls = {}
+    for result in results:
+        walls.setdefault(result["workers"], []).append(result["wall"])
+    baseline = float(np.median(walls[min(walls)]))
+
+    row = "{:>8} {:>9} {:>8} {:>8}"
+    print(row.format("workers", "wall_s", "speedup", "edges"))
+    for workers in sorted(walls):
+        wall = float(np.median(walls[workers]))
+        edges = {r["edges"] for r in results if r["workers"] == workers}
+        print(
+            row.format(
+                workers,
+                "{:.2f}".format(wall),
+                "{:.2f}x".format(baseline / wall),
+                "/".join(str(e) for e in sorted(edges)),
+            )
+        )
+
+
+def print_results(results):
+    """Print a table of the sweep results, fastest first.
+
+    Args:
+        results ([dict]): results of each run
+    """
+    row = "{:>10} {:>6} {:>6} {:>8} {:>10} {:>9} {:>9} {:>7} {:>9} {:>9}"
+    print(
+        row.format(
+            "k",
+            "iter",
+            "cut_d",
+            "scale",
+            "layout",
+            "wall_s",
+            "peak_mb",
+            "placed",
+            "med_km",
+            "p90",
+        )
+    )
+    for result in sorted(results, key=lambda r: r["wall"]):
+        params = result["params"]
+        score = result.get("score", {})
+        print(
+            row.format(
+                "{:g}".format(params["k"]),
+                params["iter"],
+                "{:g}".format(params["cut_d"]),
+                params["scale"],
+                params["layout"],
+                "{:.2f}".format(result["wall"]),
+                "{:.1f}".format(result["peak_mb"]),
+                score.get("placed", 0),
+                "{:.3f}".format(score.get("median_km", float("nan"))),
+                "{:.3f}".format(score.get("p90_km", float("nan"))),
+            )
+        )
+
+
+def main():
+    """Call when the benchmark is run from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--uri", default=Config.MONGO_URI, help="MongoDB URI")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log stages")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    snapshot = commands.add_parser("snapshot", help="freeze the current data")
+    snapshot.add_argument("snapshot", help="snapshot file to write")
+
+    run = commands.add_parser("sweep", help="benchmark a grid of parameters")
+    run.add_argument("snapshot", help="snapshot file to read")
+    run.add_argument("--k", type=float, nargs="+", default=[Config.GENERATOR_K])
+    run.add_argument("--iter", type=int, nargs="+", default=[Config.GENERATOR_ITER])
+    run.add_argument("--cut-d", type=float, nargs="+", default=[Config.GENERATOR_CUT_D])
+    run.add_argument("--scale", type=int, nargs="+", default=[Config.GENERATOR_SCALE])
+    run.add_argument(
+        "--layout",
+        nargs="+",
+        choices=["spring", "multilevel"],
+        default=[Config.GENERATOR_LAYOUT],
+    )
+    run.add_argument("--holdout", type=float, default=0.1, help="fixed berth fraction")
+    run.add_argument("--seed", type=int, default=0, help="holdout random seed")
+    run.add_argument("--repeats", type=int, default=1, help="runs per parameter set")
+    run.add_argument("--workers", type=int, default=1, help="parallel runs")
+    run.add_argument("--database", default="thetrains_benchmark")
+    run.add_argument("--tiplocs", default=TIPLOC_FILE, help="TIPLOC locations")
+    run.add_argument("--checkpoints", default="", help="shared checkpoint directory")
+    run.add_argument("--output", help="write the full results as JSON")
+
+    timing = commands.add_parser("extract", help="time the parallel edge extraction")
+    timing.add_argument("snapshot", help="snapshot file to read")
+    timing.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    timing.add_argument("--repeats", type=int, default=3, help="runs per worker count")
+    timing.add_argument("--chunk-size", type=int, default=Config.GENERATOR_CHUNK_SIZE)
+    timing.add_argument("--database", default="thetrains_benchmark")
+    timing.add_argument("--output", help="write the full results as JSON")
+
+    args = parser.parse_args()
+    Config.init_logging(log)
+    log.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    if args.command == "snapshot":
+        mongo = Mongo.connect(log, args.uri)
+        if mongo is None:
+            raise ConnectionError
+        take_snapshot(mongo, args.snapshot)
+        return
+
+    # Every run wipes its scratch database so never let it be the live one
+    if args.database == "thetrains":
+        parser.error("the benchmark database can't be the live thetrains database")
+
+    if args.command == "extract":
+        results = extract(args)
+        print_extract(results)
+    else:
+        results = sweep(args)
+        print_results(results)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the on disk checkpoint cache for the graph generator stages.
+
+After each stage of the generator the intermediate graph is written as a
+compressed NumPy archive holding its node attribute and CSR adjacency arrays.
+Each checkpoint is keyed by a hash of the data watermark and the parameters of
+every stage up to and including it, so a run can resume from the deepest stage
+that would have produced exactly the same graph.
+"""
+
+import os
+import glob
+import json
+import hashlib
+
+import numpy as np
+
+
+def stage_keys(watermark, stages):
+    """Get the cumulative checkpoint key for each stage.
+
+    Args:
+        watermark (dict): description of the data the graph is built from
+        stages ([(str, dict)]): stage names and parameters in run order
+    Returns:
+        [str]: checkpoint key for each stage
+    """
+    keys = []
+    digest = hashlib.sha1(json.dumps(watermark, sort_keys=True, default=str).encode())
+    for name, params in stages:
+        digest.update(json.dumps([name, params], sort_keys=True).encode())
+        keys.append("{}-{}".format(name, digest.hexdigest()[:16]))
+    return keys
+
+
+class CheckpointCache(object):
+    """Directory of compressed graph checkpoints keyed by stage."""
+
+    def __init__(self, log, directory, max_files=64):
+        """Initialise CheckpointCache.
+
+        Args:
+            log (logging.logger): Logger to use
+            directory (str): Directory to store checkpoints, disabled if empty
+            max_files (int): Maximum number of checkpoints to keep
+        """
+        self.log = log
+        self.directory = directory
+        self.max_files = max_files
+        if self.enabled():
+            os.makedirs(self.directory, exist_ok=True)
+
+    def enabled(self):
+        """Check if checkpointing is enabled.
+
+        Returns:
+            bool: True if checkpoints are read and written
+        """
+        return bool(self.directory)
+
+    def path(self, key):
+        """Get the checkpoint file path for a key.
+
+        Args:
+            key (str): stage checkpoint key
+        Returns:
+            str: checkpoint file path
+        """
+        return os.path.join(self.directory, "{}.npz".format(key))
+
+    def has(self, key):
+        """Check if a checkpoint exists for a key.
+
+        Args:
+            key (str): stage checkpoint key
+        Returns:
+            bool: True if the checkpoint exists
+        """
+        return self.enabled() and os.path.exists(self.path(key))
+
+    def load(self, key):
+        """Load the graph arrays checkpointed for a key.
+
+        Args:
+            key (str): stage checkpoint key
+        Returns:
+            dict: checkpointed graph arrays, None if they can't be loaded
+        """
+        try:
+            with np.load(self.path(key), allow_pickle=False) as arrays:
+                return {name: arrays[name] for name in arrays.files}
+        except Exception as e:
+            self.log.warning("Could not load checkpoint {} ({})".format(key, e))
+            return None
+
+    def resume(self, keys):
+        """Load the deepest checkpoint of a run that can be loaded.
+
+        Args:
+            keys ([str]): checkpoint key for each stage in run order
+        Returns:
+            int: index of the first stage that still needs to run
+            dict: graph arrays of the checkpoint resumed from, None if none
+        """
+        for i in reversed(range(len(keys))):
+            if not self.has(keys[i]):
+                continue
+            arrays = self.load(keys[i])
+            if arrays is not None:
+                self.log.info("Resuming from checkpoint {}".format(keys[i]))
+                return i + 1, arrays
+        return 0, None
+
+    def save(self, key, arrays):
+        """Checkpoint the graph arrays for a key.
+
+        Args:
+            key (str): stage checkpoint key
+            arrays (dict): graph arrays to checkpoint
+        """
+        if not self.enabled():
+            return
+
+        # Write to a temporary file first so a partial file is never loaded
+        path = self.path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as checkpoint_file:
+                np.savez_compressed(checkpoint_file, **arrays)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.log.warning("Could not save checkpoint {} ({})".format(key, e))
+            return
+        self.prune()
+
+    def prune(self):
+        """Remove the oldest checkpoints above the maximum number of files."""
+        paths = sorted(
+            glob.glob(os.path.join(self.directory, "*.npz")), key=os.path.getmtime
+        )
+        for path in paths[: max(len(paths) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
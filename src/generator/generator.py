@@ -6,30 +6,105 @@ import sys
 import signal
 import time
 import logging
+import json
 import functools
-import math
 import datetime
+import concurrent.futures
 
-import pandas as pd
-import networkx as nx
+import numpy as np
 
+from common import replay
+from common.berths import BerthClass, classes_expression
 from common.config import Config
+from common.geo import osgb_to_wgs84
+from common.journeys import segment_trains
+from common.layers import publish_static_layer
 from common.mongo import Mongo
+from common.sketch import QuantileSketch
+from checkpoint import CheckpointCache, stage_keys
+from graph import CSRGraph
+from layout import (
+    edge_temperature,
+    harmonic_placement,
+    multilevel_layout,
+    spring_layout,
+)
+from profiling import RunProfiler
+from retention import RetentionCompactor
+from scheduler import RunScheduler
 
 
 log = logging.getLogger("graph_generator")
 
+# Only the fields of the BERTHS we need to build the graph
+BERTH_PROJECTION = {"_id": 0, "NAME": 1, "FIXED": 1, "LATITUDE": 1, "LONGITUDE": 1}
+
+# TIPLOC locations as OSGB eastings and northings
+TIPLOC_FILE = "./tiploc.json"
+
+# Pair up the berths and times of each train and keep only the steps through
+# real berths, as classified by the collector or here if the train's classes do
+# not line up with its berths. We need at least three steps as
+# the first one is always dropped. Each step is then streamed as a document of
+# its own, with the steps of a train together and in order, so they can be read
+# in fixed size chunks, along with the time the train's edges are counted up to
+TRAIN_PIPELINE = [
+    {
+        "$project": {
+            "COUNTED": 1,
+            "STEPS": {
+                "$map": {
+                    "input": {
+                        "$filter": {
+                            "input": {
+                                "$zip": {
+                                    "inputs": [
+                                        "$BERTHS",
+                                        "$TIMES",
+                                        classes_expression("$BERTHS", "$CLASSES"),
+                                    ]
+                                }
+                            },
+                            "as": "step",
+                            "cond": {
+                                "$eq": [
+                                    {"$arrayElemAt": ["$$step", 2]},
+                                    int(BerthClass.REAL),
+                                ]
+                            },
+                        }
+                    },
+                    "as": "step",
+                    "in": {"$slice": ["$$step", 2]},
+                }
+            },
+        }
+    },
+    {"$match": {"STEPS.2": {"$exists": True}}},
+    {"$unwind": "$STEPS"},
+    {
+        "$project": {
+            "_id": 0,
+            "TRAIN": "$_id",
+            "BERTH": {"$arrayElemAt": ["$STEPS", 0]},
+            "TIME": {"$arrayElemAt": ["$STEPS", 1]},
+            "COUNTED": 1,
+        }
+    },
+]
+
 
 def timer(func):
-    """Print the runtime of the decorated function."""
+    """Log the runtime of the decorated method and add it to the run profile."""
 
     @functools.wraps(func)
-    def wrapper_timer(*args, **kwargs):
+    def wrapper_timer(self, *args, **kwargs):
         start_time = time.perf_counter()
-        return_value = func(*args, **kwargs)
+        return_value = func(self, *args, **kwargs)
         end_time = time.perf_counter()
         run_time = end_time - start_time
         log.info(f"Completed {func.__name__!r} in {run_time:.4f} secs")
+        self.profiler.step(func.__name__, run_time)
         return return_value
 
     return wrapper_timer
@@ -48,6 +123,16 @@ class GraphGenerator(object):
         scale,
         delta_b,
         delta_t,
+        checkpoints="",
+        trace_memory=False,
+        profile_dir="",
+        collector_edges=False,
+        retention_hours=0,
+        rollup_days=90,
+        layout="spring",
+        tiplocs=None,
+        chunk_size=20000,
+        workers=1,
     ):
         """Initialise GraphGenerator.
 
@@ -60,6 +145,16 @@ class GraphGenerator(object):
             scale (int): Coordinate scaling for spring layout optimisation
             delta_b (int): Berths within delta seconds will be classed as the same
             delta_t (int): Split train data when there is a gap of delta hours
+            checkpoints (str): Directory for stage checkpoints, disabled if empty
+            trace_memory (bool): Record the peak allocated memory of each stage
+            profile_dir (str): Directory for stage cProfile dumps, disabled if empty
+            collector_edges (bool): Build the graph from the collector's EDGES
+            retention_hours (int): Hours of raw TRAINS steps to keep, all if 0
+            rollup_days (int): Days of hourly movement aggregates to keep
+            layout (str): Layout algorithm, either spring or multilevel
+            tiplocs (dict): TIPLOC names mapped to (latitude, longitude)
+            chunk_size (int): Train steps read and segmented at a time
+            workers (int): Processes segmenting shards of the TRAINS in parallel
         """
         self.log = log
         self.mongo = mongo
@@ -69,7 +164,18 @@ class GraphGenerator(object):
         self.scale = scale
         self.delta_b = delta_b
         self.delta_t = delta_t
+        self.collector_edges = collector_edges
+        self.layout = layout
+        self.tiplocs = tiplocs if tiplocs is not None else {}
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retention = RetentionCompactor(
+            log, mongo, retention_hours, rollup_days, delta_b, delta_t
+        )
         self.clean_delta = 2
+        self.checkpoints = CheckpointCache(log, checkpoints)
+        self.profiler = RunProfiler(trace_memory, profile_dir)
+        self.graph = None
         self.log.info(
             "k: {}, iter: {}, cut_d:{}, scale: {}, delta_b: {}, delta_t: {}".format(
                 k, iter, cut_d, scale, delta_b, delta_t
@@ -77,294 +183,605 @@ class GraphGenerator(object):
         )
 
     def run(self):
-        """Build, tidy, and layout the graph."""
+        """Build, tidy, and layout the graph.
+
+        Returns:
+            bool: True if the generation completed
+        """
         self.log.info("Starting graph generation at {}".format(time.ctime()))
+        completed = False
+        self.graph = None
+        self.profiler.start()
         try:
-            # 1) Clean berths to remove stale train records
-            self.clean_berths()
+            # 1) Clean berths to remove stale train records and update activity
+            self.run_stage(
+                "clean", [(self.clean_berths, {}), (self.update_berth_activity, {})]
+            )
+
+            # 2-8) Build, tidy and layout the graph, resuming from a checkpoint
+            stages = self.stages()
+            keys = self.stage_keys(stages)
+            start = self.resume(keys)
+            for (name, steps, params), key in zip(stages[start:], keys[start:]):
+                self.run_stage(name, steps)
+                self.checkpoints.save(key, self.graph.to_arrays())
+
+            # 10) Update the berth layout in the database, replay the new steps
+            # into frames and compact the TRAINS history now every movement in it
+            # has been counted
+            self.run_stage(
+                "update",
+                [
+                    (self.update_berths, {}),
+                    (self.update_replay_frames, {}),
+                    (self.compact_trains, {}),
+                ],
+            )
+            completed = True
+        except Exception as e:
+            self.log.warning("Could not complete generation: {}".format(e))
+
+        self.profile = self.profiler.finish(completed, self.params())
+        self.mongo.add("GENERATOR_RUNS", dict(self.profile))
+        self.log.info("Graph generation completed at {}".format(time.ctime()))
+        return completed
+
+    def run_stage(self, name, steps):
+        """Run the steps that make up a single stage.
 
-            # 2) Get all the berths, non are isolated as they are all connected
-            self.get_berths()
+        Args:
+            name (str): stage name
+            steps ([(callable, dict)]): methods and their keyword arguments
+        """
+        with self.profiler.stage(name, self.graph_size):
+            for step, kwargs in steps:
+                step(**kwargs)
 
-            # 3) Get the single largest connected network
-            self.get_largest_network()
+    def graph_size(self):
+        """Get the current size of the graph.
 
-            # 4) Run the first layout iteration
-            self.run_layout(all_nodes=False)
+        Returns:
+            int: number of nodes, None before the graph is built
+            int: number of edges, None before the graph is built
+        """
+        if self.graph is None:
+            return None, None
+        return self.graph.number_of_nodes(), self.graph.number_of_edges()
 
-            # 5) Remove long edges, isolated nodes and get largest network
-            self.remove_distant_nodes(only_fixed=False)
-            self.remove_isolated_nodes()
-            self.get_largest_network()
+    def params(self):
+        """Get the generator parameters recorded with each run.
 
-            # 6) Run the second layout iteration
-            self.run_layout(all_nodes=True)
+        Returns:
+            dict: generator parameters
+        """
+        return {
+            "k": self.k,
+            "iter": self.iter,
+            "cut_d": self.cut_d,
+            "scale": self.scale,
+            "layout": self.layout,
+            "delta_b": self.delta_b,
+            "delta_t": self.delta_t,
+        }
+
+    def stages(self):
+        """Get the checkpointed stages that build, tidy and layout the graph.
+
+        Returns:
+            [(str, [(callable, dict)], dict)]: stage names, steps and parameters
+        """
+        layout = {
+            "k": self.k,
+            "iter": self.iter,
+            "scale": self.scale,
+            "layout": self.layout,
+        }
+        return [
+            # 2) Get all the berths, non are isolated as they are all connected,
+            # then get the single largest connected network
+            (
+                "berths",
+                [(self.get_berths, {}), (self.get_largest_network, {})],
+                {
+                    "delta_b": self.delta_b,
+                    "delta_t": self.delta_t,
+                    "collector_edges": self.collector_edges,
+                },
+            ),
+            # 3) Remove the branches that do not lead between fixed nodes
+            ("prune", [(self.remove_floating_nodes, {})], {}),
+            # 4) Seed the unfixed berths from their TIPLOC or fixed neighbours
+            ("place", [(self.place_berths, {})], {}),
+            # 5) Run the first layout iteration
+            ("layout_1", [(self.run_layout, {})], layout),
+            # 6) Remove long edges, isolated nodes and get largest network
+            (
+                "cut_1",
+                [
+                    (self.remove_distant_nodes, {"only_fixed": False}),
+                    (self.remove_isolated_nodes, {}),
+                    (self.get_largest_network, {}),
+                ],
+                {"cut_d": self.cut_d},
+            ),
+            # 7) Run the second layout iteration
+            ("layout_2", [(self.run_layout, {})], layout),
+            # 8) Remove long edges, isolated nodes and get largest network
+            (
+                "cut_2",
+                [
+                    (self.remove_distant_nodes, {"only_fixed": False, "cut_d": 0.15}),
+                    (self.remove_isolated_nodes, {}),
+                    (self.get_largest_network, {}),
+                ],
+                {"cut_d": 0.15},
+            ),
+            # 9) Run the third layout iteration
+            ("layout_3", [(self.run_layout, {})], layout),
+        ]
+
+    def stage_keys(self, stages):
+        """Get the checkpoint key for each stage.
 
-            # 7) Remove long edges, isolated nodes and get largest network
-            self.cut_d = 0.15
-            self.remove_distant_nodes(only_fixed=False)
-            self.remove_isolated_nodes()
-            self.get_largest_network()
+        Args:
+            stages ([(str, [(callable, dict)], dict)]): stages from stages()
+        Returns:
+            [str]: checkpoint key for each stage, None if checkpoints are disabled
+        """
+        if not self.checkpoints.enabled():
+            return [None] * len(stages)
+        return stage_keys(
+            self.get_data_watermark(), [(name, params) for name, _, params in stages]
+        )
 
-            # 8) Run the third layout iteration
-            self.run_layout(all_nodes=True)
+    def get_data_watermark(self):
+        """Get a description of the current berth and movement data.
 
-            # 9) Update the berth layout in the database
-            self.update_berths()
-        except Exception as e:
-            self.log.warning("Could not complete generation: {}".format(e))
+        Returns:
+            dict: latest berth update time and the berth counts
+        """
+        pipeline = [
+            {
+                "$group": {
+                    "_id": None,
+                    "LATEST_TIME": {"$max": "$LATEST_TIME"},
+                    "BERTHS": {"$sum": 1},
+                    "FIXED": {"$sum": {"$cond": ["$FIXED", 1, 0]}},
+                }
+            }
+        ]
+        result = self.mongo.aggregate("BERTHS", pipeline)
+        if result is None:
+            raise Exception("Could not get the BERTH data watermark!")
+        for doc in result:
+            return doc
+        return {}
 
-        self.log.info("Graph generation completed at {}".format(time.ctime()))
+    def resume(self, keys):
+        """Load the graph from the deepest stage with a valid checkpoint.
+
+        Args:
+            keys ([str]): checkpoint key for each stage
+        Returns:
+            int: index of the first stage that still needs to run
+        """
+        start, arrays = self.checkpoints.resume(keys)
+        if arrays is not None:
+            self.graph = CSRGraph.from_arrays(arrays)
+        return start
+
+    def create_indexes(self):
+        """Create the database indexes the generator relies on."""
+        self.mongo.create_index("EDGES", [("FROM", 1), ("TO", 1)], unique=True)
+        self.mongo.create_index("GENERATOR_STATE", [("NAME", 1)], unique=True)
+        self.mongo.create_index("GENERATOR_RUNS", [("START", -1)])
+        replay.create_indexes(self.mongo)
+        if self.retention.enabled():
+            self.retention.create_indexes()
 
     @timer
     def clean_berths(self):
         """Clean the database berths to remove stale train records."""
-        # Get the BERTHS and TRAINS from the database
-        berths = self.mongo.get("BERTHS")
-        if berths is None:
-            raise Exception("BERTH or TRAIN data is empty!")
-
-        # Get the current time and delta
-        time_now = datetime.datetime.now()
-        time_delta = datetime.timedelta(hours=self.clean_delta)
-
-        num_cleaned = 0
-        for berth in berths:
-            if "LATEST_TIME" in berth:
-                if (time_now - berth["LATEST_TIME"]) > time_delta:
-                    num_cleaned += 1
-                    update = {
-                        "$set": {
-                            "LATEST_TRAIN": "0000",
-                            "LATEST_TIME": berth["LATEST_TIME"],
-                        }
-                    }
-                    self.mongo.update("BERTHS", {"NAME": berth["NAME"]}, update)
+        # Select occupied berths that have not been updated within the clean delta
+        cutoff = datetime.datetime.now() - datetime.timedelta(hours=self.clean_delta)
+        selection = {"LATEST_TIME": {"$lt": cutoff}, "LATEST_TRAIN": {"$ne": "0000"}}
+        update = {"$set": {"LATEST_TRAIN": "0000"}}
+
+        # Let the database clear them all in one go
+        result = self.mongo.update("BERTHS", selection, update, many=True, upsert=False)
+        if result is None:
+            raise Exception("Could not clean BERTH data!")
+
+        self.log.info("Cleaned {} berths".format(result.modified_count))
 
-        self.log.info("Cleaned {} berths".format(num_cleaned))
+    @timer
+    def update_berth_activity(self):
+        """Aggregate the per berth last seen time and movement count."""
+        pipeline = [
+            {
+                "$project": {
+                    "_id": 0,
+                    "STEPS": {"$zip": {"inputs": ["$BERTHS", "$TIMES"]}},
+                }
+            },
+            {"$unwind": "$STEPS"},
+            {
+                "$group": {
+                    "_id": {"$arrayElemAt": ["$STEPS", 0]},
+                    "LAST_SEEN": {"$max": {"$arrayElemAt": ["$STEPS", 1]}},
+                    "MOVEMENTS": {"$sum": 1},
+                }
+            },
+            {"$merge": {"into": "BERTH_ACTIVITY", "whenMatched": "replace"}},
+        ]
+
+        # The $merge stage writes the result server side, nothing is returned
+        if self.mongo.aggregate("TRAINS", pipeline) is None:
+            raise Exception("Could not aggregate BERTH activity!")
 
     @timer
     def get_berths(self):
         """Generate the initial graph from the berths stored in the database."""
-        # Get the BERTHS and TRAINS from the database
-        berths = {berth["NAME"]: berth for berth in self.mongo.get("BERTHS")}
-        trains = self.mongo.get("TRAINS")
-        if berths is None or trains is None:
-            raise Exception("BERTH or TRAIN data is empty!")
-
-        self.graph = nx.Graph()
-        for train in trains:
-            # Create and tidy the dataframe
-            t = pd.DataFrame(train)
-            t = t.drop(["_id", "NAME"], axis=1)
-
-            # Check BERTHS and remove ones we don't want to use...
-            t = t[
-                t["BERTHS"].str.len() == 6
-            ]  # Check berth name length is equal to 6 characters
-            # Remove `STrike IN' berths
-            t = t[~t["BERTHS"].str.endswith("STIN")]
-            # Remove `Clear OUT' berths
-            t = t[~t["BERTHS"].str.endswith("COUT")]
-            # Remove current date berths
-            t = t[~t["BERTHS"].str.endswith("DATE")]
-            # Remove current time berths
-            t = t[~t["BERTHS"].str.endswith("TIME")]
-            # Remove current clock berths
-            t = t[~t["BERTHS"].str.endswith("CLCK")]
-            # Remove `Last Sent' berths
-            t = t[~t["BERTHS"].str.slice(start=2, stop=4).str.contains("LS")]
-            t = t[~t["BERTHS"].str.endswith("LS")]  # Remove `Last Sent' berths
-            # Remove `Train Reporting' link status berths
-            t = t[~t["BERTHS"].str.slice(start=2, stop=4).str.contains("TR")]
-            # Remove SMART link status berths
-            t = t[~t["BERTHS"].str.slice(start=2, stop=5).str.contains("SMT")]
-
-            # Calculate the delta times between berths...
-            t["DELTAS"] = t["TIMES"] - t["TIMES"].shift()
-
-            # Remove first berth as we have no context to make a decision about it...
-            t = t.iloc[1:]
-
-            # Assuming that the real TD berth is always reported first, we can get rid
-            # of all duplicate/fringe/waiting berths. Should probably uodate this as it
-            # is most likely not always the case, so need to check other same timed
-            # berths and use the most appropriate one, from the last three digits.
-            t = t[t["DELTAS"] >= datetime.timedelta(seconds=self.delta_b)]
-            t = t.reset_index()
-
-            # Remove duplicates of berths next to each other if exist
-            t = t.loc[t["BERTHS"].shift(-1) != t["BERTHS"]]
-
-            # Split the full train dataframe when there are large differences in time
-            splits = t.index[
-                t["DELTAS"] >= datetime.timedelta(hours=self.delta_t)
-            ].tolist()
-            splits.insert(0, 0)
-            splits.append(len(t.index))
-            paths = [
-                t.iloc[splits[n] : splits[n + 1]]  # noqa: E203
-                for n in range(len(splits) - 1)
-            ]
-            for path in paths:
-                for b_from, b_to, delta in zip(
-                    path["BERTHS"], path["BERTHS"][1:], path["DELTAS"][1:]
-                ):
-                    # Add the from berth to the graph
-                    if berths[b_from]["FIXED"]:
-                        self.graph.add_node(
-                            b_from,
-                            lon=berths[b_from]["LONGITUDE"],
-                            lat=berths[b_from]["LATITUDE"],
-                            fixed=True,
-                        )
-                    else:
-                        self.graph.add_node(b_from, lon=None, lat=None, fixed=False)
-
-                    # Add the to berth to the graph
-                    if berths[b_to]["FIXED"]:
-                        self.graph.add_node(
-                            b_to,
-                            lon=berths[b_to]["LONGITUDE"],
-                            lat=berths[b_to]["LATITUDE"],
-                            fixed=True,
-                        )
-                    else:
-                        self.graph.add_node(b_to, lon=None, lat=None, fixed=False)
-
-                    # Add the edge linking the berths to the graph
-                    # Could use the delta in the future to weight edge
-                    self.graph.add_edge(b_from, b_to, weight=1.0)
-
-        self.log.info("Nodes from db {}".format(len(self.graph.nodes)))
+        # Get the fixed real BERTHS from the database, only fetching the fields
+        # we use, as the rest have no location yet
+        selection = {"CLASS": int(BerthClass.REAL), "FIXED": True}
+        berths = self.mongo.get("BERTHS", selection, BERTH_PROJECTION)
+        if berths is None:
+            raise Exception("BERTH data is empty!")
+        berths = {berth["NAME"]: berth for berth in berths}
+
+        # Get the edges segmented by the collector or segment the TRAINS here
+        if self.collector_edges:
+            index, src, dst = self.get_collected_edges()
+        else:
+            index, src, dst = self.get_train_edges()
+
+        # Only fixed berths start with a known location
+        names = list(index)
+        fixed = np.array([name in berths for name in names], dtype=bool)
+        lat = np.full(len(names), np.nan)
+        lon = np.full(len(names), np.nan)
+        for i in np.flatnonzero(fixed):
+            lat[i] = berths[names[i]]["LATITUDE"]
+            lon[i] = berths[names[i]]["LONGITUDE"]
+        self.graph = CSRGraph.from_edges(names, lat, lon, fixed, src, dst)
+
+        self.log.info("Nodes from db {}".format(self.graph.number_of_nodes()))
+
+        # Use the traversal times to weight the edges
+        self.weight_edges()
+
+    def get_collected_edges(self, index=None, src=None, dst=None):
+        """Get every edge with stored traversal time statistics.
+
+        Args:
+            index (dict): existing berth node ids to add to
+            src ([int]): existing edge source node ids to add to
+            dst ([int]): existing edge destination node ids to add to
+        Returns:
+            dict: berth names mapped to integer node ids
+            [int]: edge source node ids
+            [int]: edge destination node ids
+        """
+        edges = self.mongo.get("EDGES", projection={"_id": 0, "FROM": 1, "TO": 1})
+        if edges is None:
+            raise Exception("EDGE data is empty!")
+
+        index = index if index is not None else {}
+        src = src if src is not None else []
+        dst = dst if dst is not None else []
+        for edge in edges:
+            src.append(index.setdefault(edge["FROM"], len(index)))
+            dst.append(index.setdefault(edge["TO"], len(index)))
+        return index, src, dst
+
+    def get_train_edges(self):
+        """Segment the full TRAINS history into edges.
+
+        The steps are read and segmented in chunks, either here or split into
+        shards of trains across a pool of worker processes. The traversal times
+        each train has confirmed since its edges were last counted are added to
+        the stored edge statistics.
+
+        Returns:
+            dict: berth names mapped to integer node ids
+            [int]: edge source node ids
+            [int]: edge destination node ids
+        """
+        # Trains counted before they kept their own progress share the old
+        # global watermark, which is no longer moved on
+        watermark = self.get_watermark("EDGES")
+        task = {
+            "delta_b": self.delta_b,
+            "delta_t": self.delta_t,
+            "chunk_size": self.chunk_size,
+            "watermark": watermark,
+        }
+        if self.workers > 1 and self.mongo.uri is not None:
+            results = self.extract_parallel(task)
+        else:
+            # Let the database drop the steps through pseudo berths
+            steps = self.mongo.aggregate("TRAINS", TRAIN_PIPELINE, self.chunk_size)
+            if steps is None:
+                raise Exception("TRAIN data is empty!")
+            results = [segment_trains(steps, **task)]
+
+        # Give each berth an integer node id and merge the new traversal times
+        index, src, dst = {}, [], []
+        sketches, progress = {}, {}
+        for names, edges, new_sketches, new_progress in results:
+            ids = np.array(
+                [index.setdefault(name, len(index)) for name in names.tolist()],
+                dtype=np.int64,
+            )
+            src.extend(ids[edges[:, 0]].tolist())
+            dst.extend(ids[edges[:, 1]].tolist())
+            for key, sketch in new_sketches.items():
+                if key in sketches:
+                    sketches[key].merge(sketch)
+                else:
+                    sketches[key] = sketch
+            progress.update(new_progress)
+
+        # Store the new traversal times
+        self.update_edge_stats(sketches, progress)
+
+        # Steps older than the retention window only remain as edge statistics
+        if self.retention.enabled():
+            return self.get_collected_edges(index, src, dst)
+        return index, src, dst
+
+    def extract_parallel(self, task):
+        """Segment the TRAINS in shards across a pool of worker processes.
+
+        Trains are assigned to shards by the hash of their name, and each
+        worker reads its own shard from the database.
+
+        Args:
+            task (dict): segmentation parameters shared by every shard
+        Returns:
+            [(np.ndarray, np.ndarray, dict, dict)]: results of
+                segment_trains for each shard
+        """
+        tasks = [
+            dict(
+                task,
+                uri=self.mongo.uri,
+                database=self.mongo.client.name,
+                shard=shard,
+                shards=self.workers,
+            )
+            for shard in range(self.workers)
+        ]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(extract_shard, tasks))
+
+    def get_watermark(self, name):
+        """Get the latest movement time already processed for a named stage.
+
+        Args:
+            name (str): GENERATOR_STATE document name
+        Returns:
+            datetime.datetime: latest processed time, None if never run
+        """
+        state = self.mongo.get("GENERATOR_STATE", {"NAME": name})
+        if state is None:
+            return None
+        for doc in state:
+            return doc.get("LATEST_TIME")
+        return None
+
+    def update_edge_stats(self, sketches, progress):
+        """Merge new traversal time observations into the stored edge statistics.
+
+        Args:
+            sketches (dict): (from, to) berth keys to new observation sketches
+            progress (dict): TRAINS ids to the time their edges are counted up to
+        """
+        for (b_from, b_to), sketch in sketches.items():
+            update = {"$inc": sketch.to_inc()}
+            self.mongo.update("EDGES", {"FROM": b_from, "TO": b_to}, update)
+
+        # Move each train on so its confirmed edges are not counted again
+        for train, counted in progress.items():
+            update = {"$max": {"COUNTED": counted}}
+            self.mongo.update("TRAINS", {"_id": train}, update, upsert=False)
+
+        self.log.info("Updated traversal times for {} edges".format(len(sketches)))
+
+    def weight_edges(self):
+        """Weight the graph edges using their stored traversal time statistics.
+
+        The statistics themselves are kept on the graph edges, see CSRGraph.
+        """
+        edges = self.mongo.get("EDGES", projection={"_id": 0})
+        if edges is None:
+            raise Exception("EDGE data is empty!")
+
+        # Combine the statistics for both directions of each graph edge
+        index = {name: i for i, name in enumerate(self.graph.names.tolist())}
+        sketches = {}
+        for edge in edges:
+            if edge["FROM"] not in index or edge["TO"] not in index:
+                continue
+            key = tuple(sorted([index[edge["FROM"]], index[edge["TO"]]]))
+            sketch = QuantileSketch.from_doc(edge)
+            if key in sketches:
+                sketches[key].merge(sketch)
+            else:
+                sketches[key] = sketch
+
+        # Keep the count, mean, median and p90 traversal times on the edges
+        pairs = np.array(list(sketches.keys()), dtype=np.int64).reshape(-1, 2)
+        stats = np.array(
+            [
+                [sk.count, sk.mean(), sk.quantile(0.5), sk.quantile(0.9)]
+                for sk in sketches.values()
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+        exists = self.graph.has_edges(pairs[:, 0], pairs[:, 1]) & (stats[:, 0] > 0)
+        if not exists.any():
+            return
+
+        pairs, stats = pairs[exists], stats[exists]
+        self.graph.set_stats(pairs[:, 0], pairs[:, 1], stats)
+
+        # Slower edges are longer so get weaker springs relative to the typical
+        # edge, edges without statistics keep the default weight of one
+        medians = stats[:, 2]
+        weights = np.clip(np.median(medians) / medians, 0.1, 10.0)
+        self.graph.set_weights(pairs[:, 0], pairs[:, 1], weights)
 
     @timer
     def remove_isolated_nodes(self):
         """Remove isolated nodes from the graph."""
-        self.graph.remove_nodes_from(list(nx.isolates(self.graph)))
+        self.graph = self.graph.subgraph(self.graph.degree() > 0)
         self.log.info(
             "Nodes remaining after 'remove_isolated_nodes': {}".format(
-                len(self.graph.nodes)
+                self.graph.number_of_nodes()
             )
         )
 
     @timer
     def get_largest_network(self):
         """Just consider the single largest connected network."""
-        largest_component = max(nx.connected_components(self.graph), key=len)
-        self.graph = nx.Graph(self.graph.subgraph(largest_component))
+        self.graph = self.graph.largest_component()
 
     @timer
     def remove_duplicate_locations(self):
         """Combine fixed nodes that have the same location."""
-        fixed = [n for n, d in self.graph.nodes().items() if d["fixed"] is True]
-        combine = {}
-        for base_node in fixed:
-            combine[base_node] = []
-            for other_node in fixed:
-                if (
-                    self.graph.nodes[base_node]["lon"]
-                    == self.graph.nodes[other_node]["lon"]
-                    and self.graph.nodes[base_node]["lat"]
-                    == self.graph.nodes[other_node]["lat"]
-                ):
-                    combine[base_node].append(other_node)
-
-        for base_node, combine_list in combine.items():
-            for combine_node in combine_list:
-                try:
-                    lon = self.graph.nodes[base_node]["lon"]
-                    lat = self.graph.nodes[base_node]["lat"]
-                    self.graph = nx.contracted_nodes(
-                        self.graph, base_node, combine_node, self_loops=False
-                    )
-                    self.graph.nodes[base_node]["fixed"] = True
-                    self.graph.nodes[base_node]["lon"] = lon
-                    self.graph.nodes[base_node]["lat"] = lat
-                except Exception as e:
-                    self.log.debug("Already passed {}".format(e))
+        # Merge every fixed node into the first fixed node at the same location
+        fixed = np.flatnonzero(self.graph.fixed)
+        locations = np.column_stack([self.graph.lat[fixed], self.graph.lon[fixed]])
+        _, first, inverse = np.unique(
+            locations, axis=0, return_index=True, return_inverse=True
+        )
+        mapping = np.arange(self.graph.number_of_nodes())
+        mapping[fixed] = fixed[first[inverse.ravel()]]
+        self.graph = self.graph.contract(mapping)
         self.log.info(
             "Nodes remaining after 'remove_duplicate_locations': {}".format(
-                len(self.graph.nodes)
+                self.graph.number_of_nodes()
             )
         )
 
     @timer
-    def remove_distant_nodes(self, only_fixed=True):
-        """Remove linked nodes that are distant from one another."""
-        for edge in self.graph.edges:
-            node_0 = self.graph.nodes[edge[0]]
-            node_1 = self.graph.nodes[edge[1]]
-            if node_0["lon"] is None or node_1["lon"] is None:
-                continue
-            d = math.sqrt(
-                math.pow(node_0["lat"] - node_1["lat"], 2)
-                + math.pow(node_0["lon"] - node_1["lon"], 2)
-            )
-            if only_fixed and node_0["fixed"] and node_1["fixed"] and d >= self.cut_d:
-                self.graph.remove_edge(edge[0], edge[1])
-            elif not only_fixed and d >= self.cut_d:
-                self.graph.remove_edge(edge[0], edge[1])
+    def remove_distant_nodes(self, only_fixed=True, cut_d=None):
+        """Remove linked nodes that are distant from one another.
+
+        Args:
+            only_fixed (bool): Only cut edges between fixed nodes
+            cut_d (float): Cut distance, the generator cut_d if None
+        """
+        cut_d = self.cut_d if cut_d is None else cut_d
+
+        # Edges to nodes without a location have a NaN length and are never cut
+        src, dst, lengths = self.graph.edge_lengths()
+        cut = lengths >= cut_d
+        if only_fixed:
+            cut &= self.graph.fixed[src] & self.graph.fixed[dst]
+        self.graph = self.graph.remove_edges(src[cut], dst[cut])
         self.log.info(
             "Nodes remaining after 'remove_distant_nodes': {}".format(
-                len(self.graph.nodes)
+                self.graph.number_of_nodes()
             )
         )
 
     @timer
     def remove_floating_nodes(self):
-        """Remove nodes that do not lie between fixed nodes."""
-        known = [n for n, d in self.graph.nodes().items() if d["fixed"] is True]
-        c_score = nx.algorithms.betweenness_centrality_subset(self.graph, known, known)
-        nodes_between = [x for x in c_score if c_score[x] != 0.0]
-        nodes_between.extend(known)  # Add on fixed nodes
-        self.graph = self.graph.subgraph(nodes_between)
+        """Remove nodes that do not lie on a path between fixed nodes."""
+        self.graph = self.graph.subgraph(self.graph.between_fixed())
         self.log.info(
             "Nodes remaining after 'remove_floating_nodes': {}".format(
-                len(self.graph.nodes)
+                self.graph.number_of_nodes()
             )
         )
 
     @timer
-    def run_layout(self, all_nodes=False):
-        """Run the spring layout that positions all the nodes."""
-        # Run the spring layout algorithm on the network
-        fixed_positions = dict(
-            (n, [d["lat"] * self.scale, d["lon"] * self.scale])
-            for n, d in self.graph.nodes().items()
-            if d["fixed"] is True
+    def place_berths(self):
+        """Seed the unfixed berths from their TIPLOC or their fixed neighbours."""
+        graph = self.graph
+        known = graph.fixed.copy()
+        lat, lon = graph.lat.copy(), graph.lon.copy()
+
+        # Unfixed berths with a known TIPLOC start at the TIPLOC location
+        selection = {"FIXED": False, "TIPLOC": {"$exists": True}}
+        berths = self.mongo.get("BERTHS", selection, {"_id": 0, "NAME": 1, "TIPLOC": 1})
+        index = {name: i for i, name in enumerate(graph.names.tolist())}
+        for berth in berths if berths is not None and self.tiplocs else []:
+            i = index.get(berth["NAME"])
+            location = self.tiplocs.get(berth["TIPLOC"])
+            if i is not None and location is not None and not known[i]:
+                lat[i], lon[i] = location
+                known[i] = True
+        from_tiplocs = int(known.sum() - graph.fixed.sum())
+
+        # The rest are interpolated along the paths between the known berths
+        pos = harmonic_placement(
+            graph.indptr,
+            graph.indices,
+            graph.weights,
+            np.column_stack([lat, lon]),
+            known,
         )
-        if all_nodes:
-            all_positions = dict(
-                (n, [d["lat"] * self.scale, d["lon"] * self.scale])
-                for n, d in self.graph.nodes().items()
+        graph.lat, graph.lon = pos[:, 0], pos[:, 1]
+        self.log.info(
+            "Placed {} berths from TIPLOCs and {} between known berths".format(
+                from_tiplocs, int((~known & ~np.isnan(graph.lat)).sum())
             )
+        )
 
-        self.log.info("There are {} fixed nodes".format(len(fixed_positions)))
+    @timer
+    def run_layout(self):
+        """Run the spring layout that positions all the nodes."""
+        # Start from the placed positions, any unplaced nodes start randomly
+        pos = np.column_stack([self.graph.lat, self.graph.lon]) * self.scale
 
-        if all_nodes:
-            node_positions = nx.spring_layout(
-                self.graph,
-                k=self.k,
-                pos=all_positions,
-                fixed=fixed_positions.keys(),
-                iterations=self.iter,
-            )
+        self.log.info("There are {} fixed nodes".format(self.graph.fixed.sum()))
+
+        # Run the spring or multilevel layout algorithm on the network
+        if self.layout == "multilevel":
+            layout, kwargs = multilevel_layout, {}
+        elif np.isnan(pos).any():
+            layout, kwargs = spring_layout, {}
         else:
-            node_positions = nx.spring_layout(
-                self.graph,
-                k=self.k,
-                pos=fixed_positions,
-                fixed=fixed_positions.keys(),
-                iterations=self.iter,
-            )
+            # Once every node is placed only refine on the scale of the edges
+            temperature = edge_temperature(self.graph.indptr, self.graph.indices, pos)
+            layout, kwargs = spring_layout, {"temperature": temperature}
+        pos = layout(
+            self.graph.indptr,
+            self.graph.indices,
+            self.graph.weights,
+            pos,
+            self.graph.fixed,
+            self.k,
+            self.iter,
+            **kwargs,
+        )
 
-        for node, position in node_positions.items():
-            self.graph.nodes[node]["lat"] = position[0] / self.scale
-            self.graph.nodes[node]["lon"] = position[1] / self.scale
+        self.graph.lat = pos[:, 0] / self.scale
+        self.graph.lon = pos[:, 1] / self.scale
+        return pos
 
-        self.graph = nx.Graph(self.graph)  # Unfreeze graph
-        return node_positions
+    @timer
+    def update_replay_frames(self):
+        """Replay the steps since the last run into the replay page frames."""
+        since = self.get_watermark("REPLAY_FRAMES")
+        end = replay.update_frames(self.mongo, since, datetime.datetime.now())
+        if end is None:
+            self.log.warning("Could not update the replay frames")
+            return
+
+        # Move the watermark on to the end of the last frame built
+        update = {"$set": {"LATEST_TIME": end}}
+        self.mongo.update("GENERATOR_STATE", {"NAME": "REPLAY_FRAMES"}, update)
+
+    @timer
+    def compact_trains(self):
+        """Roll up and trim the TRAINS history older than the retention window."""
+        if self.retention.enabled():
+            self.retention.compact()
 
     @timer
     def update_berths(self):
@@ -374,19 +791,75 @@ class GraphGenerator(object):
         self.mongo.update("BERTHS", {}, update, many=True)
 
         # Now update the selected berths
-        for node, data in self.graph.nodes(data=True):
+        graph = self.graph
+        for i, node in enumerate(graph.names.tolist()):
             update = {
                 "$set": {
-                    "LONGITUDE": data["lon"],
-                    "LATITUDE": data["lat"],
+                    "LONGITUDE": float(graph.lon[i]),
+                    "LATITUDE": float(graph.lat[i]),
                     "SELECTED": True,
-                    "EDGES": [[edge[1] for edge in list(self.graph.edges(node))]],
+                    "EDGES": [graph.names[graph.neighbours(i)].tolist()],
                 }
             }
             self.mongo.update("BERTHS", {"NAME": node}, update)
+
+        # Publish the static map layer of the new layout for the dash app
+        if publish_static_layer(self.mongo) is None:
+            self.log.warning("Could not publish the static graph layer")
         return True
 
 
+def extract_shard(task):
+    """Segment one shard of the TRAINS in a worker process.
+
+    Args:
+        task (dict): database, shard and segmentation parameters
+    Returns:
+        (np.ndarray, np.ndarray, dict, dict): segment_trains result
+    """
+    mongo = Mongo.connect(log, task["uri"], task["database"])
+    if mongo is None:
+        raise ConnectionError
+
+    # Select the trains whose hashed name falls in this shard
+    shard = {"$abs": {"$mod": [{"$toHashedIndexKey": "$NAME"}, task["shards"]]}}
+    pipeline = [{"$match": {"$expr": {"$eq": [shard, task["shard"]]}}}]
+    steps = mongo.aggregate("TRAINS", pipeline + TRAIN_PIPELINE, task["chunk_size"])
+    if steps is None:
+        raise Exception("TRAIN data is empty!")
+    return segment_trains(
+        steps,
+        task["delta_b"],
+        task["delta_t"],
+        task["chunk_size"],
+        task["watermark"],
+    )
+
+
+def load_tiplocs(path):
+    """Load the TIPLOC locations converted to WGS84 coordinates.
+
+    Args:
+        path (str): TIPLOC json file with OSGB eastings and northings
+    Returns:
+        dict: TIPLOC names mapped to (latitude, longitude)
+    """
+    try:
+        with open(path) as tiploc_file:
+            tiplocs = [t for t in json.load(tiploc_file) if t["EASTING"]]
+    except FileNotFoundError:
+        log.warning("No TIPLOC locations at {}".format(path))
+        return {}
+
+    lat, lon = osgb_to_wgs84(
+        [float(t["EASTING"]) for t in tiplocs], [float(t["NORTHING"]) for t in tiplocs]
+    )
+    return {
+        t["TIPLOC"]: location
+        for t, location in zip(tiplocs, zip(lat.tolist(), lon.tolist()))
+    }
+
+
 def exit_handler(sig, frame):
     """Exit method."""
     log.info("Exit signal handler invoked({})".format(sig))
@@ -416,12 +889,31 @@ def main():
         Config.GENERATOR_SCALE,
         Config.GENERATOR_DELTA_B,
         Config.GENERATOR_DELTA_T,
+        Config.GENERATOR_CHECKPOINTS,
+        Config.GENERATOR_TRACE_MEMORY,
+        Config.GENERATOR_PROFILES,
+        Config.COLLECTOR_EDGES,
+        Config.GENERATOR_RETENTION_HOURS,
+        Config.GENERATOR_ROLLUP_DAYS,
+        Config.GENERATOR_LAYOUT,
+        load_tiplocs(TIPLOC_FILE),
+        Config.GENERATOR_CHUNK_SIZE,
+        Config.GENERATOR_WORKERS,
     )
 
-    # Run the graph generator in a loop, run every GRAPH_UPDATE_RATE seconds
-    while 1:
-        gen.run()
-        time.sleep(Config.GENERATOR_RATE)
+    gen.create_indexes()
+
+    # Run the graph generator whenever enough new data has arrived, or at most
+    # every GENERATOR_RATE seconds when there is any new data at all
+    scheduler = RunScheduler(
+        log,
+        mongo,
+        Config.GENERATOR_RATE,
+        Config.GENERATOR_POLL_RATE,
+        Config.GENERATOR_MIN_MOVEMENTS,
+        Config.GENERATOR_MIN_EDGES,
+    )
+    scheduler.run(gen)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the array backed graph used by the graph generator.
+
+Nodes are integer ids into NumPy arrays of berth names, positions and fixed
+flags. The undirected edges are stored in both directions as CSR adjacency
+arrays, with the column indices sorted within each row. Operations that change
+the structure of the graph return a new compact graph with renumbered nodes.
+
+Each edge entry also carries the traversal time statistics of the edge, which
+set its weight and are kept for the consumers of the graph.
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Traversal time statistics held for each edge, in the columns of the stats
+EDGE_STATS = ["count", "mean", "median", "p90"]
+
+
+class CSRGraph(object):
+    """Undirected graph held as CSR adjacency and node attribute arrays."""
+
+    def __init__(self, names, lat, lon, fixed, indptr, indices, weights, stats=None):
+        """Initialise CSRGraph.
+
+        Args:
+            names (np.ndarray): berth name of each node
+            lat (np.ndarray): latitude of each node, NaN if unknown
+            lon (np.ndarray): longitude of each node, NaN if unknown
+            fixed (np.ndarray): True if the node has a known fixed location
+            indptr (np.ndarray): CSR row pointers
+            indices (np.ndarray): CSR column indices, sorted within each row
+            weights (np.ndarray): CSR edge weights
+            stats (np.ndarray): CSR edge EDGE_STATS columns, NaN if unknown,
+                all unknown if None
+        """
+        self.names = np.asarray(names, dtype=str)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.fixed = np.asarray(fixed, dtype=bool)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        if stats is None:
+            stats = np.full((len(self.indices), len(EDGE_STATS)), np.nan)
+        self.stats = np.asarray(stats, dtype=np.float64).reshape(-1, len(EDGE_STATS))
+
+    @classmethod
+    def from_edges(cls, names, lat, lon, fixed, src, dst, weights=None, stats=None):
+        """Create a graph from node attributes and an edge list.
+
+        Edges are made undirected, self loops are dropped and repeated edges
+        are merged keeping the largest weight and its statistics.
+
+        Args:
+            names (np.ndarray): berth name of each node
+            lat (np.ndarray): latitude of each node, NaN if unknown
+            lon (np.ndarray): longitude of each node, NaN if unknown
+            fixed (np.ndarray): True if the node has a known fixed location
+            src (np.ndarray): edge source node ids
+            dst (np.ndarray): edge destination node ids
+            weights (np.ndarray): edge weights, all one if None
+            stats (np.ndarray): edge EDGE_STATS columns, all unknown if None
+        Returns:
+            CSRGraph: new graph
+        """
+        n = len(names)
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        if weights is None:
+            weights = np.ones(len(src))
+        weights = np.asarray(weights, dtype=np.float64)
+        if stats is None:
+            stats = np.full((len(src), len(EDGE_STATS)), np.nan)
+        stats = np.asarray(stats, dtype=np.float64).reshape(-1, len(EDGE_STATS))
+
+        # Both directions of every edge without self loops
+        keep = src != dst
+        rows = np.concatenate([src[keep], dst[keep]])
+        cols = np.concatenate([dst[keep], src[keep]])
+        weights = np.concatenate([weights[keep], weights[keep]])
+        stats = np.concatenate([stats[keep], stats[keep]])
+
+        # Sort by row, column and then weight so the last repeat is the largest
+        order = np.lexsort((weights, cols, rows))
+        rows, cols, weights = rows[order], cols[order], weights[order]
+        stats = stats[order]
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, weights, stats = rows[last], cols[last], weights[last], stats[last]
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        return cls(names, lat, lon, fixed, indptr, cols, weights, stats)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Create a graph from a dictionary of arrays.
+
+        Args:
+            arrays (dict): arrays as returned by to_arrays
+        Returns:
+            CSRGraph: new graph
+        """
+        return cls(
+            arrays["names"],
+            arrays["lat"],
+            arrays["lon"],
+            arrays["fixed"],
+            arrays["indptr"],
+            arrays["indices"],
+            arrays["weights"],
+            arrays.get("stats"),
+        )
+
+    def to_arrays(self):
+        """Get the graph as a dictionary of arrays.
+
+        Returns:
+            dict: dictionary of numpy arrays
+        """
+        return {
+            "names": self.names,
+            "lat": self.lat,
+            "lon": self.lon,
+            "fixed": self.fixed,
+            "indptr": self.indptr,
+            "indices": self.indices,
+            "weights": self.weights,
+            "stats": self.stats,
+        }
+
+    def to_networkx(self):
+        """Export the graph to networkx, this is only intended for debugging.
+
+        Returns:
+            nx.Graph: graph with lat, lon, fixed, weight and EDGE_STATS
+                attributes, the statistics only where they are known
+        """
+        import networkx as nx
+
+        graph = nx.Graph()
+        for name, lat, lon, fixed in zip(self.names, self.lat, self.lon, self.fixed):
+            graph.add_node(
+                name,
+                lat=None if np.isnan(lat) else float(lat),
+                lon=None if np.isnan(lon) else float(lon),
+                fixed=bool(fixed),
+            )
+        src, dst, weights = self.edges()
+        graph.add_weighted_edges_from(
+            zip(self.names[src], self.names[dst], weights.tolist())
+        )
+        stats = self.stats[self.indices > self.rows()]
+        for a, b, values in zip(self.names[src], self.names[dst], stats.tolist()):
+            if not np.isnan(values[0]):
+                graph.edges[a, b].update(zip(EDGE_STATS, values))
+        return graph
+
+    def number_of_nodes(self):
+        """Get the number of nodes.
+
+        Returns:
+            int: number of nodes
+        """
+        return len(self.names)
+
+    def number_of_edges(self):
+        """Get the number of undirected edges.
+
+        Returns:
+            int: number of edges
+        """
+        return len(self.indices) // 2
+
+    def rows(self):
+        """Get the row node id of every CSR entry.
+
+        Returns:
+            np.ndarray: row node id of each directed edge entry
+        """
+        return np.repeat(
+            np.arange(self.number_of_nodes(), dtype=np.int32), self.degree()
+        )
+
+    def degree(self):
+        """Get the degree of every node.
+
+        Returns:
+            np.ndarray: node degrees
+        """
+        return np.diff(self.indptr)
+
+    def edges(self):
+        """Get each undirected edge once.
+
+        Returns:
+            np.ndarray: edge source node ids
+            np.ndarray: edge destination node ids, always above the source id
+            np.ndarray: edge weights
+        """
+        rows = self.rows()
+        upper = self.indices > rows
+        return rows[upper], self.indices[upper], self.weights[upper]
+
+    def neighbours(self, node):
+        """Get the neighbours of a node.
+
+        Args:
+            node (int): node id
+        Returns:
+            np.ndarray: neighbouring node ids
+        """
+        return self.indices[self.indptr[node] : self.indptr[node + 1]]  # noqa: E203
+
+    def matrix(self):
+        """Get the weighted adjacency as a scipy sparse matrix.
+
+        Returns:
+            scipy.sparse.csr_matrix: adjacency matrix
+        """
+        n = self.number_of_nodes()
+        return csr_matrix((self.weights, self.indices, self.indptr), shape=(n, n))
+
+    def isolates(self):
+        """Get the nodes without any edges.
+
+        Returns:
+            np.ndarray: isolated node ids
+        """
+        return np.flatnonzero(self.degree() == 0)
+
+    def connected_components(self):
+        """Label the connected components of the graph.
+
+        Returns:
+            int: number of components
+            np.ndarray: component label of each node
+        """
+        return connected_components(self.matrix(), directed=False)
+
+    def largest_component(self):
+        """Get the subgraph of the single largest connected component.
+
+        Returns:
+            CSRGraph: largest component subgraph
+        """
+        if self.number_of_nodes() == 0:
+            return self
+        _, labels = self.connected_components()
+        return self.subgraph(labels == np.argmax(np.bincount(labels)))
+
+    def subgraph(self, keep):
+        """Get the subgraph induced by a set of nodes.
+
+        Args:
+            keep (np.ndarray): boolean mask or ids of the nodes to keep
+        Returns:
+            CSRGraph: induced subgraph with renumbered nodes
+        """
+        mask = np.zeros(self.number_of_nodes(), dtype=bool)
+        mask[keep] = True
+        new_ids = np.cumsum(mask) - 1
+
+        rows = self.rows()
+        entries = mask[rows] & mask[self.indices]
+        counts = np.bincount(new_ids[rows[entries]], minlength=int(mask.sum()))
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        return CSRGraph(
+            self.names[mask],
+            self.lat[mask],
+            self.lon[mask],
+            self.fixed[mask],
+            indptr,
+            new_ids[self.indices[entries]],
+            self.weights[entries],
+            self.stats[entries],
+        )
+
+    def remove_edges(self, src, dst):
+        """Get the graph without a set of edges.
+
+        Args:
+            src (np.ndarray): edge source node ids
+            dst (np.ndarray): edge destination node ids
+        Returns:
+            CSRGraph: graph with the same nodes and without the edges
+        """
+        n = self.number_of_nodes()
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        removed = np.concatenate([src * n + dst, dst * n + src])
+        keys = self.rows().astype(np.int64) * n + self.indices
+        entries = ~np.isin(keys, removed)
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.rows()[entries], minlength=n), out=indptr[1:])
+        return CSRGraph(
+            self.names,
+            self.lat,
+            self.lon,
+            self.fixed,
+            indptr,
+            self.indices[entries],
+            self.weights[entries],
+            self.stats[entries],
+        )
+
+    def has_edges(self, src, dst):
+        """Check if edges exist.
+
+        Args:
+            src (np.ndarray): edge source node ids
+            dst (np.ndarray): edge destination node ids
+        Returns:
+            np.ndarray: True for each edge in the graph
+        """
+        n = self.number_of_nodes()
+        keys = self.rows().astype(np.int64) * n + self.indices
+        wanted = np.asarray(src, dtype=np.int64) * n + np.asarray(dst, dtype=np.int64)
+        return np.isin(wanted, keys)
+
+    def set_weights(self, src, dst, weights):
+        """Set the weights of existing edges in both directions.
+
+        Args:
+            src (np.ndarray): edge source node ids
+            dst (np.ndarray): edge destination node ids
+            weights (np.ndarray): new edge weights
+        """
+        for positions in self.entries(src, dst):
+            self.weights[positions] = weights
+
+    def set_stats(self, src, dst, stats):
+        """Set the traversal time statistics of existing edges in both directions.
+
+        Args:
+            src (np.ndarray): edge source node ids
+            dst (np.ndarray): edge destination node ids
+            stats (np.ndarray): (m, 4) new edge EDGE_STATS columns
+        """
+        for positions in self.entries(src, dst):
+            self.stats[positions] = stats
+
+    def entries(self, src, dst):
+        """Get the CSR entries of existing edges in both directions.
+
+        Args:
+            src (np.ndarray): edge source node ids
+            dst (np.ndarray): edge destination node ids
+        Returns:
+            [np.ndarray]: entry positions of the edges from src to dst, then
+                of the edges from dst to src
+        """
+        n = self.number_of_nodes()
+        keys = self.rows().astype(np.int64) * n + self.indices
+        positions = []
+        for a, b in [(src, dst), (dst, src)]:
+            wanted = np.asarray(a, dtype=np.int64) * n + np.asarray(b, dtype=np.int64)
+            positions.append(np.searchsorted(keys, wanted))
+        return positions
+
+    def contract(self, mapping):
+        """Merge nodes into other nodes, keeping the edges of both.
+
+        Args:
+            mapping (np.ndarray): node id each node is merged into, nodes that
+                map to themselves are kept
+        Returns:
+            CSRGraph: contracted graph without self loops
+        """
+        mapping = np.asarray(mapping, dtype=np.int64)
+        keep = mapping == np.arange(self.number_of_nodes())
+        new_ids = np.cumsum(keep) - 1
+        src, dst, weights = self.edges()
+        return CSRGraph.from_edges(
+            self.names[keep],
+            self.lat[keep],
+            self.lon[keep],
+            self.fixed[keep],
+            new_ids[mapping[src]],
+            new_ids[mapping[dst]],
+            weights,
+            self.stats[self.indices > self.rows()],
+        )
+
+    def edge_lengths(self):
+        """Get the straight line length of each undirected edge.
+
+        Returns:
+            np.ndarray: edge source node ids
+            np.ndarray: edge destination node ids
+            np.ndarray: edge lengths in degrees, NaN if a position is unknown
+        """
+        src, dst, _ = self.edges()
+        lengths = np.hypot(self.lat[src] - self.lat[dst], self.lon[src] - self.lon[dst])
+        return src, dst, lengths
+
+    def biconnected_blocks(self):
+        """Find the biconnected blocks of the graph.
+
+        Uses an iterative version of the Hopcroft-Tarjan algorithm, so it runs
+        in linear time without recursion. Every edge belongs to exactly one
+        block, while a cut vertex belongs to all the blocks it joins.
+
+        Returns:
+            np.ndarray: block pointers into the block nodes
+            np.ndarray: node ids of each block in turn
+        """
+        n = self.number_of_nodes()
+        indptr = self.indptr.tolist()
+        indices = self.indices.tolist()
+        disc = [-1] * n
+        low = [0] * n
+        blocks, block_ptr = [], [0]
+        counter = 0
+
+        for root in range(n):
+            if disc[root] != -1 or indptr[root] == indptr[root + 1]:
+                continue
+            disc[root] = low[root] = counter
+            counter += 1
+            visited = [root]
+            stack = [(root, -1, indptr[root])]
+            while stack:
+                node, parent, entry = stack[-1]
+                if entry < indptr[node + 1]:
+                    stack[-1] = (node, parent, entry + 1)
+                    child = indices[entry]
+                    if disc[child] == -1:
+                        disc[child] = low[child] = counter
+                        counter += 1
+                        visited.append(child)
+                        stack.append((child, node, indptr[child]))
+                    elif child != parent:
+                        low[node] = min(low[node], disc[child])
+                    continue
+
+                # All the neighbours are done, so finish the node
+                stack.pop()
+                if parent == -1:
+                    continue
+                low[parent] = min(low[parent], low[node])
+                if low[node] >= disc[parent]:
+                    # The parent separates the subtree below it into a block
+                    while True:
+                        member = visited.pop()
+                        blocks.append(member)
+                        if member == node:
+                            break
+                    blocks.append(parent)
+                    block_ptr.append(len(blocks))
+
+        return np.array(block_ptr, dtype=np.int64), np.array(blocks, dtype=np.int64)
+
+    def between_fixed(self):
+        """Find the nodes that lie on a simple path between two fixed nodes.
+
+        A node lies on such a path if one of its blocks lies on the path
+        between fixed nodes in the block-cut tree. Repeatedly removing the leaves
+        of the block-cut tree that hold no fixed nodes leaves exactly the blocks
+        on those paths.
+
+        Returns:
+            np.ndarray: True for nodes between fixed nodes and the fixed nodes
+        """
+        n = self.number_of_nodes()
+        block_ptr, blocks = self.biconnected_blocks()
+        n_blocks = len(block_ptr) - 1
+        keep = self.fixed.copy()
+        if n_blocks == 0:
+            return keep
+
+        # Block-cut tree with the blocks first, then a node for every graph node
+        # that is in more than one block, the cut vertices
+        block_ids = np.repeat(np.arange(n_blocks), np.diff(block_ptr))
+        memberships = np.bincount(blocks, minlength=n)
+        cut = memberships > 1
+        tree_src = block_ids[cut[blocks]]
+        tree_dst = n_blocks + blocks[cut[blocks]]
+        n_tree = n_blocks + n
+        degree = np.bincount(np.concatenate([tree_src, tree_dst]), minlength=n_tree)
+        order = np.argsort(np.concatenate([tree_src, tree_dst]), kind="stable")
+        tree_adj = np.concatenate([tree_dst, tree_src])[order]
+        tree_ptr = np.zeros(n_tree + 1, dtype=np.int64)
+        np.cumsum(degree, out=tree_ptr[1:])
+
+        # Terminals are the cut vertices that are fixed and the blocks holding
+        # a fixed node that is not a cut vertex
+        fixed_count = np.bincount(
+            block_ids, weights=self.fixed[blocks] & ~cut[blocks], minlength=n_blocks
+        )
+        terminal = np.zeros(n_tree, dtype=bool)
+        terminal[:n_blocks] = fixed_count > 0
+        terminal[n_blocks:] = cut & self.fixed
+
+        # Prune the non terminal leaves until only paths between terminals remain
+        alive = degree > 0
+        alive[:n_blocks] = True
+        leaves = np.flatnonzero(alive & ~terminal & (degree <= 1)).tolist()
+        alive, degree = alive.tolist(), degree.tolist()
+        terminal, tree_adj = terminal.tolist(), tree_adj.tolist()
+        tree_ptr = tree_ptr.tolist()
+        while leaves:
+            leaf = leaves.pop()
+            if not alive[leaf]:
+                continue
+            alive[leaf] = False
+            for other in tree_adj[tree_ptr[leaf] : tree_ptr[leaf + 1]]:  # noqa: E203
+                if alive[other]:
+                    degree[other] -= 1
+                    if degree[other] <= 1 and not terminal[other]:
+                        leaves.append(other)
+
+        # A block left on its own only lies between fixed nodes if it holds two
+        alive = np.array(alive[:n_blocks])
+        alone = np.array(degree[:n_blocks]) == 0
+        alive &= ~alone | (
+            np.bincount(block_ids, weights=self.fixed[blocks], minlength=n_blocks) > 1
+        )
+        keep[blocks[alive[block_ids]]] = True
+        return keep
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the force directed layouts used by the graph generator.
+
+The layouts work directly on CSR adjacency arrays. The spring layout follows
+the Fruchterman-Reingold implementation in networkx, so the k coefficient and
+iteration counts keep their meaning, but the forces are computed with NumPy in
+blocks of rows. The rows of a block are sized from the number of nodes so that
+the block's arrays stay within REPULSION_BYTES however large the graph.
+
+On long, thin networks corrections only travel one edge per iteration, so the
+multilevel layout first coarsens the graph into a hierarchy by merging matched
+pairs of nodes, preferring the nodes of degree two chains. The coarsest graph
+is laid out around the fixed nodes and the positions are then interpolated and
+refined level by level with only a few iterations each.
+
+Before either layout runs, the nodes without a position can be seeded by
+harmonic interpolation. Each free node is placed at the weighted mean of its
+neighbours, so a chain of free nodes between two known nodes is spread along
+the straight line between them in proportion to the edge traversal times.
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, diags
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import spsolve
+
+# Memory budget of a block of repulsion rows, and the bytes each node pair of a
+# block takes: the (x, y) deltas and two distance arrays of float64
+REPULSION_BYTES = 64 * 2**20
+PAIR_BYTES = 40
+
+
+def repulsion_block(n):
+    """Get the number of rows of the repulsion computed at once for a graph.
+
+    Args:
+        n (int): number of nodes
+    Returns:
+        int: rows per block within REPULSION_BYTES, at least one
+    """
+    return max(1, REPULSION_BYTES // (max(n, 1) * PAIR_BYTES))
+
+
+def spring_layout(
+    indptr,
+    indices,
+    weights,
+    pos,
+    fixed,
+    k,
+    iterations,
+    seed=None,
+    block=None,
+    temperature=None,
+):
+    """Position nodes using the Fruchterman-Reingold force directed algorithm.
+
+    Args:
+        indptr (np.ndarray): CSR row pointers
+        indices (np.ndarray): CSR column indices
+        weights (np.ndarray): CSR edge weights
+        pos (np.ndarray): (n, 2) initial positions, NaN rows are placed randomly
+        fixed (np.ndarray): True for nodes that must not move
+        k (float): optimal distance between nodes
+        iterations (int): maximum number of iterations
+        seed (int): random seed for the initial positions
+        block (int): number of rows to compute the repulsion for at once, from
+            the memory budget if None
+        temperature (float): largest initial move, a tenth of the domain if None
+    Returns:
+        np.ndarray: (n, 2) node positions
+    """
+    pos = np.array(pos, dtype=np.float64)
+    fixed = np.asarray(fixed, dtype=bool)
+    n = len(pos)
+    if n == 0:
+        return pos
+
+    # Place nodes without a position randomly within the known domain
+    missing = np.isnan(pos).any(axis=1)
+    dom_size = np.nanmax(pos) if not missing.all() else 1.0
+    rng = np.random.default_rng(seed)
+    pos[missing] = rng.random((int(missing.sum()), 2)) * dom_size
+
+    movable = np.flatnonzero(~fixed)
+    if len(movable) == 0:
+        return pos
+
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    block = block if block is not None else repulsion_block(n)
+    t = temperature
+    if t is None:
+        t = max(np.ptp(pos[:, 0]), np.ptp(pos[:, 1])) * 0.1
+    dt = t / float(iterations + 1)
+
+    for _ in range(iterations):
+        displacement = np.zeros((n, 2))
+
+        # Repulsion between every movable node and all other nodes
+        for start in range(0, len(movable), block):
+            nodes = movable[start : start + block]  # noqa: E203
+            delta = pos[nodes, None, :] - pos[None, :, :]
+            distance = np.hypot(delta[..., 0], delta[..., 1])
+            np.maximum(distance, 0.01, out=distance)
+            np.square(distance, out=distance)
+            np.divide(k * k, distance, out=distance)
+            displacement[nodes] += np.einsum("ijk,ij->ik", delta, distance)
+
+        # Attraction along the weighted edges
+        delta = pos[rows] - pos[indices]
+        distance = np.maximum(np.hypot(delta[:, 0], delta[:, 1]), 0.01)
+        force = delta * (weights * distance / k)[:, None]
+        displacement[:, 0] -= np.bincount(rows, force[:, 0], minlength=n)
+        displacement[:, 1] -= np.bincount(rows, force[:, 1], minlength=n)
+
+        # Move the free nodes by at most the current temperature
+        length = np.hypot(displacement[:, 0], displacement[:, 1])
+        length = np.where(length < 0.01, 0.1, length)
+        delta_pos = displacement * (t / length)[:, None]
+        delta_pos[fixed] = 0.0
+        pos += delta_pos
+
+        # Cool the temperature and stop once the layout has settled
+        t -= dt
+        if np.linalg.norm(delta_pos) / n < 1e-4:
+            break
+
+    return pos
+
+
+def coarsen(indptr, indices, weights, fixed, rng):
+    """Merge matched pairs of nodes into a coarser graph.
+
+    Nodes are visited in a random order and matched to the unmatched neighbour
+    with the lowest degree, so degree two chains halve at every level. Two fixed
+    nodes are never merged.
+
+    Args:
+        indptr (np.ndarray): CSR row pointers
+        indices (np.ndarray): CSR column indices
+        weights (np.ndarray): CSR edge weights
+        fixed (np.ndarray): True for nodes that must not move
+        rng (np.random.Generator): random generator for the visiting order
+    Returns:
+        np.ndarray: coarse node id of each node
+        (np.ndarray, np.ndarray, np.ndarray): coarse CSR arrays, the weights of
+            merged edges are summed
+    """
+    n = len(fixed)
+    degree = np.diff(indptr).tolist()
+    ptr, adj, is_fixed = indptr.tolist(), indices.tolist(), fixed.tolist()
+    match = [-1] * n
+    for node in rng.permutation(n).tolist():
+        if match[node] != -1:
+            continue
+        best = node
+        for other in adj[ptr[node] : ptr[node + 1]]:  # noqa: E203
+            if match[other] != -1 or (is_fixed[node] and is_fixed[other]):
+                continue
+            if best == node or degree[other] < degree[best]:
+                best = other
+        match[node] = best
+        match[best] = node
+
+    # Number the coarse nodes by the lower id of each pair
+    match = np.array(match)
+    leader = np.minimum(np.arange(n), match)
+    _, mapping = np.unique(leader, return_inverse=True)
+    n_coarse = int(mapping.max()) + 1 if n else 0
+
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    matrix = coo_matrix(
+        (weights, (mapping[rows], mapping[indices])), shape=(n_coarse, n_coarse)
+    ).tocsr()
+    matrix.setdiag(0)
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return mapping, (matrix.indptr, matrix.indices, matrix.data)
+
+
+def multilevel_layout(
+    indptr,
+    indices,
+    weights,
+    pos,
+    fixed,
+    k,
+    iterations,
+    refine=50,
+    min_nodes=100,
+    seed=None,
+):
+    """Position nodes with a multilevel coarsen and refine spring layout.
+
+    Args:
+        indptr (np.ndarray): CSR row pointers
+        indices (np.ndarray): CSR column indices
+        weights (np.ndarray): CSR edge weights
+        pos (np.ndarray): (n, 2) initial positions, NaN rows are unknown
+        fixed (np.ndarray): True for nodes that must not move
+        k (float): optimal distance between nodes
+        iterations (int): maximum number of iterations on the coarsest level
+        refine (int): maximum number of iterations on each finer level
+        min_nodes (int): stop coarsening once a level has fewer nodes
+        seed (int): random seed for the matching and initial positions
+    Returns:
+        np.ndarray: (n, 2) node positions
+    """
+    pos = np.array(pos, dtype=np.float64)
+    fixed = np.asarray(fixed, dtype=bool)
+    rng = np.random.default_rng(seed)
+
+    # Coarsen until the graph is small or stops shrinking
+    levels = [(indptr, indices, weights, pos, fixed)]
+    mappings = []
+    while len(levels[-1][4]) > min_nodes:
+        c_indptr, c_indices, c_weights, c_pos, c_fixed = levels[-1]
+        mapping, (n_indptr, n_indices, n_weights) = coarsen(
+            c_indptr, c_indices, c_weights, c_fixed, rng
+        )
+        n_coarse = len(n_indptr) - 1
+        if n_coarse > 0.9 * len(c_fixed):
+            break
+
+        # Coarse nodes are fixed at their fixed member, or at the mean of the
+        # known positions of their members
+        n_fixed = np.bincount(mapping, weights=c_fixed, minlength=n_coarse) > 0
+        known = ~np.isnan(c_pos).any(axis=1)
+        use = np.where(n_fixed[mapping], c_fixed, known)
+        counts = np.bincount(mapping, weights=use, minlength=n_coarse)
+        n_pos = np.full((n_coarse, 2), np.nan)
+        for axis in range(2):
+            total = np.bincount(
+                mapping, weights=np.where(use, c_pos[:, axis], 0.0), minlength=n_coarse
+            )
+            n_pos[counts > 0, axis] = total[counts > 0] / counts[counts > 0]
+        mappings.append(mapping)
+        levels.append((n_indptr, n_indices, n_weights, n_pos, n_fixed))
+
+    # Lay out the coarsest level fully
+    c_indptr, c_indices, c_weights, c_pos, c_fixed = levels[-1]
+    coarse = spring_layout(
+        c_indptr, c_indices, c_weights, c_pos, c_fixed, k, iterations, seed=seed
+    )
+
+    # Interpolate each finer level from the coarser one, smooth it and refine it
+    for level in reversed(range(len(mappings))):
+        f_indptr, f_indices, f_weights, f_pos, f_fixed = levels[level]
+        fine = coarse[mappings[level]]
+        fine[f_fixed] = f_pos[f_fixed]
+        fine = smooth(f_indptr, f_indices, f_weights, fine, f_fixed)
+
+        # Only allow moves on the scale of the local edge lengths
+        temperature = edge_temperature(f_indptr, f_indices, fine)
+        coarse = spring_layout(
+            f_indptr,
+            f_indices,
+            f_weights,
+            fine,
+            f_fixed,
+            k,
+            refine,
+            seed=seed,
+            temperature=temperature,
+        )
+
+    return coarse
+
+
+def edge_temperature(indptr, indices, pos):
+    """Get a temperature that only allows moves on the scale of the edges.
+
+    Used to refine a layout that already has good positions rather than
+    shaking it apart with moves on the scale of the whole domain.
+
+    Args:
+        indptr (np.ndarray): CSR row pointers
+        indices (np.ndarray): CSR column indices
+        pos (np.ndarray): (n, 2) node positions
+    Returns:
+        float: median edge length, None if there are no edges
+    """
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    delta = pos[rows] - pos[indices]
+    lengths = np.hypot(delta[:, 0], delta[:, 1])
+    return float(np.median(lengths)) if len(lengths) else None
+
+
+def smooth(indptr, indices, weights, pos, fixed, sweeps=2):
+    """Move the free nodes towards the weighted mean of their neighbours.
+
+    Args:
+        indptr (np.ndarray): CSR row pointers
+        indices (np.ndarray): CSR column indices
+        weights (np.ndarray): CSR edge weights
+        pos (np.ndarray): (n, 2) node positions
+        fixed (np.ndarray): True for nodes that must not move
+        sweeps (int): number of smoothing sweeps
+    Returns:
+        np.ndarray: (n, 2) smoothed node positions
+    """
+    n = len(fixed)
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    total = np.bincount(rows, weights=weights, minlength=n)
+    free = ~fixed & (total > 0)
+    for _ in range(sweeps):
+        mean = np.column_stack(
+            [
+                np.bincount(rows, weights=weights * pos[indices, axis], minlength=n)
+                for axis in range(2)
+            ]
+        )
+        pos[free] = 0.5 * pos[free] + 0.5 * mean[free] / total[free, None]
+    return pos
+
+
+def harmonic_placement(indptr, indices, weights, pos, known):
+    """Place the unknown nodes at the weighted mean of their neighbours.
+
+    Solves the graph Laplacian system for the unknown positions with the known
+    positions as boundary values. Unknown nodes with no path to a known node
+    are left without a position.
+
+    Args:
+        indptr (np.ndarray): CSR row pointers
+        indices (np.ndarray): CSR column indices
+        weights (np.ndarray): CSR edge weights
+        pos (np.ndarray): (n, 2) positions, only used where known is True
+        known (np.ndarray): True for nodes with a position
+    Returns:
+        np.ndarray: (n, 2) node positions, NaN rows could not be placed
+    """
+    pos = np.array(pos, dtype=np.float64)
+    known = np.asarray(known, dtype=bool)
+    n = len(known)
+    pos[~known] = np.nan
+    if n == 0 or not known.any() or known.all():
+        return pos
+
+    # Only components containing a known node have a unique solution
+    adjacency = csr_matrix((weights, indices, indptr), shape=(n, n))
+    _, labels = connected_components(adjacency, directed=False)
+    anchored = np.isin(labels, labels[known])
+    free = np.flatnonzero(~known & anchored)
+    if len(free) == 0:
+        return pos
+
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    laplacian = (diags(degree) - adjacency).tocsr()[free]
+    rhs = -(laplacian[:, np.flatnonzero(known)] @ pos[known])
+    solution = spsolve(laplacian[:, free].tocsc(), rhs)
+    pos[free] = np.asarray(solution).reshape(len(free), 2)
+    return pos
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the per stage profiling of the graph generator runs.
+
+Every stage of a run records its wall and CPU time, the graph size before and
+after it and the wall time of each of its steps. The peak memory allocated
+while it ran is only traced with tracemalloc when asked for, as the benchmark
+does, since tracing slows every allocation of the stages it measures. Stages
+can optionally be run under cProfile with the statistics dumped to a directory
+for later inspection with pstats or snakeviz.
+"""
+
+import os
+import time
+import cProfile
+import datetime
+import contextlib
+import tracemalloc
+
+
+class RunProfiler(object):
+    """Collects the profile of every stage of a single generator run."""
+
+    def __init__(self, trace_memory=False, profile_dir=""):
+        """Initialise RunProfiler.
+
+        Args:
+            trace_memory (bool): Record the peak allocated memory with tracemalloc
+            profile_dir (str): Directory for cProfile dumps, disabled if empty
+        """
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        self.stages = []
+        self.current = None
+        self.started = None
+
+    def start(self):
+        """Start profiling a new run."""
+        self.stages = []
+        self.current = None
+        self.started = datetime.datetime.utcnow()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.owns_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if self.owns_tracing:
+            tracemalloc.start()
+
+    def finish(self, completed, params):
+        """Finish profiling the run.
+
+        Args:
+            completed (bool): True if the run completed
+            params (dict): generator parameters of the run
+        Returns:
+            dict: run document for the GENERATOR_RUNS collection
+        """
+        if self.owns_tracing:
+            tracemalloc.stop()
+        peaks = [s["PEAK_MB"] for s in self.stages if s["PEAK_MB"] is not None]
+        return {
+            "START": self.started,
+            "END": datetime.datetime.utcnow(),
+            "COMPLETED": completed,
+            "WALL": time.perf_counter() - self.start_wall,
+            "CPU": time.process_time() - self.start_cpu,
+            "PEAK_MB": max(peaks) if peaks else None,
+            "PARAMS": params,
+            "STAGES": self.stages,
+        }
+
+    @contextlib.contextmanager
+    def stage(self, name, size):
+        """Profile a stage of the run.
+
+        Args:
+            name (str): stage name
+            size (callable): returns the current (nodes, edges) of the graph
+        """
+        nodes, edges = size()
+        self.current = {
+            "NAME": name,
+            "NODES_BEFORE": nodes,
+            "EDGES_BEFORE": edges,
+            "STEPS": [],
+        }
+
+        profiler = cProfile.Profile() if self.profile_dir else None
+        if tracemalloc.is_tracing():
+            tracemalloc.clear_traces()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield self.current
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self.current["WALL"] = time.perf_counter() - start_wall
+            self.current["CPU"] = time.process_time() - start_cpu
+            self.current["PEAK_MB"] = (
+                tracemalloc.get_traced_memory()[1] / 1e6
+                if tracemalloc.is_tracing()
+                else None
+            )
+            nodes, edges = size()
+            self.current["NODES_AFTER"] = nodes
+            self.current["EDGES_AFTER"] = edges
+            if profiler is not None:
+                self.current["PROFILE"] = self.dump(name, profiler)
+            self.stages.append(self.current)
+            self.current = None
+
+    def step(self, name, wall):
+        """Record the wall time of a step within the current stage.
+
+        Args:
+            name (str): step name
+            wall (float): step wall time in seconds
+        """
+        if self.current is not None:
+            self.current["STEPS"].append({"NAME": name, "WALL": wall})
+
+    def dump(self, name, profiler):
+        """Dump the cProfile statistics of a stage.
+
+        Args:
+            name (str): stage name
+            profiler (cProfile.Profile): finished stage profiler
+        Returns:
+            str: statistics file path
+        """
+        path = os.path.join(
+            self.profile_dir,
+            "{}-{}.prof".format(self.started.strftime("%Y%m%dT%H%M%S"), name),
+        )
+        profiler.dump_stats(path)
+        return path
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the retention and compaction of the TRAINS movement history.
+
+The raw berth steps of every train are only kept for a retention window. Older
+steps are first rolled up into hourly aggregates, the number of movements
+through each berth in BERTH_HOURLY and the number and total traversal time of
+the movements along each edge in EDGE_HOURLY, and are then trimmed from the
+TRAINS arrays. The hourly aggregates are themselves expired by TTL indexes.
+
+Each compaction rolls up the steps between the previous cutoff, stored in the
+GENERATOR_STATE collection, and the new cutoff before trimming, so a compaction
+that fails part way never counts a step twice. The last step before the cutoff
+is kept on every train so the edge into the first retained step is not lost.
+"""
+
+import datetime
+
+from common.berths import BerthClass, classes_expression
+
+
+class RetentionCompactor(object):
+    """Rolls up and trims the TRAINS history older than the retention window."""
+
+    def __init__(self, log, mongo, retention_hours, rollup_days, delta_b, delta_t):
+        """Initialise RetentionCompactor.
+
+        Args:
+            log (logging.logger): Logger to use
+            mongo (common.mongo.Mongo): Database class
+            retention_hours (int): Hours of raw steps to keep, disabled if 0
+            rollup_days (int): Days of hourly aggregates to keep
+            delta_b (int): Berths within delta seconds will be classed as the same
+            delta_t (int): Split train data when there is a gap of delta hours
+        """
+        self.log = log
+        self.mongo = mongo
+        self.retention_hours = retention_hours
+        self.rollup_days = rollup_days
+        self.delta_b = delta_b
+        self.delta_t = delta_t
+
+    def enabled(self):
+        """Check if the retention window is enabled.
+
+        Returns:
+            bool: True if old steps are rolled up and trimmed
+        """
+        return self.retention_hours > 0
+
+    def create_indexes(self):
+        """Create the unique merge and TTL indexes of the hourly aggregates."""
+        ttl = self.rollup_days * 24 * 3600
+        self.mongo.create_index(
+            "EDGE_HOURLY", [("FROM", 1), ("TO", 1), ("HOUR", 1)], unique=True
+        )
+        self.mongo.create_index("EDGE_HOURLY", [("HOUR", 1)], expireAfterSeconds=ttl)
+        self.mongo.create_index("BERTH_HOURLY", [("NAME", 1), ("HOUR", 1)], unique=True)
+        self.mongo.create_index("BERTH_HOURLY", [("HOUR", 1)], expireAfterSeconds=ttl)
+
+    def compact(self, now=None):
+        """Roll up and trim the steps older than the retention window.
+
+        Args:
+            now (datetime.datetime): current time, the wall clock if None
+        """
+        now = now if now is not None else datetime.datetime.now()
+        # Keep at least one split window so journeys are never cut short
+        hours = max(self.retention_hours, self.delta_t)
+        cutoff = now - datetime.timedelta(hours=hours)
+        previous = self.get_cutoff()
+        if previous is not None and previous >= cutoff:
+            return
+
+        # Roll up, then record the cutoff before trimming so nothing is counted twice
+        for into, pipeline in [
+            ("BERTH_HOURLY", self.berth_pipeline(previous, cutoff)),
+            ("EDGE_HOURLY", self.edge_pipeline(previous, cutoff)),
+        ]:
+            if self.mongo.aggregate("TRAINS", pipeline) is None:
+                raise Exception("Could not roll up the TRAINS into {}!".format(into))
+        update = {"$set": {"LATEST_TIME": cutoff}}
+        self.mongo.update("GENERATOR_STATE", {"NAME": "RETENTION"}, update)
+
+        self.trim(cutoff)
+
+    def get_cutoff(self):
+        """Get the cutoff of the previous compaction.
+
+        Returns:
+            datetime.datetime: previous cutoff, None if never compacted
+        """
+        state = self.mongo.get("GENERATOR_STATE", {"NAME": "RETENTION"})
+        for doc in state if state is not None else []:
+            return doc.get("LATEST_TIME")
+        return None
+
+    def steps_pipeline(self, previous, cutoff):
+        """Get the pipeline of the steps through real berths to roll up.
+
+        Each step is paired with the step before it in the same train.
+
+        Args:
+            previous (datetime.datetime): previous cutoff, None if never compacted
+            cutoff (datetime.datetime): new cutoff
+        Returns:
+            [dict]: aggregation pipeline stages
+        """
+        window = {"$lt": cutoff}
+        if previous is not None:
+            window["$gte"] = previous
+
+        def shifted(field):
+            return {"$concatArrays": [[None], field]}
+
+        classes = classes_expression("$BERTHS", "$CLASSES")
+        fields = ["BERTH", "TIME", "CLASS", "PREV", "PREV_TIME", "PREV_CLASS"]
+        return [
+            {"$match": {"TIMES": {"$elemMatch": window}}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "STEPS": {
+                        "$zip": {
+                            "inputs": [
+                                "$BERTHS",
+                                "$TIMES",
+                                classes,
+                                shifted("$BERTHS"),
+                                shifted("$TIMES"),
+                                shifted(classes),
+                            ]
+                        }
+                    },
+                }
+            },
+            {"$unwind": "$STEPS"},
+            {
+                "$project": {
+                    field: {"$arrayElemAt": ["$STEPS", i]}
+                    for i, field in enumerate(fields)
+                }
+            },
+            {"$match": {"TIME": window, "CLASS": int(BerthClass.REAL)}},
+        ]
+
+    def berth_pipeline(self, previous, cutoff):
+        """Get the pipeline rolling up the movements through each berth.
+
+        Args:
+            previous (datetime.datetime): previous cutoff, None if never compacted
+            cutoff (datetime.datetime): new cutoff
+        Returns:
+            [dict]: aggregation pipeline stages
+        """
+        return self.steps_pipeline(previous, cutoff) + [
+            {
+                "$group": {
+                    "_id": {
+                        "NAME": "$BERTH",
+                        "HOUR": {"$dateTrunc": {"date": "$TIME", "unit": "hour"}},
+                    },
+                    "MOVEMENTS": {"$sum": 1},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "NAME": "$_id.NAME",
+                    "HOUR": "$_id.HOUR",
+                    "MOVEMENTS": 1,
+                }
+            },
+            {
+                "$merge": {
+                    "into": "BERTH_HOURLY",
+                    "on": ["NAME", "HOUR"],
+                    "whenMatched": [
+                        {
+                            "$set": {
+                                "MOVEMENTS": {"$add": ["$MOVEMENTS", "$$new.MOVEMENTS"]}
+                            }
+                        }
+                    ],
+                    "whenNotMatched": "insert",
+                }
+            },
+        ]
+
+    def edge_pipeline(self, previous, cutoff):
+        """Get the pipeline rolling up the movements along each edge.
+
+        Only steps between real berths more than delta_b seconds and less than
+        delta_t hours apart are counted as movements along an edge.
+
+        Args:
+            previous (datetime.datetime): previous cutoff, None if never compacted
+            cutoff (datetime.datetime): new cutoff
+        Returns:
+            [dict]: aggregation pipeline stages
+        """
+        return self.steps_pipeline(previous, cutoff) + [
+            {
+                "$set": {
+                    "SECONDS": {
+                        "$divide": [{"$subtract": ["$TIME", "$PREV_TIME"]}, 1000]
+                    }
+                }
+            },
+            {
+                "$match": {
+                    "PREV_CLASS": int(BerthClass.REAL),
+                    "SECONDS": {"$gte": self.delta_b, "$lt": self.delta_t * 3600},
+                    "$expr": {"$ne": ["$PREV", "$BERTH"]},
+                }
+            },
+            {
+                "$group": {
+                    "_id": {
+                        "FROM": "$PREV",
+                        "TO": "$BERTH",
+                        "HOUR": {"$dateTrunc": {"date": "$TIME", "unit": "hour"}},
+                    },
+                    "COUNT": {"$sum": 1},
+                    "SUM": {"$sum": "$SECONDS"},
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "FROM": "$_id.FROM",
+                    "TO": "$_id.TO",
+                    "HOUR": "$_id.HOUR",
+                    "COUNT": 1,
+                    "SUM": 1,
+                }
+            },
+            {
+                "$merge": {
+                    "into": "EDGE_HOURLY",
+                    "on": ["FROM", "TO", "HOUR"],
+                    "whenMatched": [
+                        {
+                            "$set": {
+                                "COUNT": {"$add": ["$COUNT", "$$new.COUNT"]},
+                                "SUM": {"$add": ["$SUM", "$$new.SUM"]},
+                            }
+                        }
+                    ],
+                    "whenNotMatched": "insert",
+                }
+            },
+        ]
+
+    def trim(self, cutoff):
+        """Remove the steps before the cutoff from the TRAINS.
+
+        Args:
+            cutoff (datetime.datetime): time before which steps are removed
+        """
+        # Trains with no steps after the cutoff are removed entirely
+        selection = {"TIMES": {"$not": {"$elemMatch": {"$gte": cutoff}}}}
+        deleted = self.mongo.delete("TRAINS", selection, many=True)
+        if deleted is None:
+            raise Exception("Could not remove the idle TRAINS!")
+
+        # Keep the last step before the cutoff and everything after it
+        old = {
+            "$size": {
+                "$filter": {"input": "$TIMES", "cond": {"$lt": ["$$this", cutoff]}}
+            }
+        }
+        start = {"$max": [{"$subtract": [old, 1]}, 0]}
+
+        def trimmed(field):
+            return {"$slice": [field, start, {"$size": field}]}
+
+        update = [
+            {
+                "$set": {
+                    "BERTHS": trimmed("$BERTHS"),
+                    "TIMES": trimmed("$TIMES"),
+                    "CLASSES": trimmed(classes_expression("$BERTHS", "$CLASSES")),
+                }
+            }
+        ]
+        selection = {"TIMES.1": {"$lt": cutoff}}
+        result = self.mongo.update("TRAINS", selection, update, many=True, upsert=False)
+        if result is None:
+            raise Exception("Could not trim the TRAINS!")
+
+        self.log.info(
+            "Removed {} idle trains and trimmed {} trains before {}".format(
+                deleted.deleted_count, result.modified_count, cutoff
+            )
+        )
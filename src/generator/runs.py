@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""Command line tool to inspect and compare the recorded generator runs.
+
+Every generator run writes its per stage profile to the GENERATOR_RUNS
+collection. This tool lists the recent runs and compares the median stage
+costs of the runs after a point in time, such as a deploy, against the runs
+before it, exiting with a non zero status if any stage has regressed.
+
+Usage:
+    python runs.py list -n 10
+    python runs.py compare --since 2021-06-01T12:00:00 --threshold 0.2
+"""
+
+import sys
+import logging
+import argparse
+import datetime
+
+import numpy as np
+
+from common.config import Config
+from common.mongo import Mongo
+
+
+log = logging.getLogger("generator_runs")
+
+# Stage metrics that are compared and the smallest change worth flagging
+METRIC_FLOORS = {"WALL": 1.0, "CPU": 1.0, "PEAK_MB": 16.0}
+
+
+def get_runs(mongo, before=None, since=None, limit=10, completed=True):
+    """Get the most recent recorded runs.
+
+    Args:
+        mongo (common.mongo.Mongo): database class
+        before (datetime.datetime): only runs started before this time
+        since (datetime.datetime): only runs started at or after this time
+        limit (int): maximum number of runs
+        completed (bool): only include runs that completed
+    Returns:
+        [dict]: runs, newest first
+    """
+    selection = {}
+    if completed:
+        selection["COMPLETED"] = True
+    if before is not None or since is not None:
+        selection["START"] = {}
+    if before is not None:
+        selection["START"]["$lt"] = before
+    if since is not None:
+        selection["START"]["$gte"] = since
+
+    pipeline = [{"$match": selection}, {"$sort": {"START": -1}}, {"$limit": limit}]
+    result = mongo.aggregate("GENERATOR_RUNS", pipeline)
+    if result is None:
+        raise Exception("Could not get the generator runs!")
+    return list(result)
+
+
+def stage_medians(runs):
+    """Get the median of each metric of each stage over a set of runs.
+
+    Args:
+        runs ([dict]): recorded runs
+    Returns:
+        dict: stage names mapped to the median of each metric
+    """
+    values = {}
+    for run in runs:
+        for stage in run["STAGES"]:
+            metrics = values.setdefault(stage["NAME"], {})
+            for metric in METRIC_FLOORS:
+                if stage.get(metric) is not None:
+                    metrics.setdefault(metric, []).append(stage[metric])
+    return {
+        name: {metric: float(np.median(v)) for metric, v in metrics.items()}
+        for name, metrics in values.items()
+    }
+
+
+def compare_runs(baseline, candidate, threshold):
+    """Compare the stage costs of two sets of runs.
+
+    A stage metric has regressed if its candidate median is more than the
+    threshold fraction above the baseline median, and by more than the floor
+    for that metric so noise on very quick stages is ignored.
+
+    Args:
+        baseline ([dict]): runs to compare against
+        candidate ([dict]): runs to check for regressions
+        threshold (float): allowed fractional increase
+    Returns:
+        [dict]: stage, metric, baseline, candidate, change and regressed flag
+    """
+    before = stage_medians(baseline)
+    after = stage_medians(candidate)
+    rows = []
+    for name, metrics in after.items():
+        for metric, value in metrics.items():
+            base = before.get(name, {}).get(metric)
+            if base is None:
+                continue
+            change = (value - base) / base if base > 0 else 0.0
+            rows.append(
+                {
+                    "stage": name,
+                    "metric": metric,
+                    "baseline": base,
+                    "candidate": value,
+                    "change": change,
+                    "regressed": change > threshold
+                    and value - base > METRIC_FLOORS[metric],
+                }
+            )
+    return rows
+
+
+def print_runs(runs):
+    """Print a table of runs.
+
+    Args:
+        runs ([dict]): recorded runs
+    """
+    row = "{:<20} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}"
+    print(
+        row.format("start", "completed", "wall_s", "cpu_s", "peak_mb", "nodes", "edges")
+    )
+    for run in runs:
+        last = run["STAGES"][-1] if run["STAGES"] else {}
+        print(
+            row.format(
+                run["START"].strftime("%Y-%m-%d %H:%M:%S"),
+                str(run["COMPLETED"]),
+                "{:.1f}".format(run["WALL"]),
+                "{:.1f}".format(run["CPU"]),
+                "{:.1f}".format(run["PEAK_MB"] or float("nan")),
+                str(last.get("NODES_AFTER")),
+                str(last.get("EDGES_AFTER")),
+            )
+        )
+
+
+def print_comparison(rows):
+    """Print a table of the stage comparisons.
+
+    Args:
+        rows ([dict]): comparisons from compare_runs
+    """
+    row = "{:<10} {:<8} {:>10} {:>10} {:>8} {}"
+    print(row.format("stage", "metric", "baseline", "candidate", "change", ""))
+    for r in rows:
+        print(
+            row.format(
+                r["stage"],
+                r["metric"],
+                "{:.2f}".format(r["baseline"]),
+                "{:.2f}".format(r["candidate"]),
+                "{:+.0%}".format(r["change"]),
+                "REGRESSED" if r["regressed"] else "",
+            )
+        )
+
+
+def main():
+    """Call when the runs tool is run from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--uri", default=Config.MONGO_URI, help="MongoDB URI")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runs = commands.add_parser("list", help="list the recent runs")
+    runs.add_argument("-n", type=int, default=10, help="number of runs")
+    runs.add_argument("--all", action="store_true", help="include failed runs")
+
+    compare = commands.add_parser("compare", help="check the runs for regressions")
+    compare.add_argument(
+        "--since",
+        type=datetime.datetime.fromisoformat,
+        help="UTC start of the candidate runs, only the latest run if not set",
+    )
+    compare.add_argument("--baseline", type=int, default=5, help="baseline runs")
+    compare.add_argument("--candidate", type=int, default=5, help="candidate runs")
+    compare.add_argument("--threshold", type=float, default=0.2, help="allowed change")
+
+    args = parser.parse_args()
+    Config.init_logging(log)
+    mongo = Mongo.connect(log, args.uri)
+    if mongo is None:
+        raise ConnectionError
+
+    if args.command == "list":
+        print_runs(get_runs(mongo, limit=args.n, completed=not args.all))
+        return
+
+    if args.since is None:
+        candidate = get_runs(mongo, limit=1)
+        since = candidate[0]["START"] if candidate else None
+    else:
+        since = args.since
+        candidate = get_runs(mongo, since=since, limit=args.candidate)
+    baseline = get_runs(mongo, before=since, limit=args.baseline)
+    if not candidate or not baseline:
+        parser.error("not enough completed runs to compare")
+
+    rows = compare_runs(baseline, candidate, args.threshold)
+    print_comparison(rows)
+    if any(r["regressed"] for r in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""Implements the data driven scheduling of the graph generator runs.
+
+Instead of sleeping a fixed time between runs the scheduler polls two cheap
+counters, the number of berth movements the collector has seen and the number
+of berth connections in the BERTHS collection. A run is started once enough
+new movements or new edges have arrived since the last run, or once the graph
+is older than the maximum staleness and there is at least some new data. All
+deadlines use the monotonic clock and are anchored to the start of the last
+run, so slow runs don't drift the schedule. A run that fails is retried after
+a back off that doubles with each failure, up to the maximum staleness. A lease
+document in the GENERATOR_STATE collection stops two generators from running at
+once.
+"""
+
+import os
+import time
+import socket
+import datetime
+
+# How long a run may hold the lease before another generator can take it over
+LEASE_SECONDS = 6 * 3600
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Total number of berth connections, each new edge adds one to each berth
+EDGE_COUNT_PIPELINE = [
+    {
+        "$group": {
+            "_id": None,
+            "COUNT": {"$sum": {"$size": {"$ifNull": ["$CONNECTIONS", []]}}},
+        }
+    }
+]
+
+
+class RunScheduler(object):
+    """Decides when the graph generator should run next."""
+
+    def __init__(self, log, mongo, max_staleness, poll_rate, min_movements, min_edges):
+        """Initialise RunScheduler.
+
+        Args:
+            log (logging.logger): Logger to use
+            mongo (common.mongo.Mongo): Database class
+            max_staleness (int): Maximum seconds between runs with new data
+            poll_rate (int): Seconds between checks of the counters
+            min_movements (int): New movements that trigger a run, 0 to disable
+            min_edges (int): New edges that trigger a run, 0 to disable
+        """
+        self.log = log
+        self.mongo = mongo
+        self.max_staleness = max_staleness
+        self.poll_rate = poll_rate
+        self.min_movements = min_movements
+        self.min_edges = min_edges
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.last_run = None
+        self.last_counts = None
+        self.failures = 0
+        self.retry_time = None
+
+    def get_counts(self):
+        """Get the current movement and edge counters.
+
+        Returns:
+            int: total movements counted by the collector
+            int: total berth connections
+        """
+        movements = 0
+        counters = self.mongo.get("COUNTERS", {"NAME": "MOVEMENTS"})
+        for doc in counters if counters is not None else []:
+            movements = doc.get("COUNT", 0)
+
+        edges = 0
+        result = self.mongo.aggregate("BERTHS", EDGE_COUNT_PIPELINE)
+        for doc in result if result is not None else []:
+            edges = doc["COUNT"] // 2
+        return movements, edges
+
+    def decide(self, counts, now):
+        """Decide if a run is due.
+
+        Args:
+            counts ((int, int)): current movement and edge counters
+            now (float): current monotonic time
+        Returns:
+            str: reason for the run, None if no run is due
+            float: monotonic time of the next check
+        """
+        if self.retry_time is not None and now < self.retry_time:
+            return None, min(now + self.poll_rate, self.retry_time)
+        if self.last_run is None:
+            return "startup", now
+
+        new_movements, new_edges = self.pending(counts)
+        if self.min_edges > 0 and new_edges >= self.min_edges:
+            return "edges", now
+        if self.min_movements > 0 and new_movements >= self.min_movements:
+            return "movements", now
+
+        deadline = self.last_run + self.max_staleness
+        if now < deadline:
+            return None, min(now + self.poll_rate, deadline)
+        if new_movements > 0 or new_edges > 0:
+            return "stale", now
+        return None, now + self.poll_rate
+
+    def failed(self, now):
+        """Back off after a failed run before trying again.
+
+        Args:
+            now (float): monotonic time the run failed
+        Returns:
+            float: seconds until the next try
+        """
+        self.failures += 1
+        delay = min(self.poll_rate * 2**self.failures, self.max_staleness)
+        self.retry_time = now + delay
+        return delay
+
+    def succeeded(self, counts, now):
+        """Record a completed run.
+
+        Args:
+            counts ((int, int)): movement and edge counters the run started from
+            now (float): monotonic time the run started
+        """
+        self.last_run = now
+        self.last_counts = counts
+        self.failures = 0
+        self.retry_time = None
+
+    def pending(self, counts):
+        """Get the amount of new data since the last completed run.
+
+        Args:
+            counts ((int, int)): current movement and edge counters
+        Returns:
+            int: new movements
+            int: new edges
+        """
+        if self.last_counts is None:
+            return 0, 0
+        return (
+            max(counts[0] - self.last_counts[0], 0),
+            max(counts[1] - self.last_counts[1], 0),
+        )
+
+    def acquire(self):
+        """Take the run lease unless another generator holds it.
+
+        Returns:
+            bool: True if the lease was taken, False if another generator holds
+                it, None if the database could not be reached
+        """
+        # Make sure the lease exists, so taking it never needs an insert
+        lease = {"$setOnInsert": {"OWNER": None, "EXPIRES": EPOCH}}
+        if self.mongo.update("GENERATOR_STATE", {"NAME": "LEASE"}, lease) is None:
+            return None
+
+        now = datetime.datetime.utcnow()
+        selection = {
+            "NAME": "LEASE",
+            "$or": [{"OWNER": self.owner}, {"EXPIRES": {"$lte": now}}],
+        }
+        update = {
+            "$set": {
+                "OWNER": self.owner,
+                "EXPIRES": now + datetime.timedelta(seconds=LEASE_SECONDS),
+            }
+        }
+        result = self.mongo.update("GENERATOR_STATE", selection, update, upsert=False)
+        if result is None:
+            return None
+        return result.matched_count > 0
+
+    def release(self):
+        """Give up the run lease."""
+        self.mongo.update(
+            "GENERATOR_STATE",
+            {"NAME": "LEASE", "OWNER": self.owner},
+            {"$set": {"EXPIRES": datetime.datetime.utcnow()}},
+            upsert=False,
+        )
+
+    def publish(self, counts, reason, now):
+        """Expose the next run reason and time in the GENERATOR_STATE collection.
+
+        Args:
+            counts ((int, int)): current movement and edge counters
+            reason (str): reason for a run starting now, None if none is due
+            now (float): current monotonic time
+        """
+        new_movements, new_edges = self.pending(counts)
+        state = {
+            "NEW_MOVEMENTS": new_movements,
+            "NEW_EDGES": new_edges,
+            "NEXT_REASON": reason,
+            "NEXT_TIME": datetime.datetime.utcnow(),
+        }
+        if reason is None and self.retry_time is not None and now < self.retry_time:
+            state["NEXT_REASON"] = "retry"
+            state["NEXT_TIME"] += datetime.timedelta(seconds=self.retry_time - now)
+        elif reason is None and (new_movements > 0 or new_edges > 0):
+            # Without more data the next run is when the graph becomes stale
+            delay = max(self.last_run + self.max_staleness - now, 0)
+            state["NEXT_REASON"] = "stale"
+            state["NEXT_TIME"] += datetime.timedelta(seconds=delay)
+        elif reason is None:
+            state["NEXT_REASON"] = "waiting for data"
+            state["NEXT_TIME"] = None
+        self.mongo.update("GENERATOR_STATE", {"NAME": "SCHEDULE"}, {"$set": state})
+
+    def run(self, gen):
+        """Run the graph generator whenever it is due, forever.
+
+        Args:
+            gen (generator.GraphGenerator): graph generator to run
+        """
+        while 1:
+            counts = self.get_counts()
+            now = time.monotonic()
+            reason, next_time = self.decide(counts, now)
+            if reason is None:
+                self.publish(counts, None, now)
+                time.sleep(max(next_time - now, 0))
+                continue
+
+            acquired = self.acquire()
+            if not acquired:
+                if acquired is None:
+                    self.log.warning("Could not take the run lease")
+                else:
+                    self.log.info("Another generator holds the run lease")
+                self.publish(counts, reason, now)
+                time.sleep(self.poll_rate)
+                continue
+
+            self.log.info("Running the graph generator ({})".format(reason))
+            self.publish(counts, reason, now)
+            try:
+                completed = gen.run()
+            finally:
+                self.release()
+
+            last = {"LAST_TIME": datetime.datetime.utcnow(), "LAST_REASON": reason}
+            self.mongo.update("GENERATOR_STATE", {"NAME": "SCHEDULE"}, {"$set": last})
+            if completed:
+                self.succeeded(counts, now)
+            else:
+                delay = self.failed(time.monotonic())
+                self.log.info("Retrying the failed run in {:.0f} secs".format(delay))
@@ -0,0 +1,49 @@
+import re
+
+from common.berths import BerthClass, class_expression, classes_expression, classify
+
+# The single regex valid berths were previously matched against
+VALID_BERTH_REGEX = "^(?!..(LS|TR|SMT))(?!.*(STIN|COUT|DATE|TIME|CLCK|LS)$).{6}$"
+
+NAMES = [
+    "C10123",
+    "WJ0B12",
+    "C1LS01",
+    "C1TR12",
+    "C1SMT1",
+    "C101LS",
+    "C1STIN",
+    "C1COUT",
+    "C1DATE",
+    "C1TIME",
+    "C1CLCK",
+    "C1012",
+    "C101234",
+    "",
+]
+
+
+def test_classify():
+    assert classify("C10123") == BerthClass.REAL
+    assert classify("C1LS01") == BerthClass.LINK_STATUS
+    assert classify("C1COUT") == BerthClass.STRIKE
+    assert classify("C1CLCK") == BerthClass.CLOCK
+    assert classify("C1012") == BerthClass.MALFORMED
+
+
+def test_real_matches_previous_filter():
+    for name in NAMES:
+        real = classify(name) == BerthClass.REAL
+        assert real == bool(re.match(VALID_BERTH_REGEX, name)), name
+
+
+def test_class_expression_follows_rules():
+    branches = class_expression("$NAME")["$switch"]["branches"]
+    assert [b["then"] for b in branches] == [1, 2, 3, 4]
+    assert all(b["case"]["$regexMatch"]["input"] == "$NAME" for b in branches)
+
+
+def test_classes_expression_falls_back_to_classifying():
+    expression = classes_expression("$BERTHS", "$CLASSES")["$cond"]
+    assert expression[1] == "$CLASSES"
+    assert expression[2]["$map"]["in"] == class_expression("$$berth")
@@ -0,0 +1,157 @@
+import queue
+import logging
+import datetime
+
+from pymongo.errors import PyMongoError
+
+import common.broadcast
+from common.broadcast import QUEUE_SIZE, BerthBroadcaster, changed_states
+
+TIME = datetime.datetime(2021, 1, 1, 12)
+
+
+def test_only_changed_berths_are_reported():
+    states = {}
+    docs = [
+        {"NAME": "AB0001", "LATEST_TRAIN": "1A01", "LATEST_TIME": TIME},
+        {"NAME": "AB0002", "LATEST_TRAIN": "0000", "LATEST_TIME": TIME},
+    ]
+    assert changed_states(states, docs)["NAMES"] == ["AB0001", "AB0002"]
+
+    docs[1] = {"NAME": "AB0002", "LATEST_TRAIN": "1A01", "LATEST_TIME": TIME}
+    assert changed_states(states, docs) == {
+        "NAMES": ["AB0002"],
+        "TRAINS": ["1A01"],
+        "TIMES": [str(TIME)],
+    }
+
+
+def test_changes_fan_out_and_slow_clients_drop_them():
+    broadcaster = BerthBroadcaster(logging.getLogger(), None)
+    fast, slow = broadcaster.subscribe(), broadcaster.subscribe()
+    changes = {"NAMES": ["AB0001"], "TRAINS": ["1A01"], "TIMES": [str(TIME)]}
+    for _ in range(QUEUE_SIZE + 1):
+        broadcaster.publish(changes)
+        fast.get_nowait()
+    assert fast.empty()
+    assert slow.qsize() == QUEUE_SIZE
+
+    broadcaster.unsubscribe(slow)
+    assert broadcaster.subscribers == {fast}
+
+
+def test_streams_are_capped():
+    broadcaster = BerthBroadcaster(logging.getLogger(), None, max_subscribers=1)
+    first = broadcaster.subscribe()
+    assert broadcaster.subscribe() is None
+    broadcaster.unsubscribe(first)
+    assert broadcaster.subscribe() is not None
+
+
+class FailingStream(object):
+    def __init__(self, changes):
+        self.changes = changes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def try_next(self):
+        if not self.changes:
+            raise PyMongoError("stream lost")
+        return self.changes.pop(0)
+
+
+class StreamMongo(object):
+    def __init__(self, broadcaster, streams):
+        self.broadcaster = broadcaster
+        self.streams = streams
+
+    def watch(self, collection, pipeline=None, **kwargs):
+        if not self.streams:
+            # Every client has left once the streams run out
+            self.broadcaster.subscribers.clear()
+            return FailingStream([])
+        return FailingStream(self.streams.pop(0))
+
+
+def test_failed_change_streams_are_reopened(monkeypatch):
+    monkeypatch.setattr(common.broadcast.time, "sleep", lambda seconds: None)
+    broadcaster = BerthBroadcaster(logging.getLogger(), None)
+    change = {"fullDocument": {"NAME": "AB0001", "LATEST_TRAIN": "1A01"}}
+    broadcaster.mongo = StreamMongo(broadcaster, [[change], [], [change]])
+    subscriber = queue.Queue()
+    broadcaster.subscribers.add(subscriber)
+    broadcaster.run()
+    assert subscriber.qsize() == 2
+    assert broadcaster.thread is None
+
+
+class FailingCursor(object):
+    def __iter__(self):
+        raise PyMongoError("cursor lost")
+
+
+class PollMongo(object):
+    def __init__(self, broadcaster, polls, supported=False):
+        self.broadcaster = broadcaster
+        self.polls = polls
+        self.supported = supported
+        self.watched = 0
+
+    def watch(self, collection, pipeline=None, **kwargs):
+        self.watched += 1
+        return None
+
+    def supports_change_streams(self):
+        return self.supported
+
+    def get(self, collection, selection=None, projection=None, sort=None):
+        if not self.polls:
+            self.broadcaster.subscribers.clear()
+            return []
+        return self.polls.pop(0)
+
+
+def test_failed_polls_back_off(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(common.broadcast.time, "sleep", sleeps.append)
+    broadcaster = BerthBroadcaster(logging.getLogger(), None)
+    later = TIME + datetime.timedelta(seconds=10)
+    polls = [
+        FailingCursor(),
+        [{"NAME": "AB0001", "LATEST_TRAIN": "1A01", "LATEST_TIME": TIME}],
+        FailingCursor(),
+        FailingCursor(),
+        [{"NAME": "AB0001", "LATEST_TRAIN": "2B02", "LATEST_TIME": later}],
+    ]
+    broadcaster.mongo = PollMongo(broadcaster, polls)
+    subscriber = queue.Queue()
+    broadcaster.subscribers.add(subscriber)
+    broadcaster.run()
+    assert subscriber.get_nowait()["TRAINS"] == ["2B02"]
+    assert sleeps[:5] == [
+        common.broadcast.RETRY_DELAY,
+        common.broadcast.POLL_INTERVAL,
+        common.broadcast.RETRY_DELAY,
+        common.broadcast.RETRY_DELAY * 2,
+        common.broadcast.POLL_INTERVAL,
+    ]
+
+
+def test_change_stream_errors_do_not_fall_back_to_polling(monkeypatch):
+    monkeypatch.setattr(common.broadcast.time, "sleep", lambda seconds: None)
+    broadcaster = BerthBroadcaster(logging.getLogger(), None)
+    broadcaster.mongo = PollMongo(broadcaster, [], supported=True)
+    broadcaster.subscribers.add(queue.Queue())
+
+    # Leave once the change stream has been tried a few times
+    def active():
+        return broadcaster.mongo.watched < 3
+
+    broadcaster.active = active
+    broadcaster.run()
+    assert broadcaster.mongo.watched == 3
+    assert broadcaster.subscribers
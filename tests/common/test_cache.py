@@ -0,0 +1,53 @@
+import time
+import threading
+
+from common.cache import FileCache
+
+
+def test_entries_expire_and_follow_versions(tmp_path):
+    cache = FileCache(str(tmp_path), 60)
+    cache.set("figure", {"data": [1]}, version=1)
+
+    assert cache.get("figure", version=1) == {"data": [1]}
+    assert cache.get("figure", version=2) is None
+    cache.invalidate("figure")
+    assert cache.get("figure", version=1) is None
+
+    cache.ttl = 0.01
+    cache.set("figure", {"data": [1]})
+    time.sleep(0.02)
+    assert cache.get("figure") is None
+    assert cache.last("figure") == {"data": [1]}
+
+
+def test_disabled_cache_always_builds(tmp_path):
+    cache = FileCache(str(tmp_path), 0)
+    builds = []
+    for _ in range(3):
+        cache.get_or_build("figure", lambda: builds.append(1) or len(builds))
+    assert len(builds) == 3
+
+
+def test_concurrent_requests_build_once(tmp_path):
+    cache = FileCache(str(tmp_path), 60)
+    builds = []
+
+    def build():
+        builds.append(1)
+        time.sleep(0.1)
+        return {"data": [1]}
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.get_or_build("figure", build))
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(builds) == 1
+    assert results == [{"data": [1]}] * 8
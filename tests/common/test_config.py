@@ -9,19 +9,34 @@ def check_base_attributes(config):
         "MONGO_PASS",
         "MONGO_URI",
         "DASH_MAPBOX_TOKEN",
+        "DASH_CACHE_DIR",
+        "DASH_CACHE_TTL",
+        "DASH_MAX_STREAMS",
         "COLLECTOR_NR_USER",
         "COLLECTOR_NR_PASS",
         "COLLECTOR_ATTEMPTS",
         "COLLECTOR_PPM",
         "COLLECTOR_TD",
         "COLLECTOR_TM",
+        "COLLECTOR_EDGES",
         "GENERATOR_RATE",
+        "GENERATOR_POLL_RATE",
+        "GENERATOR_MIN_MOVEMENTS",
+        "GENERATOR_MIN_EDGES",
         "GENERATOR_K",
         "GENERATOR_ITER",
         "GENERATOR_CUT_D",
         "GENERATOR_SCALE",
+        "GENERATOR_LAYOUT",
+        "GENERATOR_CHUNK_SIZE",
+        "GENERATOR_WORKERS",
         "GENERATOR_DELTA_B",
         "GENERATOR_DELTA_T",
+        "GENERATOR_CHECKPOINTS",
+        "GENERATOR_RETENTION_HOURS",
+        "GENERATOR_ROLLUP_DAYS",
+        "GENERATOR_TRACE_MEMORY",
+        "GENERATOR_PROFILES",
     ]
     types = [
         str,
@@ -29,18 +44,33 @@ def check_base_attributes(config):
         str,
         str,
         str,
+        int,
+        int,
+        str,
         str,
         int,
         bool,
         bool,
         bool,
+        bool,
+        int,
+        int,
+        int,
         int,
         float,
         int,
         float,
         int,
+        str,
         int,
         int,
+        int,
+        int,
+        str,
+        int,
+        int,
+        bool,
+        str,
     ]
     errors = []
     for i, attribute in enumerate(attributes):
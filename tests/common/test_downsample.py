@@ -0,0 +1,25 @@
+import numpy as np
+
+from common.downsample import lttb
+
+
+def test_short_series_are_kept():
+    assert lttb(np.arange(5), np.arange(5), 10).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_keeps_the_ends_and_the_peaks():
+    x = np.arange(1000)
+    y = np.sin(x / 50.0)
+    y[321] = 10
+    y[777] = -10
+    selected = lttb(x, y, 50)
+    assert len(selected) == 50
+    assert selected[0] == 0 and selected[-1] == 999
+    assert np.all(np.diff(selected) > 0)
+    assert 321 in selected and 777 in selected
+
+
+def test_datetimes_are_downsampled():
+    x = np.arange("2021-01-01", "2021-01-05", dtype="datetime64[m]")
+    selected = lttb(x, np.random.default_rng(0).random(len(x)), 100)
+    assert len(selected) == 100
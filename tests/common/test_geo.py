@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from common.geo import grid_to_latlon, osgb_to_wgs84
+
+
+def test_grid_to_latlon_matches_ordnance_survey_example():
+    # Worked example from the Ordnance Survey guide to coordinate systems
+    lat, lon = grid_to_latlon(np.array([651409.903]), np.array([313177.270]))
+    assert np.degrees(lat[0]) == pytest.approx(52.657570, abs=1e-6)
+    assert np.degrees(lon[0]) == pytest.approx(1.717922, abs=1e-6)
+
+
+def test_osgb_to_wgs84_applies_datum_shift():
+    lat, lon = osgb_to_wgs84([651409.903, 651409.903], [313177.270, 313177.270])
+    assert lat.shape == (2,)
+    assert np.allclose(lat, 52.657979, atol=1e-5)
+    assert np.allclose(lon, 1.716052, atol=1e-5)
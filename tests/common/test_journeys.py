@@ -0,0 +1,119 @@
+import random
+import datetime
+
+import pandas as pd
+
+from common.journeys import ChunkSegmenter, JourneySegmenter, segment_trains
+
+START = datetime.datetime(2021, 1, 1)
+
+
+def batch_edges(steps, delta_b, delta_t):
+    # The generator's segmentation of the full history of a train
+    t = pd.DataFrame(steps, columns=["BERTHS", "TIMES"])
+    t["DELTAS"] = t["TIMES"] - t["TIMES"].shift()
+    t = t.iloc[1:]
+    t = t[t["DELTAS"] >= datetime.timedelta(seconds=delta_b)]
+    t = t.reset_index()
+    t = t.loc[t["BERTHS"].shift(-1) != t["BERTHS"]].reset_index(drop=True)
+    splits = t.index[t["DELTAS"] >= datetime.timedelta(hours=delta_t)].tolist()
+    splits = [0] + splits + [len(t.index)]
+    edges = []
+    for n in range(len(splits) - 1):
+        path = t.iloc[splits[n] : splits[n + 1]]  # noqa: E203
+        for b_from, b_to, delta in zip(
+            path["BERTHS"], path["BERTHS"][1:], path["DELTAS"][1:]
+        ):
+            edges.append((b_from, b_to, delta.total_seconds()))
+    return edges
+
+
+def online_edges(steps, delta_b, delta_t):
+    segmenter = JourneySegmenter(delta_b, delta_t)
+    edges = []
+    for berth, time in steps:
+        edges.extend(segmenter.step("1A01", berth, time))
+    edges.extend(segmenter.evict(steps[-1][1] + datetime.timedelta(hours=delta_t)))
+    return [(b_from, b_to, seconds) for b_from, b_to, seconds, _ in edges]
+
+
+def chunked_edges(trains, delta_b, delta_t, size):
+    segmenter = ChunkSegmenter(delta_b, delta_t)
+    steps = [(train, b, t) for train, path in trains for b, t in path]
+    chunks = [steps[i : i + size] for i in range(0, len(steps), size)]  # noqa: E203
+    edges = []
+    for chunk in chunks:
+        b_from, b_to, seconds, _, _ = segmenter.chunk(*zip(*chunk))
+        edges.extend(zip(b_from, b_to, seconds.tolist()))
+    b_from, b_to, seconds, _, _ = segmenter.finish()
+    edges.extend(zip(b_from, b_to, seconds.tolist()))
+    return edges
+
+
+def test_segments_a_journey():
+    seconds = [0, 30, 32, 60, 90, 4000, 4030]
+    berths = ["A", "B", "C", "C", "D", "E", "F"]
+    steps = [
+        (b, START + datetime.timedelta(seconds=s)) for b, s in zip(berths, seconds)
+    ]
+    assert online_edges(steps, 5, 1) == [
+        ("B", "C", 28.0),
+        ("C", "D", 30.0),
+        ("E", "F", 30.0),
+    ]
+
+
+def test_matches_batch_segmentation():
+    rng = random.Random(1)
+    for _ in range(50):
+        time, steps = START, []
+        for _ in range(rng.randint(2, 60)):
+            time += datetime.timedelta(seconds=rng.choice([0, 2, 30, 90, 4000]))
+            steps.append((rng.choice("ABCD"), time))
+        assert online_edges(steps, 5, 1) == batch_edges(steps, 5, 1)
+
+
+def test_chunked_matches_batch_segmentation():
+    rng = random.Random(2)
+    for _ in range(50):
+        trains = []
+        for train in range(rng.randint(1, 5)):
+            time, steps = START, []
+            for _ in range(rng.randint(1, 30)):
+                time += datetime.timedelta(seconds=rng.choice([0, 2, 30, 90, 4000]))
+                steps.append((rng.choice("ABCD"), time))
+            trains.append((train, steps))
+        expected = [e for _, steps in trains for e in batch_edges(steps, 5, 1)]
+        for size in [1, 3, 1000]:
+            assert chunked_edges(trains, 5, 1, size) == expected
+
+
+def test_counts_each_traversal_once():
+    def run(path, counted):
+        steps = [
+            {"TRAIN": "1A01", "BERTH": b, "TIME": START + datetime.timedelta(seconds=s)}
+            for b, s in path
+        ]
+        if counted is not None:
+            for step in steps:
+                step["COUNTED"] = counted
+        _, _, sketches, progress = segment_trains(iter(steps), 5, 1, 2, None)
+        return {key: sketch.count for key, sketch in sketches.items()}, progress
+
+    # The edge into the last berth is only counted once the train moves on
+    path = [("A", 0), ("B", 30), ("C", 90)]
+    counts, progress = run(path, None)
+    assert counts == {} and progress == {}
+
+    # Repeating the last berth in a later run does not count the edge
+    counts, progress = run(path + [("C", 200)], None)
+    assert counts == {}
+    path += [("C", 200), ("D", 260), ("E", 300)]
+    counts, progress = run(path, None)
+    assert counts == {("B", "C"): 1, ("C", "D"): 1}
+    counted = progress["1A01"]
+
+    # Once counted, only the edges confirmed after the train's progress are new
+    path += [("E", 400), ("F", 450), ("G", 500)]
+    counts, _ = run(path, counted)
+    assert counts == {("D", "E"): 1, ("E", "F"): 1}
@@ -0,0 +1,65 @@
+import datetime
+
+from common.layers import (
+    build_dynamic_layer,
+    build_static_layer,
+    decode_layer,
+    diff_dynamic_layers,
+    encode_layer,
+)
+
+BERTHS = [
+    {"NAME": "AB0001", "LATITUDE": 53.0, "LONGITUDE": -2.0, "EDGES": [["AB0002"]]},
+    {
+        "NAME": "AB0002",
+        "LATITUDE": 53.1,
+        "LONGITUDE": -2.1,
+        "DESCRIPTION": "Signal",
+        "FIXED": True,
+        "EDGES": [["AB0001", "AB0003"]],
+    },
+]
+
+
+def test_static_layer_keeps_edges_between_selected_berths():
+    layer = build_static_layer(BERTHS)
+    assert layer["NAMES"] == ["AB0001", "AB0002"]
+    assert layer["EDGES"] == [[0, 1]]
+    assert "Description: Signal" in layer["TEXT"][1]
+    assert "Fixed: False" in layer["TEXT"][0]
+
+
+def test_encoded_layer_round_trips_with_a_stable_etag():
+    layer = build_static_layer(BERTHS)
+    data, etag = encode_layer(layer)
+    assert decode_layer(data) == layer
+    assert encode_layer(build_static_layer(BERTHS)) == (data, etag)
+    assert encode_layer(build_static_layer(BERTHS[:1]))[1] != etag
+
+
+def test_dynamic_layer_defaults_unoccupied_berths():
+    time = datetime.datetime(2021, 1, 1, 12)
+    berths = [
+        {"NAME": "AB0001"},
+        {"NAME": "AB0002", "LATEST_TRAIN": "1A01", "LATEST_TIME": time},
+    ]
+    layer = build_dynamic_layer(berths, {"AB0002": 3}, "e")
+    assert layer["NAMES"] == ["AB0001", "AB0002"]
+    assert layer["TRAINS"] == ["0000", "1A01"]
+    assert layer["TIMES"] == ["None", "2021-01-01 12:00:00"]
+    assert layer["USAGE"] == [0, 3]
+
+
+def test_patch_holds_only_the_changed_berths():
+    time = datetime.datetime(2021, 1, 1, 12)
+    names = ["AB0001", "AB0002", "AB0003"]
+    berths = [{"NAME": name, "LATEST_TIME": time} for name in names]
+    old = build_dynamic_layer(berths, {}, "e")
+    berths[1] = {"NAME": "AB0002", "LATEST_TRAIN": "1A01", "LATEST_TIME": time}
+    new = build_dynamic_layer(berths[::-1], {"AB0003": 1}, "e")
+    assert diff_dynamic_layers(old, new) == {
+        "NAMES": ["AB0003", "AB0002"],
+        "TRAINS": ["0000", "1A01"],
+        "TIMES": [str(time), str(time)],
+        "USAGE": [1, 0],
+    }
@@ -0,0 +1,60 @@
+import datetime
+
+import numpy as np
+
+from common.downsample import lttb
+from common.ppm import (
+    READ_FACTOR,
+    bucket,
+    choose_resolution,
+    rollup_means,
+    rollup_update,
+)
+
+TIME = datetime.datetime(2021, 3, 4, 5, 6, 7)
+
+
+def test_buckets_start_at_each_resolution():
+    assert bucket(TIME, "minute") == datetime.datetime(2021, 3, 4, 5, 6)
+    assert bucket(TIME, "hour") == datetime.datetime(2021, 3, 4, 5)
+    assert bucket(TIME, "day") == datetime.datetime(2021, 3, 4)
+
+
+def test_finest_resolution_within_the_rows_is_chosen():
+    day = datetime.timedelta(days=1)
+    assert choose_resolution(TIME, TIME + day / 2, 1000)[1] == "PPM_MINUTE"
+    assert choose_resolution(TIME, TIME + 30 * day, 1000)[1] == "PPM_HOUR"
+    assert choose_resolution(TIME, TIME + 3000 * day, 1000)[1] == "PPM_DAY"
+
+
+def test_a_day_is_read_by_minute_and_downsampled():
+    day = datetime.timedelta(days=1)
+    unit, collection = choose_resolution(TIME, TIME + day, READ_FACTOR * 1000)
+    assert (unit, collection) == ("minute", "PPM_MINUTE")
+
+    # A peak within an hour is kept rather than averaged into the hour
+    dates = np.arange(1440).astype("timedelta64[m]") + np.datetime64(TIME)
+    ppm = np.full(1440, 90.0)
+    ppm[::7] = 89.0
+    ppm[601] = 40.0
+    keep = lttb(dates, ppm, 1000)
+    assert len(keep) == 1000
+    assert 601 in keep
+
+
+def test_means_of_incremental_rollups():
+    rollup = {"date": TIME, "count": 0}
+    for ppm in [90.0, 80.0]:
+        doc = {"total": 10, "on_time": 9, "late": 1, "ppm": ppm, "rolling_ppm": 85.0}
+        for field, value in rollup_update(doc)["$inc"].items():
+            rollup[field] = rollup.get(field, 0) + value
+    assert rollup_means([rollup]) == [
+        {
+            "date": TIME,
+            "total": 10,
+            "on_time": 9,
+            "late": 1,
+            "ppm": 85.0,
+            "rolling_ppm": 85.0,
+        }
+    ]
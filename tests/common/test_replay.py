@@ -0,0 +1,111 @@
+import datetime
+
+from common.replay import (
+    OCCUPANCY_HOLD,
+    REPLAY_BACKFILL,
+    build_frames,
+    get_window,
+    keyframe_start,
+    occupancy_changes,
+    update_frames,
+)
+
+START = datetime.datetime(2021, 3, 4, 10, 0)
+
+
+class FrameMongo:
+    def __init__(self, steps=()):
+        self.steps = list(steps)
+        self.frames = {}
+
+    def aggregate(self, collection, pipeline):
+        return self.steps
+
+    def update(self, collection, selection, update):
+        self.frames[selection["MINUTE"]] = update["$set"]
+        return True
+
+    def get(self, collection, selection, sort=None):
+        within = selection["MINUTE"]
+        return [
+            self.frames[minute]
+            for minute in sorted(self.frames)
+            if within["$gte"] <= minute < within["$lt"]
+        ]
+
+
+def at(seconds):
+    return START + datetime.timedelta(seconds=seconds)
+
+
+def test_keyframes_start_every_quarter_hour():
+    assert keyframe_start(at(29 * 60 + 5)) == at(15 * 60)
+    assert keyframe_start(START) == START
+
+
+def test_trains_leave_their_last_berth_and_replace_other_trains():
+    steps = [
+        (at(0), "1A01", "AB0001"),
+        (at(30), "1A01", "AB0002"),
+        (at(40), "2B02", "AB0002"),
+    ]
+    assert occupancy_changes(steps) == [
+        (at(0), "AB0001", "1A01"),
+        (at(30), "AB0001", "0000"),
+        (at(30), "AB0002", "1A01"),
+        (at(40), "AB0002", "2B02"),
+        (at(40) + OCCUPANCY_HOLD, "AB0002", "0000"),
+    ]
+
+
+def test_frames_hold_real_berth_changes_and_keyframes():
+    steps = [
+        (at(-60), "1A01", "AB0001"),
+        (at(30), "1A01", "ABSTIN"),
+        (at(15 * 60 + 5), "2B02", "AB0002"),
+    ]
+    frames = build_frames(steps, START, at(20 * 60))
+    assert [frame["MINUTE"] for frame in frames] == [START, at(15 * 60)]
+    assert frames[0]["KEYFRAME"] == {"NAMES": ["AB0001"], "TRAINS": ["1A01"]}
+    assert frames[0]["NAMES"] == ["AB0001"]
+    assert frames[0]["TRAINS"] == ["0000"]
+    assert frames[0]["OFFSETS"] == [30000]
+    assert frames[1]["KEYFRAME"] == {"NAMES": [], "TRAINS": []}
+    assert frames[1]["OFFSETS"] == [5000]
+
+
+def test_first_run_starts_at_a_keyframe():
+    mongo = FrameMongo([{"TIME": at(-60), "TRAIN": "1A01", "BERTH": "AB0001"}])
+    now = at(7 * 60 + 30)
+    assert update_frames(mongo, None, now) == at(7 * 60)
+    first = min(mongo.frames)
+    assert (
+        first == keyframe_start(at(7 * 60) - REPLAY_BACKFILL) == START - REPLAY_BACKFILL
+    )
+    assert "KEYFRAME" in mongo.frames[first]
+    window = get_window(mongo, at(-60), at(60))
+    assert window["KEYFRAME"] == str(START - datetime.timedelta(minutes=15))
+    assert window["OCCUPANCY"] == {"NAMES": [], "TRAINS": []}
+    assert window["NAMES"] == ["AB0001"]
+
+
+def test_windows_start_from_the_next_keyframe():
+    steps = [
+        (at(-60), "1A01", "AB0001"),
+        (at(5 * 60), "2B02", "AB0002"),
+        (at(15 * 60 + 5), "1A01", "AB0003"),
+    ]
+    mongo = FrameMongo()
+    for frame in build_frames(steps, START, at(20 * 60)):
+        mongo.update("REPLAY_FRAMES", {"MINUTE": frame["MINUTE"]}, {"$set": frame})
+    del mongo.frames[START]
+
+    window = get_window(mongo, at(60), at(20 * 60))
+    assert window["KEYFRAME"] == str(at(15 * 60))
+    assert window["OCCUPANCY"] == {
+        "NAMES": ["AB0001", "AB0002"],
+        "TRAINS": ["1A01", "2B02"],
+    }
+    assert window["OFFSETS"] == [5000, 5000]
+    assert window["NAMES"] == ["AB0001", "AB0003"]
+    assert get_window(mongo, at(60), at(10 * 60)) is None
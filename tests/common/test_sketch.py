@@ -0,0 +1,52 @@
+import random
+
+from common.sketch import QuantileSketch
+
+
+def test_quantile_accuracy():
+    sketch = QuantileSketch(accuracy=0.02)
+    values = [random.uniform(5, 600) for _ in range(10000)]
+    for value in values:
+        sketch.add(value)
+
+    values.sort()
+    for q in [0.1, 0.5, 0.9]:
+        exact = values[int(q * (len(values) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= 0.02 * exact + 1e-9
+
+
+def test_mean_and_count():
+    sketch = QuantileSketch()
+    assert sketch.mean() is None
+    assert sketch.quantile(0.5) is None
+    for value in [10, 20, 30]:
+        sketch.add(value)
+    assert sketch.count == 3
+    assert sketch.mean() == 20
+
+
+def test_merge_matches_single_sketch():
+    single, first, second = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for value in range(1, 1000):
+        single.add(value)
+        (first if value % 2 else second).add(value)
+    first.merge(second)
+    assert first.bins == single.bins
+    assert first.quantile(0.9) == single.quantile(0.9)
+
+
+def test_bins_are_bounded():
+    sketch = QuantileSketch(min_value=1.0, max_value=3600.0)
+    for value in [0.0, 0.5, 1e9, 3600.0, 1.0]:
+        sketch.add(value)
+    assert len(sketch.bins) == 2
+
+
+def test_doc_round_trip():
+    sketch = QuantileSketch()
+    for value in [5, 50, 500]:
+        sketch.add(value)
+    copy = QuantileSketch.from_doc(sketch.to_doc())
+    assert copy.bins == sketch.bins
+    assert copy.count == sketch.count
+    assert copy.to_inc()["COUNT"] == 3
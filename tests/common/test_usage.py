@@ -0,0 +1,24 @@
+import datetime
+
+from common.usage import bucket, count_steps
+
+START = datetime.datetime(2021, 1, 1, 12)
+
+
+def test_steps_are_counted_per_minute():
+    steps = [
+        ("AB0001", START + datetime.timedelta(seconds=1)),
+        ("AB0001", START + datetime.timedelta(seconds=59)),
+        ("AB0001", START + datetime.timedelta(seconds=60)),
+        ("AB0002", START + datetime.timedelta(seconds=30)),
+    ]
+    assert count_steps(steps) == {
+        ("AB0001", START): 2,
+        ("AB0001", START + datetime.timedelta(minutes=1)): 1,
+        ("AB0002", START): 1,
+    }
+
+
+def test_bucket_truncates_to_the_minute():
+    time = START + datetime.timedelta(minutes=3, seconds=7, microseconds=9)
+    assert bucket(time) == START + datetime.timedelta(minutes=3)
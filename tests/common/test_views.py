@@ -0,0 +1,84 @@
+from common.layers import build_static_layer
+from common.views import LayerIndex, clip_bounds, fit_view
+
+# A line of berths a kilometre or so apart with a branch off the second
+BERTHS = [
+    {"NAME": "AB0001", "LATITUDE": 53.00, "LONGITUDE": -2.00, "EDGES": [["AB0002"]]},
+    {
+        "NAME": "AB0002",
+        "LATITUDE": 53.01,
+        "LONGITUDE": -2.00,
+        "EDGES": [["AB0003", "AB0004"]],
+    },
+    {"NAME": "AB0003", "LATITUDE": 53.02, "LONGITUDE": -2.00, "EDGES": [[]]},
+    {"NAME": "AB0004", "LATITUDE": 53.50, "LONGITUDE": -2.50, "EDGES": [[]]},
+]
+LAYER = build_static_layer(BERTHS)
+INDEX = LayerIndex(LAYER)
+EVERYWHERE = (-180.0, -85.0, 180.0, 85.0)
+
+
+def test_detail_view_keeps_the_neighbours_of_berths_in_view():
+    view = INDEX.detail_view((-2.05, 52.99, -1.95, 53.005))
+    assert view["GROUPS"] == [["AB0001"], ["AB0002"]]
+    assert view["EDGES"] == [[0, 1]]
+    assert view["TEXT"] == LAYER["TEXT"][:2]
+
+
+def test_zoomed_out_berths_are_clustered_without_self_edges():
+    view = INDEX.cluster_view(4, EVERYWHERE)
+    assert sorted(map(sorted, view["GROUPS"])) == [
+        ["AB0001", "AB0002", "AB0003"],
+        ["AB0004"],
+    ]
+    assert view["EDGES"] == [[0, 1]] or view["EDGES"] == [[1, 0]]
+    big = [len(group) for group in view["GROUPS"]].index(3)
+    assert view["LATITUDE"][big] == 53.01
+    assert view["TEXT"][big] == "Berths: 3<br />"
+
+
+def test_zoomed_in_clusters_are_single_berths():
+    view = INDEX.cluster_view(16, EVERYWHERE)
+    assert len(view["GROUPS"]) == 4
+    assert len(view["EDGES"]) == 3
+
+
+def test_clusters_out_of_view_are_culled_unless_joined():
+    view = INDEX.cluster_view(16, (-2.1, 52.9, -1.9, 53.005))
+    assert view["GROUPS"] == [["AB0001"], ["AB0002"]]
+    view = INDEX.cluster_view(16, (10.0, 10.0, 11.0, 11.0))
+    assert view["GROUPS"] == [] and view["EDGES"] == []
+
+
+def test_fit_view_centres_on_the_berths():
+    (lat, lon), zoom = fit_view(LAYER)
+    assert 53.0 < lat < 53.5 and lon == -2.25
+    assert 8 <= zoom <= 11
+
+
+def test_berths_are_found_from_the_grid():
+    assert INDEX.within(EVERYWHERE).tolist() == [0, 1, 2, 3]
+    assert INDEX.within((-2.6, 53.4, -2.4, 53.6)).tolist() == [3]
+    assert INDEX.within((-2.01, 53.005, -1.99, 53.03)).tolist() == [1, 2]
+    assert INDEX.incident(INDEX.within((-2.6, 53.4, -2.4, 53.6))).tolist() == [2]
+
+
+def test_views_switch_to_berths_at_the_detail_zoom():
+    index = LayerIndex(LAYER)
+    bounds = (-2.1, 52.9, -1.9, 53.005)
+    assert index.view(10, bounds) == index.cluster_view(10, bounds)
+    assert index.view(11, bounds) == index.detail_view(bounds)
+    assert list(index.clusterings) == [10]
+
+
+def test_bounds_that_are_not_finite_are_rejected():
+    nan = float("nan")
+    assert clip_bounds((-2.1, nan, -1.9, 53.0)) is None
+    assert clip_bounds((-2.1, 52.9, float("inf"), 53.0)) is None
+    assert INDEX.within((-2.1, nan, -1.9, 53.0)).tolist() == []
+
+
+def test_huge_bounds_are_clipped_to_the_globe():
+    assert clip_bounds((-1e300, -1e7, 1e300, 1e7)) == (-180.0, -90.0, 180.0, 90.0)
+    assert clip_bounds((-2.1, 52.9, -1.9, 53.0)) == (-2.1, 52.9, -1.9, 53.0)
+    assert INDEX.within((-1e300, -1e7, 1e300, 1e7)).tolist() == [0, 1, 2, 3]
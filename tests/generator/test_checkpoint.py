@@ -0,0 +1,63 @@
+import os
+import logging
+
+import numpy as np
+
+from generator.checkpoint import CheckpointCache, stage_keys
+
+WATERMARK = {"BERTHS": 10, "LATEST_TIME": "2021-03-04 12:00:00"}
+STAGES = [("build", {"delta_b": 5}), ("tidy", {"cut_d": 3}), ("layout", {"k": 1})]
+
+
+def make_cache(tmp_path, **kwargs):
+    return CheckpointCache(logging.getLogger(), str(tmp_path), **kwargs)
+
+
+def test_changed_params_change_their_stage_and_later_keys():
+    keys = stage_keys(WATERMARK, STAGES)
+    changed = stage_keys(WATERMARK, [STAGES[0], ("tidy", {"cut_d": 4}), STAGES[2]])
+    assert changed[0] == keys[0]
+    assert changed[1] != keys[1] and changed[2] != keys[2]
+    assert stage_keys(WATERMARK, STAGES) == keys
+    assert stage_keys({**WATERMARK, "BERTHS": 11}, STAGES)[0] != keys[0]
+
+
+def test_resume_from_the_deepest_valid_checkpoint(tmp_path):
+    cache = make_cache(tmp_path)
+    keys = stage_keys(WATERMARK, STAGES)
+    assert cache.resume(keys) == (0, None)
+
+    cache.save(keys[0], {"lat": np.zeros(3)})
+    cache.save(keys[1], {"lat": np.ones(3)})
+    start, arrays = cache.resume(keys)
+    assert start == 2
+    assert arrays["lat"].tolist() == [1.0, 1.0, 1.0]
+
+
+def test_corrupt_checkpoints_are_skipped(tmp_path):
+    cache = make_cache(tmp_path)
+    keys = stage_keys(WATERMARK, STAGES)
+    cache.save(keys[0], {"lat": np.zeros(3)})
+    cache.save(keys[1], {"lat": np.ones(1000)})
+    with open(cache.path(keys[2]), "wb") as checkpoint_file:
+        checkpoint_file.write(b"not a checkpoint")
+
+    # Truncate the middle checkpoint as if its write was cut short
+    size = os.path.getsize(cache.path(keys[1]))
+    with open(cache.path(keys[1]), "r+b") as checkpoint_file:
+        checkpoint_file.truncate(size // 2)
+
+    start, arrays = cache.resume(keys)
+    assert start == 1
+    assert arrays["lat"].tolist() == [0.0, 0.0, 0.0]
+
+
+def test_pruning_keeps_the_newest_checkpoints(tmp_path):
+    cache = make_cache(tmp_path)
+    for i in range(70):
+        cache.save("stage-{:02d}".format(i), {"lat": np.zeros(1)})
+        os.utime(cache.path("stage-{:02d}".format(i)), (i, i))
+    cache.prune()
+    kept = sorted(os.listdir(str(tmp_path)))
+    assert len(kept) == 64
+    assert kept[0] == "stage-06.npz" and kept[-1] == "stage-69.npz"
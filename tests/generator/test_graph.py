@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+from generator.graph import CSRGraph
+
+
+def make_graph(src, dst, n, fixed=None):
+    names = ["AB{:04d}".format(i) for i in range(n)]
+    lat = np.arange(n, dtype=float)
+    lon = np.zeros(n)
+    if fixed is None:
+        fixed = np.zeros(n, dtype=bool)
+    return CSRGraph.from_edges(names, lat, lon, fixed, src, dst)
+
+
+def test_from_edges_is_undirected_and_unique():
+    graph = make_graph([0, 1, 1, 2, 2], [1, 0, 2, 2, 3], 5)
+    assert graph.number_of_nodes() == 5
+    assert graph.number_of_edges() == 3
+    assert graph.neighbours(1).tolist() == [0, 2]
+    assert graph.isolates().tolist() == [4]
+
+
+def test_largest_component():
+    graph = make_graph([0, 1, 3], [1, 2, 4], 6)
+    n_components, _ = graph.connected_components()
+    assert n_components == 3
+    largest = graph.largest_component()
+    assert largest.names.tolist() == ["AB0000", "AB0001", "AB0002"]
+    assert largest.number_of_edges() == 2
+
+
+def test_subgraph_renumbers_nodes():
+    graph = make_graph([0, 1, 2], [1, 2, 3], 4)
+    sub = graph.subgraph(np.array([False, True, True, True]))
+    assert sub.names.tolist() == ["AB0001", "AB0002", "AB0003"]
+    assert sub.lat.tolist() == [1.0, 2.0, 3.0]
+    assert sub.neighbours(1).tolist() == [0, 2]
+
+
+def test_remove_edges_and_lengths():
+    graph = make_graph([0, 1, 2], [1, 2, 3], 4)
+    src, dst, lengths = graph.edge_lengths()
+    assert lengths.tolist() == [1.0, 1.0, 1.0]
+    cut = graph.remove_edges(src[1:2], dst[1:2])
+    assert cut.number_of_nodes() == 4
+    assert cut.number_of_edges() == 2
+    assert not cut.has_edges([1], [2])[0]
+
+
+def test_set_weights():
+    graph = make_graph([0, 1], [1, 2], 3)
+    graph.set_weights([1], [2], [5.0])
+    assert graph.matrix()[2, 1] == 5.0
+    assert graph.matrix()[1, 2] == 5.0
+    assert graph.matrix()[0, 1] == 1.0
+
+
+def test_stats_follow_the_edges():
+    graph = make_graph([0, 1, 2], [1, 2, 3], 4)
+    graph.set_stats([2], [1], [[3, 40.0, 35.0, 60.0]])
+    sub = CSRGraph.from_arrays(graph.subgraph([1, 2, 3]).to_arrays())
+    assert sub.stats[sub.entries([0], [1])[1]].tolist() == [[3, 40.0, 35.0, 60.0]]
+    assert np.isnan(sub.stats[sub.entries([1], [2])[0]]).all()
+    contracted = graph.contract([0, 0, 2, 3])
+    assert contracted.stats[contracted.entries([0], [1])[0], 0].tolist() == [3]
+
+
+def test_contract_merges_edges():
+    graph = make_graph([0, 1, 2], [1, 2, 3], 4)
+    contracted = graph.contract([0, 1, 1, 3])
+    assert contracted.names.tolist() == ["AB0000", "AB0001", "AB0003"]
+    assert contracted.number_of_edges() == 2
+
+
+def test_networkx_export():
+    pytest.importorskip("networkx")
+    graph = make_graph([0, 1], [1, 2], 3)
+    nx_graph = graph.to_networkx()
+    assert sorted(nx_graph.edges) == [("AB0000", "AB0001"), ("AB0001", "AB0002")]
+    graph.set_stats([0], [1], [[3, 40.0, 35.0, 60.0]])
+    nx_graph = graph.to_networkx()
+    assert nx_graph.edges["AB0000", "AB0001"]["p90"] == 60.0
+    assert "count" not in nx_graph.edges["AB0001", "AB0002"]
+
+
+def test_biconnected_blocks():
+    # A triangle with a tail hanging off one corner
+    graph = make_graph([0, 1, 2, 2], [1, 2, 0, 3], 4)
+    block_ptr, blocks = graph.biconnected_blocks()
+    found = sorted(
+        sorted(blocks[s:e].tolist()) for s, e in zip(block_ptr, block_ptr[1:])
+    )
+    assert found == [[0, 1, 2], [2, 3]]
+
+
+def test_between_fixed():
+    # A fixed path 0-1-2 with a loop 1-3-4-1 and a spur 2-5
+    graph = make_graph([0, 1, 1, 3, 4, 2], [1, 2, 3, 4, 1, 5], 6)
+    graph.fixed[[0, 2]] = True
+    assert graph.between_fixed().tolist() == [True, True, True, False, False, False]
+
+    # Once a loop node is fixed the whole loop lies between fixed nodes
+    graph.fixed[4] = True
+    assert graph.between_fixed().tolist() == [True, True, True, True, True, False]
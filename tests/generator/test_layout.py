@@ -0,0 +1,96 @@
+import numpy as np
+
+from generator.graph import CSRGraph
+from generator.layout import (
+    coarsen,
+    harmonic_placement,
+    multilevel_layout,
+    repulsion_block,
+    spring_layout,
+)
+
+
+def test_chain_settles_between_fixed_nodes():
+    n = 5
+    fixed = np.array([True, False, False, False, True])
+    lat = np.array([0.0, np.nan, np.nan, np.nan, 4.0])
+    lon = np.array([0.0, np.nan, np.nan, np.nan, 0.0])
+    graph = CSRGraph.from_edges(
+        [str(i) for i in range(n)], lat, lon, fixed, [0, 1, 2, 3], [1, 2, 3, 4]
+    )
+    pos = np.column_stack([lat, lon])
+    pos = spring_layout(
+        graph.indptr, graph.indices, graph.weights, pos, fixed, 0.5, 500, seed=1
+    )
+
+    # Fixed nodes stay where they are and the chain lies between them
+    assert pos[0].tolist() == [0.0, 0.0]
+    assert pos[4].tolist() == [4.0, 0.0]
+    assert np.all((pos[1:4, 0] > 0.0) & (pos[1:4, 0] < 4.0))
+
+
+def anchored_chain(n, every):
+    fixed = np.arange(n) % every == 0
+    fixed[-1] = True
+    lat = np.where(fixed, np.arange(n, dtype=np.float64), np.nan)
+    lon = np.where(fixed, 0.0, np.nan)
+    graph = CSRGraph.from_edges(
+        [str(i) for i in range(n)], lat, lon, fixed, range(n - 1), range(1, n)
+    )
+    return graph, np.column_stack([lat, lon]), fixed
+
+
+def test_repulsion_blocks_stay_within_the_budget():
+    assert repulsion_block(20000) * 20000 * 40 <= 64 * 2**20
+    assert repulsion_block(10**9) == 1
+
+    graph, pos, fixed = anchored_chain(50, 10)
+    args = (graph.indptr, graph.indices, graph.weights, pos, fixed, 0.5, 20)
+    whole = spring_layout(*args, seed=1)
+    rows = spring_layout(*args, seed=1, block=7)
+    assert np.allclose(whole, rows)
+
+
+def test_coarsen_never_merges_fixed_nodes():
+    graph, _, fixed = anchored_chain(400, 2)
+    rng = np.random.default_rng(0)
+    mapping, (indptr, _, _) = coarsen(
+        graph.indptr, graph.indices, graph.weights, fixed, rng
+    )
+
+    # Every coarse node holds at most one fixed node and the chain shrinks
+    assert np.bincount(mapping[fixed]).max() == 1
+    assert len(indptr) - 1 < 400
+
+
+def test_multilevel_places_chain_between_fixed_nodes():
+    n = 400
+    graph, pos, fixed = anchored_chain(n, 50)
+    pos = multilevel_layout(
+        graph.indptr, graph.indices, graph.weights, pos, fixed, 0.5, 200, seed=1
+    )
+
+    # Fixed nodes stay put and free nodes stay near their place along the chain
+    assert np.array_equal(pos[fixed, 0], np.flatnonzero(fixed))
+    assert np.all(np.isfinite(pos))
+    assert np.median(np.abs(pos[:, 0] - np.arange(n))) < 10.0
+
+
+def test_harmonic_placement_interpolates_between_known_nodes():
+    graph, pos, fixed = anchored_chain(11, 5)
+    pos = harmonic_placement(graph.indptr, graph.indices, graph.weights, pos, fixed)
+
+    # Free nodes of the equally weighted chain are spaced evenly
+    assert np.allclose(pos[:, 0], np.arange(11))
+    assert np.allclose(pos[:, 1], 0.0)
+
+
+def test_harmonic_placement_leaves_unreachable_nodes():
+    fixed = np.array([True, False, False, False])
+    lat = np.array([1.0, np.nan, np.nan, np.nan])
+    graph = CSRGraph.from_edges(["0", "1", "2", "3"], lat, lat, fixed, [0, 2], [1, 3])
+    pos = np.column_stack([lat, lat])
+    pos = harmonic_placement(graph.indptr, graph.indices, graph.weights, pos, fixed)
+
+    assert pos[1].tolist() == [1.0, 1.0]
+    assert np.isnan(pos[2:]).all()
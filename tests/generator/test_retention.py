@@ -0,0 +1,284 @@
+import re
+import logging
+import datetime
+import collections
+
+from generator.retention import RetentionCompactor
+
+NOW = datetime.datetime(2021, 3, 4, 12, 0)
+CUTOFF = NOW - datetime.timedelta(hours=2)
+Result = collections.namedtuple("Result", ["deleted_count", "modified_count"])
+
+
+def at(hour, minute=0):
+    return NOW.replace(hour=hour, minute=minute)
+
+
+def get_path(doc, path):
+    for key in path.split("."):
+        if isinstance(doc, list):
+            doc = doc[int(key)] if int(key) < len(doc) else None
+        elif isinstance(doc, dict):
+            doc = doc.get(key)
+        else:
+            return None
+    return doc
+
+
+def evaluate(expr, doc, variables=None):
+    # Just the aggregation expressions the compactor builds
+    variables = variables or {}
+    if isinstance(expr, str) and expr.startswith("$$"):
+        name, _, path = expr[2:].partition(".")
+        return get_path(variables[name], path) if path else variables[name]
+    if isinstance(expr, str) and expr.startswith("$"):
+        return get_path(doc, expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(e, doc, variables) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) != 1 or not next(iter(expr)).startswith("$"):
+        return {k: evaluate(v, doc, variables) for k, v in expr.items()}
+
+    ((op, arg),) = expr.items()
+    if op in ["$map", "$filter"]:
+        name = arg.get("as", "this")
+        items = evaluate(arg["input"], doc, variables)
+        key = "in" if op == "$map" else "cond"
+        results = [evaluate(arg[key], doc, {**variables, name: i}) for i in items]
+        if op == "$map":
+            return results
+        return [i for i, keep in zip(items, results) if keep]
+    if op == "$switch":
+        for branch in arg["branches"]:
+            if evaluate(branch["case"], doc, variables):
+                return evaluate(branch["then"], doc, variables)
+        return evaluate(arg["default"], doc, variables)
+    if op == "$regexMatch":
+        value = evaluate(arg["input"], doc, variables)
+        return re.search(arg["regex"], value) is not None
+    if op == "$zip":
+        return [list(t) for t in zip(*evaluate(arg["inputs"], doc, variables))]
+    if op == "$dateTrunc":
+        return evaluate(arg["date"], doc, variables).replace(minute=0, second=0)
+    if op == "$cond":
+        test, then, otherwise = arg
+        branch = then if evaluate(test, doc, variables) else otherwise
+        return evaluate(branch, doc, variables)
+
+    args = evaluate(arg, doc, variables)
+    if op == "$ifNull":
+        return next((a for a in args if a is not None), None)
+    if op == "$size":
+        return len(args)
+    if op in ["$subtract", "$divide"] and None in args:
+        return None
+    if op == "$subtract":
+        difference = args[0] - args[1]
+        if isinstance(difference, datetime.timedelta):
+            return difference / datetime.timedelta(milliseconds=1)
+        return difference
+    if op == "$slice":
+        array, start, length = args
+        return array[start:][:length]
+    if op == "$concatArrays":
+        return [item for array in args for item in array]
+    operators = {
+        "$eq": lambda a: a[0] == a[1],
+        "$ne": lambda a: a[0] != a[1],
+        "$lt": lambda a: a[0] < a[1],
+        "$max": max,
+        "$divide": lambda a: a[0] / a[1],
+        "$arrayElemAt": lambda a: a[0][a[1]],
+    }
+    return operators[op](args)
+
+
+def matches_condition(value, condition):
+    if not isinstance(condition, dict):
+        return condition in value if isinstance(value, list) else value == condition
+    for op, arg in condition.items():
+        if op == "$not":
+            if matches_condition(value, arg):
+                return False
+        elif op == "$elemMatch":
+            if not any(matches_condition(v, arg) for v in value or []):
+                return False
+        elif value is None:
+            return False
+        elif op == "$lt" and not value < arg:
+            return False
+        elif op == "$gte" and not value >= arg:
+            return False
+    return True
+
+
+def matches(selection, doc):
+    for key, condition in selection.items():
+        if key == "$expr":
+            if not evaluate(condition, doc):
+                return False
+        elif not matches_condition(get_path(doc, key), condition):
+            return False
+    return True
+
+
+class TrainsMongo(object):
+    def __init__(self, trains, cutoff=None):
+        self.trains = trains
+        self.cutoff = cutoff
+        self.rollups = {"BERTH_HOURLY": [], "EDGE_HOURLY": []}
+
+    def get(self, collection, selection=None):
+        if self.cutoff is None:
+            return []
+        return [{"NAME": "RETENTION", "LATEST_TIME": self.cutoff}]
+
+    def delete(self, collection, selection, many=False):
+        kept = [doc for doc in self.trains if not matches(selection, doc)]
+        deleted = len(self.trains) - len(kept)
+        self.trains = kept
+        return Result(deleted, 0)
+
+    def update(self, collection, selection, update, many=False, upsert=True):
+        if collection == "GENERATOR_STATE":
+            self.cutoff = update["$set"]["LATEST_TIME"]
+            return Result(0, 1)
+        modified = 0
+        for doc in self.trains:
+            if matches(selection, doc):
+                # The fields of a $set stage are all computed from the input doc
+                doc.update(evaluate(update[0]["$set"], doc))
+                modified += 1
+        return Result(0, modified)
+
+    def aggregate(self, collection, pipeline):
+        docs = [dict(doc) for doc in self.trains]
+        for stage in pipeline:
+            ((op, arg),) = stage.items()
+            if op == "$match":
+                docs = [doc for doc in docs if matches(arg, doc)]
+            elif op == "$unwind":
+                field = arg[1:]
+                docs = [{**doc, field: item} for doc in docs for item in doc[field]]
+            elif op == "$set":
+                docs = [{**doc, **evaluate(arg, doc)} for doc in docs]
+            elif op == "$project":
+                docs = [
+                    {
+                        k: doc.get(k) if v == 1 else evaluate(v, doc)
+                        for k, v in arg.items()
+                        if v != 0
+                    }
+                    for doc in docs
+                ]
+            elif op == "$group":
+                groups = {}
+                for doc in docs:
+                    key = evaluate(arg["_id"], doc)
+                    group = groups.setdefault(
+                        tuple(sorted(key.items())),
+                        {"_id": key, **{f: 0 for f in arg if f != "_id"}},
+                    )
+                    for field, accumulator in arg.items():
+                        if field != "_id":
+                            group[field] += evaluate(accumulator["$sum"], doc)
+                docs = list(groups.values())
+            elif op == "$merge":
+                self.rollups[arg["into"]].extend(docs)
+        return []
+
+
+def make_trains():
+    return [
+        {
+            "NAME": "1A01",
+            "BERTHS": ["AB0001", "AB0002", "ABSTIN", "AB0003", "AB0004"],
+            "TIMES": [at(9), at(9, 10), at(9, 20), at(9, 50), at(10, 30)],
+            "CLASSES": [0, 0, 3, 0, 0],
+        },
+        {
+            "NAME": "2B02",
+            "BERTHS": ["AB0005", "AB0006"],
+            "TIMES": [at(8), at(8, 5)],
+            "CLASSES": [0, 0],
+        },
+        {
+            "NAME": "3C03",
+            "BERTHS": ["AB0007"],
+            "TIMES": [at(11)],
+            "CLASSES": [0],
+        },
+    ]
+
+
+def make_compactor(mongo):
+    return RetentionCompactor(logging.getLogger(), mongo, 2, 7, 10, 1)
+
+
+def movements(mongo):
+    counts = collections.Counter()
+    for doc in mongo.rollups["BERTH_HOURLY"]:
+        counts[doc["NAME"]] += doc["MOVEMENTS"]
+    return counts
+
+
+def traversals(mongo):
+    counts = collections.Counter()
+    for doc in mongo.rollups["EDGE_HOURLY"]:
+        counts[(doc["FROM"], doc["TO"])] += doc["COUNT"]
+    return counts
+
+
+def test_the_cutoff_is_not_moved_back():
+    mongo = TrainsMongo(make_trains())
+    make_compactor(mongo).compact(NOW)
+    assert mongo.cutoff == CUTOFF
+
+    trains = [dict(doc) for doc in mongo.trains]
+    make_compactor(mongo).compact(NOW - datetime.timedelta(hours=1))
+    assert mongo.cutoff == CUTOFF
+    assert mongo.trains == trains
+    assert sum(movements(mongo).values()) == 5
+
+
+def test_trains_with_no_steps_after_the_cutoff_are_removed():
+    mongo = TrainsMongo(make_trains())
+    make_compactor(mongo).compact(NOW)
+    assert [doc["NAME"] for doc in mongo.trains] == ["1A01", "3C03"]
+
+
+def test_trimming_keeps_the_last_step_before_the_cutoff_aligned():
+    trains = make_trains()
+    # Classes that no longer line up with the berths are classified again
+    trains[0]["CLASSES"] = [0, 0]
+    mongo = TrainsMongo(trains)
+    make_compactor(mongo).compact(NOW)
+    train = mongo.trains[0]
+    assert train["BERTHS"] == ["AB0003", "AB0004"]
+    assert train["TIMES"] == [at(9, 50), at(10, 30)]
+    assert train["CLASSES"] == [0, 0]
+    assert mongo.trains[1]["BERTHS"] == ["AB0007"]
+
+
+def test_each_step_is_rolled_up_once():
+    mongo = TrainsMongo(make_trains())
+    make_compactor(mongo).compact(NOW)
+    assert movements(mongo) == {
+        "AB0001": 1,
+        "AB0002": 1,
+        "AB0003": 1,
+        "AB0005": 1,
+        "AB0006": 1,
+    }
+    assert traversals(mongo) == {("AB0001", "AB0002"): 1, ("AB0005", "AB0006"): 1}
+
+    # The step kept before the first cutoff is not counted again
+    make_compactor(mongo).compact(NOW + datetime.timedelta(hours=2))
+    assert mongo.cutoff == NOW
+    counts = movements(mongo)
+    assert counts["AB0003"] == 1
+    assert counts["AB0004"] == 1 and counts["AB0007"] == 1
+    assert sum(counts.values()) == 7
+    assert traversals(mongo)[("AB0003", "AB0004")] == 1
+    assert sum(traversals(mongo).values()) == 3
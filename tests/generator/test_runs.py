@@ -0,0 +1,27 @@
+from generator.runs import compare_runs, stage_medians
+
+
+def make_run(wall, peak_mb):
+    return {
+        "STAGES": [
+            {"NAME": "berths", "WALL": wall, "CPU": wall, "PEAK_MB": peak_mb},
+            {"NAME": "update", "WALL": 0.1, "CPU": 0.1, "PEAK_MB": None},
+        ]
+    }
+
+
+def test_stage_medians_skip_missing_metrics():
+    medians = stage_medians([make_run(10, 100), make_run(20, 200), make_run(30, 300)])
+    assert medians["berths"] == {"WALL": 20, "CPU": 20, "PEAK_MB": 200}
+    assert "PEAK_MB" not in medians["update"]
+
+
+def test_regression_is_flagged():
+    rows = compare_runs([make_run(10, 100)], [make_run(20, 100)], 0.2)
+    regressed = {(r["stage"], r["metric"]) for r in rows if r["regressed"]}
+    assert regressed == {("berths", "WALL"), ("berths", "CPU")}
+
+
+def test_small_changes_are_ignored():
+    rows = compare_runs([make_run(1.0, 10)], [make_run(1.5, 15)], 0.2)
+    assert not any(r["regressed"] for r in rows)
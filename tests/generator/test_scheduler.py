@@ -0,0 +1,39 @@
+from generator.scheduler import RunScheduler
+
+
+def make_scheduler():
+    scheduler = RunScheduler(None, None, 3600, 60, 1000, 10)
+    scheduler.last_run = 0.0
+    scheduler.last_counts = (5000, 200)
+    return scheduler
+
+
+def test_first_run_is_immediate():
+    scheduler = RunScheduler(None, None, 3600, 60, 1000, 10)
+    assert scheduler.decide((0, 0), 5.0) == ("startup", 5.0)
+
+
+def test_thresholds_trigger_runs():
+    scheduler = make_scheduler()
+    assert scheduler.decide((5000, 210), 10.0)[0] == "edges"
+    assert scheduler.decide((6000, 200), 10.0)[0] == "movements"
+    assert scheduler.decide((5999, 209), 10.0) == (None, 70.0)
+
+
+def test_stale_only_with_new_data():
+    scheduler = make_scheduler()
+    assert scheduler.decide((5001, 200), 3590.0) == (None, 3600.0)
+    assert scheduler.decide((5001, 200), 3600.0)[0] == "stale"
+    assert scheduler.decide((5000, 200), 7200.0) == (None, 7260.0)
+
+
+def test_failed_runs_back_off():
+    scheduler = RunScheduler(None, None, 3600, 60, 1000, 10)
+    assert scheduler.failed(10.0) == 120
+    assert scheduler.decide((0, 0), 20.0) == (None, 80.0)
+    assert scheduler.decide((0, 0), 130.0) == ("startup", 130.0)
+    for _ in range(5):
+        delay = scheduler.failed(130.0)
+    assert delay == 3600
+    scheduler.succeeded((6000, 200), 4000.0)
+    assert scheduler.decide((6000, 200), 4010.0) == (None, 4070.0)